@@ -1,39 +1,65 @@
-import pigpio  # GPIO制御
 import math
 import random
 import socket
-import json
-import VL53L0X  # ToFセンサ
+import logging
 import threading
-from rpi_ws281x import PixelStrip, Color
-import time
 import datetime
 import sys
-import spidev # 圧力センサ
-import subprocess # 音声
 import os
 
+import hal  # ハードウェア(実機かシミュレーション)
+import log  # 出力を止めないログ
+import protocol  # 通信のメッセージ層
+import clock_sync  # マスターとの時計合わせ
+import discovery  # マスターの自動発見とつなぎ直し
+import heartbeat  # 接続が生きているかの確認
+from multicast import MulticastReceiver
+from audio import Audio, BandTable
+from pressure import BASELINE_PATH, Baseline, PressurePad, PressureTrigger, to_volts
+import render  # 描画の共通処理
+from panel_map import PanelMap, SERPENTINE
+from tof_scan import TofScanner, BackgroundScanner
+
+logger = log.get_logger("slave")
+# ループの中の細かいログ(TRACE_LOGがFalseなら出さない)
+trace = log.get_trace_logger("slave")
+
+# 実機のライブラリかシミュレーション(環境変数 HAL=sim)か
+hw = hal.open_hardware()
+
 # SPIバスを開く
 # 圧力
-spi = spidev.SpiDev()
+spi = hw.SpiDev()
 spi.open(1, 0)
 spi.max_speed_hz = 1000000
+# 圧力の読み取り周期(Hz)と、1回の読み取りで平均する回数
+PRESSURE_SAMPLE_RATE = 200
+PRESSURE_OVERSAMPLE = 4
+# 4チャンネルを1回のSPI転送でまとめて読む
+pad = PressurePad(spi, sample_rate=PRESSURE_SAMPLE_RATE, oversample=PRESSURE_OVERSAMPLE)
 
 # pigpioデーモンに接続し、piオブジェクトを作成
-pi = pigpio.pi()
+pi = hw.pi()
 
 # SG90のピン設定
 SERVO_PIN = 23  # SG90
-pi.set_mode(SERVO_PIN,pigpio.OUTPUT)
+pi.set_mode(SERVO_PIN, hal.OUTPUT)
 
 # ボタンのGPIO設定
 BUTTON_PIN = 3
-pi.set_mode(BUTTON_PIN,pigpio.INPUT)
+pi.set_mode(BUTTON_PIN, hal.INPUT)
 # チャタリング対策でデバウンスを50msに
 pi.set_glitch_filter(BUTTON_PIN, 50000)
 
 # 周期ごとの度数
 DEGREE_CYCLE = 1
+# Trueなら荒い走査で物体の範囲を見つけてからその範囲だけ細かく走査する
+FAST_SWEEP = True
+# Trueなら裏でずっと走査して物体の位置をキャッシュしておく
+BACKGROUND_SCAN = True
+# キャッシュの位置を使ってよい古さ(秒)。これより古ければ走査し直す
+# Noneなら測った走査1回の時間から決める(find_pos_fastの1回は実機で1.6秒ほどなので、固定するならそれより長く)
+SCAN_MAX_AGE = None
 # ディスプレイの大きさ(mm)
 DISPLAY_X = 160
 DISPLAY_Y = 160
@@ -48,14 +74,13 @@ Y_OUT = DISPLAY_Y - 7
 DISTANCE_ERROR = 0
 
 # Create a VL53L0X object
-tof = VL53L0X.VL53L0X()
+tof = hw.ToF()
 
 # Matrix setting
 MATRIX_WIDTH = 16
 MATRIX_HEIGHT = 16
 
 # LED設定
-LED_COUNT = 256  # 16x16
 LED_PIN = 10
 LED_FREQ_HZ = 800000
 LED_DMA = 10
@@ -63,15 +88,29 @@ LED_BRIGHTNESS = 10
 LED_INVERT = False
 LED_PER_PANEL = 16  # 列ごとのLED数 (16)
 LED_CHANNEL = 0
-
-# MASTER_IP = "192.168.10.65"
-MASTER_IP = "192.168.2.100" # マスター(尾崎)のラズパイ
-MASTER_PORT = 5000
+# パネルの配線と取り付け向き
+PANEL_WIRING = SERPENTINE
+PANEL_ROTATION = 0
+# 座標 -> LEDのインデックスの表
+panel_map = PanelMap(LED_PER_PANEL, LED_PER_PANEL, wiring=PANEL_WIRING, rotation=PANEL_ROTATION)
+LED_COUNT = panel_map.led_count  # 16x16
+
+# MASTER_IP = "192.168.2.100" # マスター(尾崎)のラズパイ
+# 空ならマスターのビーコンで見つける。環境変数で決め打ちにもできる(ベンチマーク用)
+MASTER_IP = os.environ.get("MASTER_IP", "")
+MASTER_PORT = int(os.environ.get("MASTER_PORT", 5000))
+# ビーコンを1回に待つ時間(秒)。来なければつなぎ直しの間隔をあけてまた待つ
+DISCOVERY_TIMEOUT = 3.0
+# draw/sensor_dataを固定長バイナリで送るか(FalseならJSON)
+BINARY_PROTOCOL = True
+# ログのレベル。DEBUGにしても細かいログ(1角度・1メッセージごと)はTRACE_LOGがTrueのときだけ出る
+LOG_LEVEL = logging.INFO
+TRACE_LOG = False
 
 
 # スレーブの列・行番号 (マスターを0,0とする)
-SLAVE_ROWS = 0  # 横方向
-SLAVE_COLS = 1  # 縦方向
+SLAVE_ROWS = int(os.environ.get("SLAVE_ROWS", 0))  # 横方向
+SLAVE_COLS = int(os.environ.get("SLAVE_COLS", 1))  # 縦方向
 # スレーブ1の担当領域
 SLAVE_ORIGIN_X = LED_PER_PANEL * SLAVE_ROWS  # x方向のオフセット
 SLAVE_ORIGIN_Y = LED_PER_PANEL * SLAVE_COLS  # y方向のオフセット
@@ -91,6 +130,10 @@ def quitting():
     master_connection.stop_connection()
     # コールバックを解除して終了
     cb.cancel()
+    trigger.stop()
+    audio.stop()
+    # 裏の走査を止めてからサーボ(pigpio)を止める
+    background_scanner.stop()
     pi.stop()
     # 圧力センサに関するものを閉じる
     spi.close()
@@ -98,16 +141,29 @@ def quitting():
     tof.stop_ranging()
     # Clear on exit
     clear_screen()
+    # LEDに送ったフレーム数と省略したフレーム数
+    print(f"> LED frames: {compositor.stats()}")
+    # 鳴らした音の数と鳴り始めるまでの時間
+    print(f"> Audio: {audio.stats()}")
+    # 位置特定にかかった時間(最後の1回の内訳)と、裏の走査のキャッシュを使えた回数
+    print(f"> Scan: {scanner.latency_stats()} last: {scanner.last_report}")
+    print(f"> Scan cache: {background_scanner.stats()}")
+    # マルチキャストで受け取った数と、抜けて再送を頼んだもの
+    print(f"> Multicast: {master_connection.multicast_stats()}")
     # server.shutdown()
 
+    # 残っているログを書き出す
+    log.shutdown()
     # システム終了
     print("This Raspberry Pi shutdown")
-    os.system("sudo shutdown -h now")
+    if not hw.simulated:
+        os.system("sudo shutdown -h now")
 
 
 
 class MasterConnection:
-    def __init__(self, master_ip, master_port, row, column):
+    def __init__(self, master_ip, master_port, row, column,
+                 heartbeat_interval=heartbeat.HEARTBEAT_INTERVAL, heartbeat_timeout=heartbeat.HEARTBEAT_TIMEOUT):
         self.master_ip = master_ip
         self.master_port = master_port
         self.row = row
@@ -115,120 +171,242 @@ class MasterConnection:
         self.client_socket = None
         self.listener_thread = None
         self.running = False  # スレッドの実行状態
+        self.wakeup = threading.Event()  # つなぎ直しの待ちを止める
+        self.close_lock = threading.Lock()  # 受信スレッドとメインの両方から閉じるので
         self.client_id = self.get_client_id()  # ユニークなクライアントIDを生成
+        self.clock_sync = clock_sync.ClockSync()  # マスターの時計とのずれ
+        self.send_lock = threading.Lock()  # 時計合わせのスレッドとメインから送るので
+        self.multicast = None  # マスターが描画コマンドをマルチキャストで送るときのMulticastReceiver
+        self.multicast_totals = {}  # 止めたMulticastReceiverの分のstats()の合計
+        # 接続の状態。heartbeat_interval秒ごとに送り、heartbeat_timeout秒返事がなければ切る
+        self.heartbeat_interval = heartbeat_interval
+        self.link = heartbeat.LinkState("master", degraded=2 * heartbeat_interval, timeout=heartbeat_timeout)
 
     def get_client_id(self):
         """ユニークなクライアントIDを生成"""
         return f"Device_{socket.gethostname()}"
 
-    def connect_to_master(self):
+    def find_master(self):
+        """つなぐ先の(ip, port)。MASTER_IPがなければビーコンを待つ(来なければNone)"""
+        if self.master_ip:
+            return self.master_ip, self.master_port
+        address = discovery.discover_master(DISCOVERY_TIMEOUT, cancel=self.wakeup)
+        if address is not None:
+            logger.info("Found master at %s:%d", *address)
+        return address
+
+    def connect_to_master(self, master_ip, master_port):
         """マスターに接続"""
+        self.link.connecting()
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.master_ip, self.master_port))
-            print(f"> Connected to master at {self.master_ip}:{self.master_port}")
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((master_ip, master_port))
+            # アプリが止まっていてもOSが相手の死を見つけられるように
+            heartbeat.set_keepalive(sock)
+            self.client_socket = sock
+            self.link.up()
+            logger.info("Connected to master at %s:%d", master_ip, master_port)
 
             # 接続時に初期データを送信
             init_data = {
                 "type": "init",
                 "client_id": self.client_id,
-                "position": {"row": self.row, "column": self.column}
+                "position": {"row": self.row, "column": self.column},
+                # このパネルが受け持つ全体の座標の範囲(マスターが波紋の届く先を絞るのに使う)
+                "origin": {"x": SLAVE_ORIGIN_X, "y": SLAVE_ORIGIN_Y},
+                "size": {"width": panel_map.width, "height": panel_map.height}
             }
             self.send_to_master(init_data)
+            # ハートビートと時計合わせは別スレッドで続ける(この接続が切れたら終わる)
+            keepalive_thread = threading.Thread(target=self.keep_alive, args=(sock,))
+            keepalive_thread.daemon = True
+            keepalive_thread.start()
             return True
         except socket.error as e:
-            print(f"> Connection error: {e}")
+            logger.warning("Connection error: %s", e)
+            self.link.down()
             return False
 
     def send_to_master(self, data):
-        """マスターにデータを送信"""
-        if self.is_connected():
+        """マスターにデータを送信(生きているかはハートビートで見ているので、送る前に確かめない)"""
+        sock = self.client_socket
+        if sock is not None and self.link.usable:
             try:
-                self.client_socket.send(json.dumps(data).encode())
-                print(f"> Sent to master: {data}\n")
+                message = protocol.encode_message(data, BINARY_PROTOCOL)
+                with self.send_lock:
+                    sock.sendall(message)
+                trace.debug("Sent to master: %s", data)
             except Exception as e:
-                print(f"> Error sending data to master: {e}")
+                logger.warning("Error sending data to master: %s", e)
         else:
-            print("> Not connected to master. Cannot send data.")
+            logger.warning("Not connected to master. Cannot send data.")
 
     def listen_for_master(self):
-        global isSingleMode
-        """マスターからのデータをリッスン"""
+        """マスターからのデータをリッスン。切れたら戻る。マスターから何か届いていればTrue"""
+        decoder = protocol.FrameDecoder()
+        answered = False
+        sock = self.client_socket
         try:
             while self.running:
-                data = self.client_socket.recv(1024)
-                if not data:  # マスターが接続を切断
-                    print("> Connection closed by master.")
-                    isSingleMode = True
+                data = sock.recv(4096)
+                received = hal.clock.monotonic()  # 時計合わせに使う受信時刻
+                if not data:
+                    if self.client_socket is sock:  # マスターが接続を切断(こちらで閉じたのではない)
+                        logger.info("Connection closed by master.")
                     break
-                try:
-                    received_data = json.loads(data.decode())
-                    print(f"> Received from master: {received_data}")
-                    self.handle_command(received_data)
-                except json.JSONDecodeError:
-                    print("> Failed to decode data from master.")
+                answered = True
+                self.link.received()
+                # 1回のrecvに複数のメッセージが入っていることもある
+                for received_data in decoder.feed(data):
+                    trace.debug("Received from master: %s", received_data)
+                    self.handle_command(received_data, received)
         except Exception as e:
-            print(f"> Listening error: {e}")
+            logger.warning("Listening error: %s", e)
         finally:
-            self.stop_connection()
+            self.close_socket()
+        return answered
 
-    def handle_command(self, command):
+    def handle_command(self, command, received=None):
         """マスターからのコマンドを処理"""
         global isSingleMode
         if command["type"] == "draw":
+            hal.mark("draw_received")
             x = command["x"]
             y = command["y"]
             colors = command["colors"]
             max_radius = command["max_radius"]
-            # 描画処理を実行（スレッドでアニメーション）
-            animation_slave_thread = threading.Thread(target=animate_slave_circles, args=(x, y, colors, max_radius,))
-            animation_slave_thread.daemon = True  # メインが終われば終わる
-            animation_slave_thread.start()
+            # マスターの時計での描き始めの時刻を自分の時計に直す(時計合わせがまだならすぐ描く)
+            start_at = command.get("start_at")
+            if start_at is not None:
+                start_at = self.clock_sync.to_local(start_at)
+            # 描画処理を実行（compositorにレイヤーを追加）
+            animate_slave_circles(x, y, colors, max_radius, start_at)
+        elif command["type"] == "sync_reply":
+            self.clock_sync.add(command, received if received is not None else hal.clock.monotonic())
+            # フレームの区切りをマスターにそろえる
+            compositor.phase = self.clock_sync.phase(compositor.interval)
+            trace.debug("Clock offset: %.4f s, rtt: %.4f s", self.clock_sync.offset, self.clock_sync.rtt)
+        elif command["type"] == "multicast":
+            # 以降の描画コマンドはマルチキャストで届く
+            self.start_multicast(command)
         elif command["type"] == "clear":
             clear_screen()
         elif command["type"] == "multiend":
             isSingleMode = True
 
+    def start_multicast(self, announcement):
+        """マスターに教えられたグループに参加する。抜けたコマンドはTCPで再送を頼む"""
+        if self.multicast is not None:
+            self.retire_multicast(self.multicast)
+        self.multicast = MulticastReceiver(
+            self.handle_command,
+            lambda seqs: self.send_to_master({"type": "nack", "seqs": seqs}),
+            group=announcement["group"], port=announcement["port"])
+        try:
+            self.multicast.start(announcement["seq"])
+        except OSError as e:
+            logger.warning("Could not join multicast group: %s", e)
+            self.multicast = None
+            # 描画コマンドはTCPで送ってもらう
+            self.send_to_master({"type": "multicast_failed"})
+
+    def retire_multicast(self, receiver):
+        """receiverを止めて、数えたものを合計に足しておく"""
+        receiver.stop()
+        for key, value in receiver.stats().items():
+            self.multicast_totals[key] = self.multicast_totals.get(key, 0) + value
+
+    def multicast_stats(self):
+        """これまでのマルチキャストの受信数・重複・抜け(つなぎ直す前の分も含む)"""
+        totals = dict(self.multicast_totals)
+        receiver = self.multicast
+        if receiver is not None:
+            for key, value in receiver.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def keep_alive(self, sock):
+        """sockでつながっている間、ハートビートとsyncを送る。返事が途絶えたら切ってつなぎ直させる
+
+        syncにもマスターは返事をするので、syncを送るときはハートビートを送らない
+        """
+        count = 0
+        next_sync = hal.clock.monotonic()
+        while self.running and self.client_socket is sock:
+            now = hal.clock.monotonic()
+            if now >= next_sync:
+                self.send_to_master(clock_sync.sync_request())
+                count += 1
+                next_sync = now + (clock_sync.SYNC_BURST_INTERVAL if count < clock_sync.SYNC_BURST
+                                   else clock_sync.SYNC_INTERVAL)
+            else:
+                self.send_to_master(heartbeat.heartbeat())
+            if self.link.check() == heartbeat.DOWN:
+                logger.warning("No reply from master for %.1f s", self.link.timeout)
+                self.close_socket()
+                break
+            hal.clock.sleep(min(self.heartbeat_interval, max(0.0, next_sync - hal.clock.monotonic())))
+
     def is_connected(self):
-        """接続状態を確認"""
-        if self.client_socket:
-            try:
-                self.client_socket.send(b"")  # 空データを送信して確認
-                return True
-            except socket.error:
-                return False
-        return False
+        """接続状態を確認(ソケットには触らない)"""
+        return self.client_socket is not None and self.link.usable
 
     def start_connection(self):
         """接続スレッドを開始"""
         self.running = True
-        if not self.client_socket:
+        self.wakeup.clear()
+        if not (self.listener_thread and self.listener_thread.is_alive()):
             self.listener_thread = threading.Thread(target=self.run)
             self.listener_thread.daemon = True
             self.listener_thread.start()
 
     def run(self):
-        """マスターとの接続を試みてデータをリッスン"""
-        if self.connect_to_master():
-            self.listen_for_master()
+        """マスターを探してつなぎ、切れたらつなぎ直す(stop_connectionまで続ける)
 
-    def stop_connection(self):
-        global isSingleMode
-        """接続を停止"""
-        self.running = False
-        if self.client_socket:
+        失敗が続くほど間隔を伸ばし、ゆらぎを入れて全スレーブが一斉につなぎ直さないようにする
+        """
+        backoff = discovery.Backoff()
+        while self.running:
             try:
-                self.client_socket.shutdown(socket.SHUT_RDWR) # ソケットの読み書き中止。これでlisten_for_masterのrecvがとまる
-                self.client_socket.close()
-                print("> Disconnected from master.")
-                # 接続が切れたら単体機能に
-                isSingleMode = True
+                address = self.find_master()
+                if address is not None and self.connect_to_master(*address):
+                    # マスターが返事をしていれば(受け付けられていれば)間隔を最初に戻す
+                    if self.listen_for_master():
+                        backoff.reset()
             except Exception as e:
-                print(f"> Error closing connection: {e}")
-            self.client_socket = None  # ソケットをリセット
+                # 何が起きてもつなぎ直しのスレッドは止めない
+                logger.warning("Connection attempt failed: %s", e)
+                self.close_socket()
+            if not self.running:
+                break
+            delay = backoff.next()
+            logger.info("Reconnecting to master in %.1f s", delay)
+            self.wakeup.wait(hal.clock.real(delay))
+
+    def close_socket(self):
+        """今の接続だけを閉じる(つなぎ直しは続ける)"""
+        with self.close_lock:
+            receiver, self.multicast = self.multicast, None
+            sock, self.client_socket = self.client_socket, None
+        if receiver is not None:
+            self.retire_multicast(receiver)
+        self.link.down()
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # ソケットの読み書き中止。これでlisten_for_masterのrecvがとまる
+            except OSError:
+                pass  # もう切れている
+            sock.close()
+            logger.info("Disconnected from master.")
+
+    def stop_connection(self):
+        """接続を停止(つなぎ直しもやめる)"""
+        self.running = False
+        self.wakeup.set()
+        self.close_socket()
         if threading.current_thread() != self.listener_thread and self.listener_thread and self.listener_thread.is_alive():
             self.listener_thread.join()
-            print("> Listener thread stopped")
+            logger.info("Listener thread stopped")
 
 
 
@@ -236,33 +414,9 @@ class MasterConnection:
 
 def clear_screen():
     """LEDマトリクスを消灯。"""
-    for i in range(LED_COUNT):
-        strip.setPixelColor(i, Color(0, 0, 0))
-    strip.show()
-
-# 圧力読み取りにつかう関数
-# MCP3008から値を読み取るメソッド
-# チャンネル番号は0から7まで
-def ReadChannel(channel):
-    adc = spi.xfer2([1, (8 + channel) << 4, 0])
-    data = ((adc[1] & 3) << 8) + adc[2]
-    return data
-
-
-# 得た値を電圧に変換するメソッド
-# 指定した桁数で切り捨てる
-def ConvertVolts(data, places):
-    volts = (data * 5) / float(1023)
-    volts = round(volts, places)
-    return volts
-
+    compositor.clear()
 
 # 位置特定につかう関数
-# 変数の初期化
-def valInit():
-    valInit.SvDeg = 0  # サーボモータの現在角度
-
-
 # サーボモータを特定の角度に設定する関数
 def set_angle(angle):
     assert 0 <= angle <= 180, '角度は0から180の間でなければなりません'
@@ -290,6 +444,13 @@ def calculateGap(degree):
     return X_GAP, Y_GAP
 
 
+# 極座標(角度, 距離)からずれを補正した筐体の座標(x, y)へ
+def to_point(degree, distance):
+    x, y = getXY(distance, degree)
+    X_GAP, Y_GAP = calculateGap(degree)
+    return x - X_GAP, y - Y_GAP
+
+
 # 範囲内か識別
 def isRange(x, y):
     if x > DISPLAY_X or y > DISPLAY_Y:  # ディスプレイの大きさ外なら
@@ -298,189 +459,43 @@ def isRange(x, y):
         return False
     return True
 
-# 位置特定
-def find_pos(timing):
-    # 極座標の特定(角度, 距離)
-    # 極座標変換(x, y)および範囲内かどうか
-    # 範囲内の最初と最後のx,yを配列に入れる
-    # 配列から範囲内に最初になった座標と最後に範囲内になった座標の中心(物体の中心座標)を返す
-
-    # サーボを0度に設定
-    valInit.SvDeg = 0
-    set_angle(valInit.SvDeg)
-
-    time.sleep(0.1)
-
-    # 配列の初期化
-    pointlist = []
-
-    flag = False
-
-    count = 0
-
-    for i in range(0, 91, DEGREE_CYCLE):  # 0~90度で増加量はDEGREE_CYCLE
-        valInit.SvDeg = i
-        set_angle(valInit.SvDeg)  # サーボを回転
-        # print(valInit.SvDeg)
-
-        # ToFセンサで測距S
-        distance = tof.get_distance()
-        # ToFセンサの誤差を引いて正確な値にする
-        distance -= DISTANCE_ERROR
-        if (distance > 0):
-            # 角度と距離の表示
-            print("angle: %d \t distance: %d mm" % (valInit.SvDeg, distance))
-
-            # 極座標変換 (半径,角度)から(x,y)
-            x, y = getXY(distance, valInit.SvDeg)
-            X_GAP, Y_GAP = calculateGap(valInit.SvDeg)
-            x -= X_GAP  # x座標のずれを減らす
-            y -= Y_GAP  # y座標のずれを減らす
-            print("pos:x %d, y %d \t GAP:x %d, y %d" % (x, y, X_GAP, Y_GAP))
-            if not flag:  # flagがFalseのとき
-                if isRange(x, y):  # 範囲内なら
-                    print("isrange true")
-                    count += 1
-                else:
-                    print("isrange false")
-                    count = 0
-                if count == 5:  # 5度連続で範囲内ならflagをtrueに
-                    flag = True
-            else:  # flagがTrueのとき
-                pointlist.append([x, y])
-                print(pointlist[-1])
-                if not isRange(x, y):  # 範囲外なら
-                    print("isrange false")
-                    count += 1
-                else:
-                    print("isrange true")
-                    count = 0
-                if count == 5:  # 5度連続で範囲外ならforをぬける
-                    break
-        time.sleep(timing / 1000000.00)
-
-    # 余分に記録した末尾5個のリストを削除
-    del pointlist[-5:]
-    # print(pointlist)
-
-    # もしリストが入ってなかったら
-    if len(pointlist) == 0:
-        return -1, -1
-
-    # リストの中央値(物体の中心座標)を求める
-    mid = len(pointlist) // 2
-    res_x = pointlist[mid][0]
-    res_y = pointlist[mid][1]
-
-    return res_x, res_y
-
-def zigzag_transform(x, y, width=16):
-    """ジグザグ配列に変換する座標"""
-    if y % 2 == 1:
-        x = LED_PER_PANEL - 1 - x
-    return x, y
+# 1回分の走査
+# FAST_SWEEPなら荒い走査→細かい走査、そうでなければ0~90度をDEGREE_CYCLEずつ走査
+# 走査の向きはサーボが今いる端から(0→90度、90→0度を交互に)
+def sweep_once():
+    if FAST_SWEEP:
+        return scanner.find_pos_fast()
+    return scanner.find_pos()
+
+# 物体の位置特定
+# BACKGROUND_SCANなら裏で走査した位置を使う(古ければ走査し直す)
+def locate_object():
+    if BACKGROUND_SCAN:
+        return background_scanner.get_position()
+    return sweep_once()
 
 # 単体機能でつかう関数
 # Update positions of multiple points simultaneously
 # ターゲットポジションにたどり着くまで乱数で生成した位置から光をターゲットポジションに移動させる
-def update_positions(points, target_x, target_y, strip, speed):
-    while points:
-        print("light gathering...")
-        # Update each point's position
-        # それぞれのポイントの座標更新
-        for point in points[:]:
-            x, y, color = point
-            # Clear current position
-            zigzag_x, zigzag_y = zigzag_transform(x, y)
-            index = zigzag_y * LED_PER_PANEL + zigzag_x
-            strip.setPixelColor(index, Color(0, 0, 0))
-
-            # Calculate direction to target
-            dx = target_x - x
-            dy = target_y - y
-
-            #print("%d dx: %d dy: %d" % (points.index(point), dx, dy))
-            # ターゲットポジションにたどり着いたら
-            if abs(dx) < 1 and abs(dy) < 1:
-                # ポイントの削除
-                points.remove(point)
-            # ターゲットポジションにたどり着いてなかったら
-            else:
-                # 座標更新
-                if abs(dx) > abs(dy):
-                    x += 1 if dx > 0 else -1
-                else:
-                    y += 1 if dy > 0 else -1
-                zigzag_x, zigzag_y = zigzag_transform(x, y)
-                index = zigzag_y * LED_PER_PANEL + zigzag_x
-                # Draw new position
-                strip.setPixelColor(index, color)
-                # Update the point in the list
-                points[points.index(point)] = (x, y, color)
-
-        # Show updated positions
-        strip.show()
-        time.sleep(speed)
+def update_positions(points, target_x, target_y):
+    # 描画はcompositorが1フレームずつ進める。全部の点がたどり着くまで待つ
+    gathering = render.Gathering(points, target_x, target_y)
+    compositor.add_layer(gathering)
+    gathering.wait()
 
 # 複数機能につかう関数
 # 円の配列の作成
 def circle_pixels(xc, yc, radius):
     """Generate circle pixels for a given center and radius."""
-    x, y = 0, radius
-    d = 1 - radius
-    pixels = []
-
-    while x <= y:
-        for dx, dy in [(x, y), (y, x), (-x, y), (-y, x), (x, -y), (y, -x), (-x, -y), (-y, -x)]:
-            if 0 <= xc + dx < MATRIX_GLOBAL_WIDTH and 0 <= yc + dy < MATRIX_GLOBAL_HEIGHT:
-                pixels.append((xc + dx, yc + dy))
-        if d < 0:
-            d += 2 * x + 3
-        else:
-            d += 2 * (x - y) + 5
-            y -= 1
-        x += 1
-    return pixels
+    return render.ring_pixels(xc, yc, radius, 0, 0, MATRIX_GLOBAL_WIDTH, MATRIX_GLOBAL_HEIGHT)
 
 # スレーブの描画
-def draw_slave(frame_pixels, color):
-    # Draw a single frame of animation.
-    slave_pixels = [p for p in frame_pixels if
-                    SLAVE_ORIGIN_X <= p[0] < SLAVE_ORIGIN_X + 16 and SLAVE_ORIGIN_Y <= p[1] < SLAVE_ORIGIN_Y + 16]
-
-    # Draw slave pixels
-    for x, y in slave_pixels:
-        # ローカル座標に変換
-        x -= SLAVE_ORIGIN_X
-        y -= SLAVE_ORIGIN_Y
-        # ジグザグ変換
-        zigzag_x, zigzag_y = zigzag_transform(x, y)
-        index = zigzag_y * LED_PER_PANEL + zigzag_x
-        strip.setPixelColor(index, Color(color[0], color[1], color[2]))
-    strip.show()
-
-def animate_slave_circles(xc, yc, colors, max_radius):
-    radius = 0
-    clear_radius = 0
-    print("center of the circle: x:%d, y:%d" % (xc - SLAVE_ORIGIN_X, yc - SLAVE_ORIGIN_Y))
-    # 円の描画
-    while True:
-        if clear_radius == max_radius:
-            break
-        if radius < max_radius:
-            circle = circle_pixels(xc, yc, radius)
-            color = colors[radius % CIRCLE_WIDTH]
-            
-            draw_slave(circle, color)
-
-            radius += 1
-
-        if radius > CIRCLE_WIDTH:
-            clear_circle = circle_pixels(xc, yc, clear_radius)
-            # 描画を消す
-            draw_slave(clear_circle, [0, 0, 0])
-            clear_radius += 1
-        time.sleep(0.1)
+# 1フレームずつの描画はcompositorがやるので、レイヤーを登録したらすぐ戻る
+def animate_slave_circles(xc, yc, colors, max_radius, start_at=None):
+    logger.info("center of the circle: x:%d, y:%d", xc - SLAVE_ORIGIN_X, yc - SLAVE_ORIGIN_Y)
+    # ローカル座標に変換。start_atがあれば全パネルが同じ時刻に同じフレームを描く
+    compositor.add_layer(render.Ripple(xc - SLAVE_ORIGIN_X, yc - SLAVE_ORIGIN_Y, colors, max_radius, CIRCLE_WIDTH,
+                                       start_at=start_at))
 
 # 単体機能メイン
 def single_function():
@@ -495,41 +510,24 @@ def single_function():
                 clear_screen()
                 return
 
-            # 圧力の合計データの初期化
-            data_total = 0
-            # ４箇所の圧力を測定
-            for i in range(4):
-                # センサのチャンネルの切り替え
-                data = ReadChannel(i)
-                data_total += data
-                print("channel: %d" % (i))
-                print("A/D Converter: {0}".format(data))
-                volts = ConvertVolts(data,3)
-                print("Volts: {0}".format(volts))
-            # ４つの圧力の合計値(通信する変数1:data_total)
-            print("Data total: {0}\n".format(data_total))
-            #data_total = 2000 # デバック用圧力合計値
-            # 一定以下の圧力になったら抜ける
-            if data_total >= DATA_TOTAL_MIN:
-                if DATA_TOTAL_MIN <= data_total < DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL:
-                    MP3_PATH = 'music1.mp3'
-                elif DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2):
-                    MP3_PATH = 'music2.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2) <= data_total < DATA_TOTAL_MIN + (
-                        DATA_TOTAL_INTERVAL * 3):
-                    MP3_PATH = 'music3.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3) <= data_total < DATA_TOTAL_MIN + (
-                        DATA_TOTAL_INTERVAL * 4):
-                    MP3_PATH = 'music4.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4) <= data_total:
-                    MP3_PATH = 'music5.mp3'
+            # 閾値を超えた瞬間に戻る(超えなければ0.1秒ごとにモードの切り替えを確認)
+            press = trigger.wait_press(timeout=0.1)
+            if press is not None:
                 break
-            time.sleep(0.5)
-                
-                
+
         # ToFセンサとサーボで物体の位置特定
-        print("find position of object")
-        target_x, target_y = find_pos(timing)
+        logger.info("find position of object")
+        target_x, target_y = locate_object()
+
+        # 押している間の圧力の最大値(位置特定の間に集め終わっている)
+        # ４つの圧力の合計値(通信する変数1:data_total)
+        data_total = press.wait_peak()
+        # 押したときの閾値(基準値に合わせて動く)を音楽の区切りの基準にする
+        data_total_min = press.threshold
+        #data_total = 2000 # デバック用圧力合計値
+        logger.info("Data total: %d", data_total)
+        # 閾値からの圧力の大きさで鳴らす曲を選ぶ
+        music = audio.select(data_total - data_total_min)
         if target_x < 0 or target_y < 0:
             continue
         #print("\n x:%d mm \t y:%d mm\n" % (target_x, target_y))
@@ -537,7 +535,7 @@ def single_function():
         target_x /= 10 # mmからcmに変換
         target_y /= 10 # mmからcmに変換
 
-        print(f"Target position: ({target_x}, {target_y})")
+        logger.info("Target position: (%d, %d)", target_x, target_y)
         # target_x, target_y = MATRIX_WIDTH / 2, MATRIX_HEIGHT / 2
         target_x, target_y = int(target_x), int(target_y)
 
@@ -546,21 +544,19 @@ def single_function():
         points = []
         # 圧力の値から生成する点の数を設定
         generated_points = int((10000 - data_total) / 700)
-        print("generated points: %d\n" % (generated_points))
+        logger.info("generated points: %d", generated_points)
         for _ in range(generated_points):  # Number of points
-            x = random.randint(0, MATRIX_WIDTH - 1)
-            y = random.randint(0, MATRIX_HEIGHT - 1)
-            color = Color(random.randint(50, 255), random.randint(50, 255), random.randint(50, 255))
+            x = random.randint(0, panel_map.width - 1)
+            y = random.randint(0, panel_map.height - 1)
+            color = hw.Color(random.randint(50, 255), random.randint(50, 255), random.randint(50, 255))
             points.append((x, y, color))
 
-        print()
-        subprocess.Popen(['mpg321',MP3_PATH])
-        print()
+        audio.play(music)
 
         # Move all points toward the target simultaneously
-        print("update position start")
-        update_positions(points, target_x, target_y, strip, speed=0.1)
-        print("update position end")
+        trace.debug("update position start")
+        update_positions(points, target_x, target_y)
+        trace.debug("update position end")
 
         # Clear the matrix
         clear_screen()
@@ -573,15 +569,9 @@ def single_function():
 def multi_slave_function(master_connection: MasterConnection):
     global isSingleMode
 
-    # マスター接続を開始
+    # マスター接続を開始(見つかるまで、切れてもつなぎ直し続ける。待たずに圧力の監視に入る)
     master_connection.start_connection()
-    # 接続を待つ
-    time.sleep(1)
 
-    if master_connection.is_connected() == False:
-        # 単体機能にする
-        isSingleMode = True
-    
     while True:
         
         # 4つの圧力センサで重さ測定
@@ -594,42 +584,25 @@ def multi_slave_function(master_connection: MasterConnection):
                 clear_screen()
                 return
 
-            # 圧力の合計データの初期化
-            data_total = 0
-            # ４箇所の圧力を測定
-            for i in range(4):
-                # センサのチャンネルの切り替え
-                data = ReadChannel(i)
-                data_total += data
-                print("channel: %d" % (i))
-                print("A/D Converter: {0}".format(data))
-                volts = ConvertVolts(data,3)
-                print("Volts: {0}".format(volts))
-            # ４つの圧力の合計値(通信する変数1:data_total)
-            print("Data total: {0}\n".format(data_total))
-            #data_total = 2500 # デバック用圧力合計値
-            # 一定以下の圧力になったら抜ける
-            if data_total >= DATA_TOTAL_MIN:
-                if DATA_TOTAL_MIN <= data_total < DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL:
-                    MP3_PATH = 'music1.mp3'
-                elif DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2):
-                    MP3_PATH = 'music2.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2) <= data_total < DATA_TOTAL_MIN + (
-                        DATA_TOTAL_INTERVAL * 3):
-                    MP3_PATH = 'music3.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3) <= data_total < DATA_TOTAL_MIN + (
-                        DATA_TOTAL_INTERVAL * 4):
-                    MP3_PATH = 'music4.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4) <= data_total:
-                    MP3_PATH = 'music5.mp3'
+            # 閾値を超えた瞬間に戻る(超えなければ0.1秒ごとにモードの切り替えを確認)
+            press = trigger.wait_press(timeout=0.1)
+            if press is not None:
                 break
-            time.sleep(0.5)
-                
 
-                
         # ToFセンサとサーボで物体の位置特定
-        print("find position of object")
-        target_x, target_y = find_pos(timing)
+        logger.info("find position of object")
+        target_x, target_y = locate_object()
+        hal.mark("located", x=target_x, y=target_y)
+
+        # 押している間の圧力の最大値(位置特定の間に集め終わっている)
+        # ４つの圧力の合計値(通信する変数1:data_total)
+        data_total = press.wait_peak()
+        # 押したときの閾値(基準値に合わせて動く)を音楽の区切りの基準にする
+        data_total_min = press.threshold
+        #data_total = 2500 # デバック用圧力合計値
+        logger.info("Data total: %d", data_total)
+        # 閾値からの圧力の大きさで鳴らす曲を選ぶ
+        music = audio.select(data_total - data_total_min)
         if target_x < 0 or target_y < 0:
             continue
         #print("\n x:%d mm \t y:%d mm\n" % (target_x, target_y))
@@ -641,12 +614,10 @@ def multi_slave_function(master_connection: MasterConnection):
         target_y += SLAVE_SPACE * SLAVE_COLS
 
         
-        print(f"Global Target position: ({target_x}, {target_y})")
+        logger.info("Global Target position: (%d, %d)", target_x, target_y)
         target_x, target_y = int(target_x), int(target_y)
 
-        print()
-        subprocess.Popen(['mpg321',MP3_PATH])
-        print()
+        audio.play(music)
 
         # グローバル座標に変換
         target_x += SLAVE_ORIGIN_X
@@ -655,8 +626,10 @@ def multi_slave_function(master_connection: MasterConnection):
             "type": "sensor_data",
             "x": target_x,
             "y": target_y,
-            "data_total": data_total - DATA_TOTAL_MIN
+            "data_total": data_total - data_total_min
         }
+        # 送り始めの時刻(マスターが受け取る方が送り終わるより先になることがある)
+        hal.mark("sent")
         master_connection.send_to_master(sensor_data)
 
         #time.sleep(5) # デバッグ用
@@ -671,11 +644,11 @@ def button_callback(gpio, level, tick):
     #print(f"Button pressed! GPIO: {gpio}, Level: {level}, Tick: {tick}")
 
     if level == 0:  # ボタンが押されたとき  # ボタンが押されたとき
-        pressed_time = time.time()  # ボタンが押された時間を記録
+        pressed_time = tick  # ボタンが押された時間を記録(us)
 
     elif level == 1:
-        released_time = time.time()
-        press_duration = released_time - pressed_time  # 押していた時間を記録
+        released_time = tick
+        press_duration = hal.tick_diff(pressed_time, released_time) / 1000000  # 押していた時間を記録
         print(f"#####Button press duration: {press_duration:.2f} second#####")
 
         if press_duration >= 5:
@@ -695,51 +668,70 @@ def button_callback(gpio, level, tick):
 
 
 if __name__ == '__main__':
+    # ログはキューに積んで別スレッドで書き出す
+    log.setup(LOG_LEVEL, trace=TRACE_LOG)
     # 単体機能か複数機能か判断
     isSingleMode = True
     # 初期設定
-    valInit()  # 変数の初期化
-
     # ToF起動
-    tof.start_ranging(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE)
-
-    timing = tof.get_timing()
-    if (timing < 20000):
-        timing = 20000
+    # 荒い走査は高速モード、細かい走査は精度の高いモードで測る
+    # シミュレーションのToFは物体までの距離をこの変換から逆算する
+    hw.set_geometry(to_point)
+    scanner = TofScanner(tof, set_angle, to_point, isRange,
+                         hal.HIGH_SPEED_MODE, hal.BETTER_ACCURACY_MODE,
+                         distance_error=DISTANCE_ERROR, degree_cycle=DEGREE_CYCLE)
+    timing = scanner.set_mode(hal.BETTER_ACCURACY_MODE)
     print("Timing %d ms" % (timing / 1000))
 
+    # 裏で物体の位置を探し続けるスレッド
+    background_scanner = BackgroundScanner(sweep_once, max_age=SCAN_MAX_AGE)
+    if BACKGROUND_SCAN:
+        background_scanner.start()
+
     print()
 
-    # 圧力の合計データの初期化
-    data_total = 0
-    # ４箇所の圧力を測定
+    # ４箇所の圧力をまとめて測定
+    data = pad.read()
     for i in range(4):
-        # センサのチャンネルの切り替え
-        data = ReadChannel(i)
-        data_total += data
-        print("channel: %d" % (i))
-        print("A/D Converter: {0}".format(data))
-        volts = ConvertVolts(data,3)
-        print("Volts: {0}".format(volts))
+        print("channel: %d\tA/D Converter: %d\tVolts: %.3f" % (i, data[i], to_volts(data[i])))
     # ４つの圧力の合計値(通信する変数1:data_total)
+    data_total = sum(data)
     print("Data total: {0}\n".format(data_total))
     
-    # 圧力の最小値を最初の圧力ちをもとに設定
-    DATA_TOTAL_MIN = data_total + 50
+    # 圧力の最小値を前回保存した基準値(なければ最初の圧力値)をもとに設定
+    # シミュレーションのときは実機の基準値を読み書きしない
+    baseline = Baseline(path=None if hw.simulated else BASELINE_PATH)
+    if baseline.start(data_total):
+        print(f"Pressure baseline loaded: {baseline.value:.1f}")
+    DATA_TOTAL_MIN = baseline.threshold
 
     print(f"Presurre total data min: {DATA_TOTAL_MIN}\n")
 
+    # 圧力を高い周期で読み続け、閾値を超えたら知らせるスレッド
+    # 押していない間の値で基準値を更新し、閾値もそれに合わせて動かす
+    trigger = PressureTrigger(pad, DATA_TOTAL_MIN, baseline=baseline)
+    trigger.start()
+
+    # 音楽を起動時にデコードしておき、ミキサーから鳴らす
+    audio = Audio(BandTable.evenly_spaced(interval=DATA_TOTAL_INTERVAL), enabled=not hw.simulated)
+    audio.start()
+
     # LED setting
-    strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
+    strip = hw.PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
     strip.begin()
+    # 全エフェクトをまとめて描画するスレッド
+    compositor = render.Compositor(strip, panel_map)
+    compositor.start()
     # 初期設定終了
 
     clear_screen()
+    # 円のオフセット表を先に作っておく
+    render.warm_ring_cache(render.RING_CACHE_SIZE - 1)
 
     pressed_time = 0
     released_time = 0
 
-    cb = pi.callback(BUTTON_PIN, pigpio.EITHER_EDGE, button_callback)
+    cb = pi.callback(BUTTON_PIN, hal.EITHER_EDGE, button_callback)
 
     master_connection = MasterConnection(MASTER_IP, MASTER_PORT, SLAVE_ROWS, SLAVE_COLS)
 
@@ -761,6 +753,10 @@ if __name__ == '__main__':
         master_connection.stop_connection()
         # コールバックを解除して終了
         cb.cancel()
+        trigger.stop()
+        audio.stop()
+        # 裏の走査を止めてからサーボ(pigpio)を止める
+        background_scanner.stop()
         pi.stop()
         # 圧力センサに関するものを閉じる
         spi.close()
@@ -768,6 +764,17 @@ if __name__ == '__main__':
         tof.stop_ranging()
         # Clear on exit
         clear_screen()
-
+        # LEDに送ったフレーム数と省略したフレーム数
+        print(f"> LED frames: {compositor.stats()}")
+        # 鳴らした音の数と鳴り始めるまでの時間
+        print(f"> Audio: {audio.stats()}")
+        # 位置特定にかかった時間(最後の1回の内訳)と、裏の走査のキャッシュを使えた回数
+        print(f"> Scan: {scanner.latency_stats()} last: {scanner.last_report}")
+        print(f"> Scan cache: {background_scanner.stats()}")
+        # マルチキャストで受け取った数と、抜けて再送を頼んだもの
+        print(f"> Multicast: {master_connection.multicast_stats()}")
+
+        # 残っているログを書き出す
+        log.shutdown()
         # システム終了
         sys.exit(0)
@@ -1,49 +1,75 @@
-import RPi.GPIO as GPIO
-import pigpio  # GPIO制御
 import socket
-import json
-import VL53L0X  # ToFセンサ
-from rpi_ws281x import PixelStrip, Color
+import logging
 import random
-import time
 import math  # 極座標変換
 import threading
-from typing import Dict, Tuple
 import sys
-import spidev # 圧力センサ
-import subprocess # 音声
 import os
 
 import datetime
 
+import hal  # ハードウェア(実機かシミュレーション)
+import log  # 出力を止めないログ
+import protocol  # 通信のメッセージ層
+import clock_sync  # スレーブとの時計合わせ
+import discovery  # スレーブにマスターの場所を知らせる
+import heartbeat  # 接続が生きているかの確認
+from audio import Audio, BandTable
+from pressure import BASELINE_PATH, Baseline, PressurePad, PressureTrigger, to_volts
+import render  # 描画の共通処理
+from panel_map import PanelMap, PanelRegistry, SERPENTINE
+from tof_scan import TofScanner, BackgroundScanner
+from aio_server import AsyncMultiClientServer, panel_geometry
+from client_registry import ClientRegistry
+from multicast import MulticastSender
+
+
+logger = log.get_logger("master")
+# ループの中の細かいログ(TRACE_LOGがFalseなら出さない)
+trace = log.get_trace_logger("master")
+
+# 実機のライブラリかシミュレーション(環境変数 HAL=sim)か
+hw = hal.open_hardware()
 
 # SPIバスを開く
 # 圧力
-spi = spidev.SpiDev()
+spi = hw.SpiDev()
 spi.open(1, 0)
 spi.max_speed_hz = 1000000
+# 圧力の読み取り周期(Hz)と、1回の読み取りで平均する回数
+PRESSURE_SAMPLE_RATE = 200
+PRESSURE_OVERSAMPLE = 4
+# 4チャンネルを1回のSPI転送でまとめて読む
+pad = PressurePad(spi, sample_rate=PRESSURE_SAMPLE_RATE, oversample=PRESSURE_OVERSAMPLE)
 
 # pigpioデーモンに接続し、piオブジェクトを作成
-pi = pigpio.pi()
+pi = hw.pi()
 
 # SG90のピン設定
 SERVO_PIN = 23  # SG90
-pi.set_mode(SERVO_PIN, pigpio.OUTPUT)
+pi.set_mode(SERVO_PIN, hal.OUTPUT)
 
 # ボタンのGPIO設定
 BUTTON_PIN = 3
-pi.set_mode(BUTTON_PIN, pigpio.INPUT)
+pi.set_mode(BUTTON_PIN, hal.INPUT)
 # チャタリングを防ぐためデバウンスを50msに
 pi.set_glitch_filter(BUTTON_PIN, 50000)
 
 # Create a VL53L0X object
-tof = VL53L0X.VL53L0X()
+tof = hw.ToF()
 
 # 音楽の切り替えの間の値
 DATA_TOTAL_INTERVAL = 300
 
 # 周期ごとの度数
 DEGREE_CYCLE = 1
+# Trueなら荒い走査で物体の範囲を見つけてからその範囲だけ細かく走査する
+FAST_SWEEP = True
+# Trueなら裏でずっと走査して物体の位置をキャッシュしておく
+BACKGROUND_SCAN = True
+# キャッシュの位置を使ってよい古さ(秒)。これより古ければ走査し直す
+# Noneなら測った走査1回の時間から決める(find_pos_fastの1回は実機で1.6秒ほどなので、固定するならそれより長く)
+SCAN_MAX_AGE = None
 # ディスプレイの大きさ(mm)
 DISPLAY_X = 160
 DISPLAY_Y = 160
@@ -62,7 +88,6 @@ MATRIX_WIDTH = 16
 MATRIX_HEIGHT = 16
 
 # LED configuration
-LED_COUNT = 256
 LED_PIN = 10
 LED_FREQ_HZ = 800000
 LED_DMA = 10
@@ -76,17 +101,39 @@ MATRIX_ROWS = 1  # 横方向
 MATRIX_COLS = 1  # 縦方向
 MATRIX_GLOBAL_WIDTH = MATRIX_ROWS * LED_PER_PANEL
 MATRIX_GLOBAL_HEIGHT = MATRIX_COLS * LED_PER_PANEL
+# パネルの配線と取り付け向き
+PANEL_WIRING = SERPENTINE
+PANEL_ROTATION = 0
+# 座標 -> LEDのインデックスの表 (複数パネルを1本のテープにつないでもよい)
+panel_map = PanelMap(LED_PER_PANEL, LED_PER_PANEL, MATRIX_ROWS, MATRIX_COLS,
+                     wiring=PANEL_WIRING, rotation=PANEL_ROTATION)
+LED_COUNT = panel_map.led_count
 
 # 円の幅
 CIRCLE_WIDTH = 7
 
 # 通信設定
-PORT = 5000
+# 環境変数MASTER_PORTで変えられる(1台のPCでマスターとスレーブを動かすベンチマーク用)
+PORT = int(os.environ.get("MASTER_PORT", 5000))
+# draw/sensor_dataを固定長バイナリで送るか(FalseならJSON)
+BINARY_PROTOCOL = True
+# ログのレベル。DEBUGにしても細かいログ(1角度・1メッセージごと)はTRACE_LOGがTrueのときだけ出る
+LOG_LEVEL = logging.INFO
+TRACE_LOG = False
+# Trueならasyncio版のサーバー(スレーブごとのスレッドを立てない)を使う
+ASYNC_SERVER = True
+# Trueならdraw/multiendをUDPマルチキャストで1回だけ送る(スレーブが多い壁向け)
+# 環境変数MULTICAST_FANOUT=1でも有効にできる(ベンチマーク用)
+MULTICAST_FANOUT = os.environ.get("MULTICAST_FANOUT", "0") == "1"
 
 
 def quitting():
     # コールバックを解除して終了
     cb.cancel()
+    trigger.stop()
+    audio.stop()
+    # 裏の走査を止めてからサーボ(pigpio)を止める
+    background_scanner.stop()
     pi.stop()
     # 圧力センサに関するものを閉じる
     spi.close()
@@ -94,17 +141,37 @@ def quitting():
     tof.stop_ranging()
     # Clear on exit
     clear_screen()
+    # LEDに送ったフレーム数と省略したフレーム数
+    print(f"> LED frames: {compositor.stats()}")
+    # 鳴らした音の数と鳴り始めるまでの時間
+    print(f"> Audio: {audio.stats()}")
+    # 位置特定にかかった時間(最後の1回の内訳)と、裏の走査のキャッシュを使えた回数
+    print(f"> Scan: {scanner.latency_stats()} last: {scanner.last_report}")
+    print(f"> Scan cache: {background_scanner.stats()}")
+    if ASYNC_SERVER:
+        # 送信キューがあふれて捨てたメッセージ数
+        print(f"> Dropped messages: {server.dropped_messages()}")
     server.shutdown()
+    beacon.stop()
+    if multicast is not None:
+        print(f"> Multicast: {multicast.stats()}")
+        multicast.close()
+    # 残っているログを書き出す
+    log.shutdown()
     # システム終了
     print("This Raspberry Pi shutdown")
-    os.system("sudo shutdown -h now")
+    if not hw.simulated:
+        os.system("sudo shutdown -h now")
 
 class MultiClientServer:
-    def __init__(self, port: int = PORT):
+    def __init__(self, port: int = PORT, multicast=None):
         self.host = '0.0.0.0'
         self.port = port
+        self.multicast = multicast  # 描画コマンドをマルチキャストで送るときのMulticastSender
+        self.unicast_positions = frozenset()  # マルチキャストを受けられず、描画コマンドもTCPで送る位置
         self.server_socket: socket.socket = None  # サーバーソケットをインスタンス変数として保持
-        self.clients: Dict[Tuple[int, int], socket.socket] = {}  # {(row, column): socket}
+        self.clients = ClientRegistry()  # {(row, column): socket}。どのスレッドから触ってもよい。送信はclients.send()で
+        self.panels = PanelRegistry(LED_PER_PANEL, LED_PER_PANEL)  # 各スレーブの担当領域
 
     def start_server(self):
         global isSingleMode
@@ -112,7 +179,7 @@ class MultiClientServer:
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
-        print(f"> Master server listening on port {self.port}\n")
+        logger.info("Master server listening on port %d", self.port)
 
         try:
             while True:
@@ -120,11 +187,14 @@ class MultiClientServer:
 
                 # isSingleMode が True の場合、接続を拒否
                 if isSingleMode:
-                    print(f"> Connection attempt from {address} rejected (isSingleMode is True)")
+                    logger.info("Connection attempt from %s rejected (isSingleMode is True)", address)
                     client_socket.close()
                     continue
 
-                print(f"> New connection from {address}")
+                logger.info("New connection from %s", address)
+                # ハートビートが途絶えた(スレーブが落ちた)らrecvがタイムアウトして切る
+                heartbeat.set_keepalive(client_socket)
+                client_socket.settimeout(hal.clock.real(heartbeat.HEARTBEAT_TIMEOUT))
 
                 client_thread = threading.Thread(
                     target=self.handle_client,
@@ -133,101 +203,128 @@ class MultiClientServer:
                 client_thread.daemon = True
                 client_thread.start()
         except KeyboardInterrupt:
-            print("\n> Shutting down server...")
+            logger.info("Shutting down server...")
         finally:
             self.shutdown()
 
     def handle_client(self, client_socket: socket.socket):
         global isSingleMode
+        decoder = protocol.FrameDecoder()
         try:
             while isSingleMode == False:
-                data = client_socket.recv(1024)
+                data = client_socket.recv(4096)
                 if not data:
                     break
 
-                try:
-                    received_data = json.loads(data.decode())
-                    if received_data["type"] == "init":
+                # 1回のrecvに複数のメッセージが入っていることもある
+                received = hal.clock.monotonic()  # 時計合わせに使う受信時刻
+                for received_data in decoder.feed(data):
+                    if received_data["type"] == "heartbeat":
+                        # 同じものを返す(スレーブはこれでマスターが生きていると分かる)
+                        self.clients.send(client_socket, protocol.encode_message(heartbeat.heartbeat(), BINARY_PROTOCOL))
+
+                    elif received_data["type"] == "sync":
+                        # 受け取った時刻と返す時刻を入れてすぐ返す
+                        reply = clock_sync.sync_reply(received_data, received)
+                        self.clients.send(client_socket, protocol.encode_message(reply, BINARY_PROTOCOL))
+
+                    elif received_data["type"] == "init":
                         # クライアントの位置情報を登録
                         position = tuple(received_data["position"].values())  # (row, column)
-                        self.clients[position] = client_socket
-                        print(f"> Registered client at position: {position}")
+                        count = self.clients.register(position, client_socket)
+                        self.panels.register(position, *panel_geometry(received_data))
+                        logger.info("Registered client at position: %s", position)
+                        if count > 1:
+                            # 古い接続はハートビートが途絶えるか切れたときに外れる
+                            logger.info("Client at %s reconnected (%d sockets until the old one closes)",
+                                        position, count)
+                        if self.multicast is not None:
+                            # 描画コマンドの受け取り方を教える(参加できなければmulticast_failedが返ってくる)
+                            self.unicast_positions = self.unicast_positions - {position}
+                            self.clients.send(client_socket, protocol.encode_message(self.multicast.announcement(), BINARY_PROTOCOL))
+
+                    elif received_data["type"] == "nack":
+                        if self.multicast is not None:
+                            self.multicast.retransmit(received_data["seqs"])
+
+                    elif received_data["type"] == "multicast_failed":
+                        # このスレーブには描画コマンドもTCPで送る
+                        position = self.clients.position_of(client_socket)
+                        if position is not None:
+                            self.unicast_positions = self.unicast_positions | {position}
+                            logger.warning("Client at %s cannot receive multicast, sending draw over TCP", position)
 
                     elif received_data["type"] == "sensor_data":
                         x = received_data["x"]
                         y = received_data["y"]
                         data_total = received_data["data_total"]
-                        print("> multi_animation start")
+                        logger.info("multi_animation start")
                         multi_animation(self, x, y, data_total)
-
-                except json.JSONDecodeError:
-                    print("> Failed to decode data from client")
         except Exception as e:
-            print(f"> Error handling client: {e}")
+            logger.warning("Error handling client: %s", e)
         finally:
             self.remove_client(client_socket)
 
     def send_to_position(self, row: int, column: int, data: dict):
         """特定の位置にデータを送信"""
         position = (row, column)
-        if position in self.clients:
+        client_socket = self.clients.get(position)
+        if client_socket is not None:
             try:
-                self.clients[position].send(json.dumps(data).encode())
-                print(f"> Sent to {position}: {data}")
+                self.clients.send(client_socket, protocol.encode_message(data, BINARY_PROTOCOL))
+                trace.debug("Sent to %s: %s", position, data)
             except Exception as e:
-                print(f"> Failed to send to {position}: {e}")
+                logger.warning("Failed to send to %s: %s", position, e)
         else:
-            print(f"> No client at position {position}")
+            logger.warning("No client at position %s", position)
 
     def broadcast(self, data: dict):
         """すべてのクライアントにデータをブロードキャスト"""
-        for position, client_socket in list(self.clients.items()):
+        # エンコードは1回だけ
+        message = protocol.encode_message(data, BINARY_PROTOCOL)
+        # 表はコピーオンライトなので、ロックもコピーもなしで回せる
+        for position, client_socket in self.clients.snapshot().items():
             try:
-                client_socket.send(json.dumps(data).encode())
-                print(f"> Broadcasted to {position}: {data}")
+                self.clients.send(client_socket, message)
+                trace.debug("Broadcasted to %s: %s", position, data)
             except Exception as e:
-                print(f"> Failed to broadcast to {position}: {e}")
+                logger.warning("Failed to broadcast to %s: %s", position, e)
+
+    def broadcast_to(self, positions, data: dict):
+        """positionsのクライアントだけにデータを送信"""
+        message = protocol.encode_message(data, BINARY_PROTOCOL)
+        targets = self.clients.snapshot()
+        for position in positions:
+            client_socket = targets.get(position)
+            if client_socket is None:
+                continue
+            try:
+                self.clients.send(client_socket, message)
+                trace.debug("Sent to %s: %s", position, data)
+            except Exception as e:
+                logger.warning("Failed to send to %s: %s", position, e)
 
     def remove_client(self, client_socket: socket.socket):
-        """クライアントを削除"""
-        for position, socket in list(self.clients.items()):
-            if socket == client_socket:
-                del self.clients[position]
-                print(f"> Removed client at position: {position}")
-                break
+        """クライアントを削除(逆引きするので全位置をなめない)"""
+        position, remaining = self.clients.remove(client_socket)
+        if position is None:
+            return
+        # つなぎ直しの途中なら新しい接続が残っているので、担当領域は消さない
+        if not remaining:
+            self.panels.remove(position)
+            self.unicast_positions = self.unicast_positions - {position}
+        logger.info("Removed client at position: %s", position)
 
     def shutdown(self):
         """すべてのクライアントとサーバーソケットを閉じる"""
-        for client_socket in self.clients.values():
+        for client_socket in self.clients.sockets():
             client_socket.close()
         if self.server_socket:
             self.server_socket.close()
-            print("> Server shutdown complete")
-
-
-# 圧力読み取りにつかう関数
-# MCP3008から値を読み取るメソッド
-# チャンネル番号は0から7まで
-def ReadChannel(channel):
-    adc = spi.xfer2([1, (8 + channel) << 4, 0])
-    data = ((adc[1] & 3) << 8) + adc[2]
-    return data
-
-
-# 得た値を電圧に変換するメソッド
-# 指定した桁数で切り捨てる
-def ConvertVolts(data, places):
-    volts = (data * 5) / float(1023)
-    volts = round(volts, places)
-    return volts
+            logger.info("Server shutdown complete")
 
 
 # 位置特定につかう関数
-# 変数の初期化
-def valInit():
-    valInit.SvDeg = 0  # サーボモータの現在角度
-
-
 # サーボモータを特定の角度に設定する関数
 def set_angle(angle):
     assert 0 <= angle <= 180, '角度は0から180の間でなければなりません'
@@ -255,6 +352,13 @@ def calculateGap(degree):
     return X_GAP, Y_GAP
 
 
+# 極座標(角度, 距離)からずれを補正した筐体の座標(x, y)へ
+def to_point(degree, distance):
+    x, y = getXY(distance, degree)
+    X_GAP, Y_GAP = calculateGap(degree)
+    return x - X_GAP, y - Y_GAP
+
+
 # 範囲内か識別
 def isRange(x, y):
     if x > DISPLAY_X or y > DISPLAY_Y:  # ディスプレイの大きさ外なら
@@ -263,206 +367,66 @@ def isRange(x, y):
         return False
     return True
 
-# 位置特定
-def find_pos(timing):
-    # 極座標の特定(角度, 距離)
-    # 極座標変換(x, y)および範囲内かどうか
-    # 範囲内の最初と最後のx,yを配列に入れる
-    # 配列から範囲内に最初になった座標と最後に範囲内になった座標の中心(物体の中心座標)を返す
-
-    # サーボを0度に設定
-    valInit.SvDeg = 0
-    set_angle(valInit.SvDeg)
-
-    #print(timing)
-    time.sleep(0.1)
-
-    # 配列の初期化
-    pointlist = []
-
-    flag = False
-
-    count = 0
-
-    for i in range(0, 91, DEGREE_CYCLE):  # 0~90度で増加量はDEGREE_CYCLE
-        valInit.SvDeg = i
-        set_angle(valInit.SvDeg)  # サーボを回転
-        #print(valInit.SvDeg)
-        
-        # ToFセンサで測距
-        distance = tof.get_distance()
-        # ToFセンサの誤差を引いて正確な値にする
-        distance -= DISTANCE_ERROR
-        if (distance > 0):
-            # 角度と距離の表示
-            print("angle: %d \t distance: %d mm" % (valInit.SvDeg, distance))
-
-            # 極座標変換 (半径,角度)から(x,y)
-            x, y = getXY(distance, valInit.SvDeg)
-            X_GAP, Y_GAP = calculateGap(valInit.SvDeg)
-            x -= X_GAP  # x座標のずれを減らす
-            y -= Y_GAP  # y座標のずれを減らす
-            print("pos:x %d, y %d \t GAP:x %d, y %d" % (x, y, X_GAP, Y_GAP))
-            if not flag:  # flagがFalseのとき
-                if isRange(x, y):  # 範囲内なら
-                    print("isrange true")
-                    count += 1
-                else:
-                    print("isrange false")
-                    count = 0
-                if count == 5:  # 5度連続で範囲内ならflagをtrueに
-                    flag = True
-            else:  # flagがTrueのとき
-                pointlist.append([x, y])
-                print(pointlist[-1])
-                if not isRange(x, y):  # 範囲外なら
-                    print("isrange false")
-                    count += 1
-                else:
-                    print("isrange true")
-                    count = 0
-                if count == 5:  # 5度連続で範囲外ならforをぬける
-                    break
-        time.sleep(timing / 1000000.00)
-
-
-    # 余分に記録した末尾5個のリストを削除
-    del pointlist[-5:]
-    # print(pointlist)
+# 1回分の走査
+# FAST_SWEEPなら荒い走査→細かい走査、そうでなければ0~90度をDEGREE_CYCLEずつ走査
+# 走査の向きはサーボが今いる端から(0→90度、90→0度を交互に)
+def sweep_once():
+    if FAST_SWEEP:
+        return scanner.find_pos_fast()
+    return scanner.find_pos()
 
-    # もしリストが入ってなかったら
-    if len(pointlist) == 0:
-        return -1, -1
-
-    # リストの中央値(物体の中心座標)を求める
-    mid = len(pointlist) // 2
-    res_x = pointlist[mid][0]
-    res_y = pointlist[mid][1]
-
-    return res_x, res_y
+# 物体の位置特定
+# BACKGROUND_SCANなら裏で走査した位置を使う(古ければ走査し直す)
+def locate_object():
+    if BACKGROUND_SCAN:
+        return background_scanner.get_position()
+    return sweep_once()
 
 
 # LEDマトリックスに関する関数
-# 奇数列の反転
-def zigzag_transform(x, y):
-    if y % 2 == 1:  # Zigzag for odd rows
-        x = LED_PER_PANEL - 1 - x
-    return x, y
-
 # この筐体のLEDマトリックスを消灯
 def clear_screen():
-    for i in range(LED_COUNT):
-        strip.setPixelColor(i, Color(0, 0, 0))
-    strip.show()
+    compositor.clear()
 
 # 単体機能でつかう関数
 # Update positions of multiple points simultaneously
 # ターゲットポジションにたどり着くまで乱数で生成した位置から光をターゲットポジションに移動させる
-def update_positions(points, target_x, target_y, strip, speed):
-    while points:
-        print("light gathering...")
-        # Update each point's position
-        # それぞれのポイントの座標更新
-        for point in points[:]:
-            x, y, color = point
-            # Clear current position
-            zigzag_x, zigzag_y = zigzag_transform(x, y)
-            index = zigzag_y * LED_PER_PANEL + zigzag_x
-            strip.setPixelColor(index, Color(0, 0, 0))
-
-            # Calculate direction to target
-            dx = target_x - x
-            dy = target_y - y
-
-            #print("%d dx: %d dy: %d" % (points.index(point), dx, dy))
-            # ターゲットポジションにたどり着いたら
-            if abs(dx) < 1 and abs(dy) < 1:
-                # ポイントの削除
-                points.remove(point)
-            # ターゲットポジションにたどり着いてなかったら
-            else:
-                # 座標更新
-                if abs(dx) > abs(dy):
-                    x += 1 if dx > 0 else -1
-                else:
-                    y += 1 if dy > 0 else -1
-                zigzag_x, zigzag_y = zigzag_transform(x, y)
-                index = zigzag_y * LED_PER_PANEL + zigzag_x
-                # Draw new position
-                strip.setPixelColor(index, color)
-                # Update the point in the list
-                points[points.index(point)] = (x, y, color)
-
-        # Show updated positions
-        strip.show()
-        time.sleep(speed)
+def update_positions(points, target_x, target_y):
+    # 描画はcompositorが1フレームずつ進める。全部の点がたどり着くまで待つ
+    gathering = render.Gathering(points, target_x, target_y)
+    compositor.add_layer(gathering)
+    gathering.wait()
 
 # 複数機能につかう関数
 # 円の配列の作成
 def circle_pixels(xc, yc, radius):
     """Generate circle pixels for a given center and radius."""
-    x, y = 0, radius
-    d = 1 - radius
-    pixels = []
-
-    while x <= y:
-
-        for dx, dy in [(x, y), (y, x), (-x, y), (-y, x), (x, -y), (y, -x), (-x, -y), (-y, -x)]:
-            if 0 <= xc + dx < MATRIX_GLOBAL_WIDTH and 0 <= yc + dy < MATRIX_GLOBAL_HEIGHT:
-                pixels.append((xc + dx, yc + dy))
-        if d < 0:
-            d += 2 * x + 3
-        else:
-            d += 2 * (x - y) + 5
-            y -= 1
-        x += 1
-    return pixels
-
-# マスターの描画
-def draw_frame(frame_pixels, color):
-    # Draw a single frame of animation.
-    # この筐体の範囲内のものだけにする
-    master_pixels = [p for p in frame_pixels if p[0] < LED_PER_PANEL and p[1] < LED_PER_PANEL]
-
-    # Draw master pixels
-    for x, y in master_pixels:
-        zigzag_x, zigzag_y = zigzag_transform(x, y)
-        index = zigzag_y * LED_PER_PANEL + zigzag_x
-        strip.setPixelColor(index, Color(color[0], color[1], color[2]))
-        #print(datetime.datetime.now())
-    strip.show()
-
-    # print(f"Master: {master_pixels}")
-
+    return render.ring_pixels(xc, yc, radius, 0, 0, MATRIX_GLOBAL_WIDTH, MATRIX_GLOBAL_HEIGHT)
 
 # 円の描画
-def animate_circles(xc, yc, colors, max_radius):
-    radius = 0
-    clear_radius = 0
-    
-    # 円の描画
-    while True:
-        if clear_radius == max_radius:
-            break
-        #print("Draw Circle :radius = %d,\t Clear Circle :radius = %d" % (radius, clear_radius))
-        if radius < max_radius:
-            circle = circle_pixels(xc, yc, radius)
-            color = colors[radius % CIRCLE_WIDTH]
-
-            draw_frame(circle, color)
-            
-            radius += 1
-        
-        # 描画している円の幅がCIRCLE_WIDTH以上になったら真ん中から消していく
-        if radius > CIRCLE_WIDTH:
-            clear_circle = circle_pixels(xc,yc,clear_radius)
-            # 描画を消す
-            draw_frame(clear_circle,[0,0,0])
-            clear_radius += 1
-        time.sleep(0.1)
+# 1フレームずつの描画はcompositorがやるので、レイヤーを登録したらすぐ戻る
+def animate_circles(xc, yc, colors, max_radius, start_at=None):
+    compositor.add_layer(render.Ripple(xc, yc, colors, max_radius, CIRCLE_WIDTH, start_at=start_at))
+
+# スレーブへの描画コマンドの送信
+# マルチキャストなら全員に1回送るだけ(positionsで絞らなくてもスレーブが自分の領域の外は描かない)
+# マルチキャストに参加できなかったスレーブにはTCPでも送る
+def send_command(server, command, positions=None):
+    if multicast is not None:
+        multicast.send(command)
+        fallback = server.unicast_positions
+        if positions is not None:
+            fallback = fallback.intersection(positions)
+        if fallback:
+            server.broadcast_to(fallback, command)
+    elif positions is None:
+        server.broadcast(command)
+    else:
+        server.broadcast_to(positions, command)
 
 # x,y座標、最大半径をブロードキャスト、マスターの描画
 def multi_animation(server, x, y, data_total):
+    hal.mark("sensor_received")
     colors = []
     # 圧力値をもとに最大半径を決める
     max_radius = int(data_total / 5)
@@ -473,20 +437,24 @@ def multi_animation(server, x, y, data_total):
             
     #x, y = random.randint(0, MATRIX_WIDTH - 1), random.randint(0, MATRIX_HEIGHT - 1)
     #x, y = random.randint(0, MATRIX_GLOBAL_WIDTH - 1), random.randint(0, MATRIX_GLOBAL_HEIGHT - 1)
-    print("x:%d, y:%d. max_radius:%d" % (x, y, max_radius))
+    logger.info("x:%d, y:%d. max_radius:%d", x, y, max_radius)
 
     for i in range(CIRCLE_WIDTH):
         color = [random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)]
         colors.append(color)
 
-    # スレーブに送信
-    command = {"type": "draw", "x": x, "y": y, "colors": colors, "max_radius": max_radius}
-    server.broadcast(command)
+    # 全スレーブに届く頃のフレームの区切りから、全パネルが同時に描き始める
+    start_at = clock_sync.next_frame_time(render.FRAME_INTERVAL)
+    # 波紋が届くスレーブにだけ送信
+    command = {"type": "draw", "x": x, "y": y, "colors": colors, "max_radius": max_radius,
+               "start_at": start_at}
+    targets = server.panels.reaching(x, y, max_radius)
+    # 送り始めの時刻(マルチキャストは送り終わる前にスレーブに届くことがある)
+    hal.mark("broadcast", targets=len(targets))
+    send_command(server, command, targets)
 
-    # 円描画のスレッドを作成 argsはanimate_circlesの引数 x,y 受け取ったら
-    animation_thread = threading.Thread(target=animate_circles, args=(x,y,colors,max_radius,))
-    animation_thread.daemon = True # メインが終われば終わる
-    animation_thread.start()
+    # 円描画のレイヤーを追加
+    animate_circles(x, y, colors, max_radius, start_at)
 
 
 # 単体機能メイン
@@ -502,39 +470,24 @@ def single_function():
                 clear_screen()
                 return
             
-            # 圧力の合計データの初期化
-            data_total = 0
-            # ４箇所の圧力を測定
-            for i in range(4):
-                # センサのチャンネルの切り替え
-                data = ReadChannel(i)
-                data_total += data
-                print("channel: %d" % (i))
-                print("A/D Converter: {0}".format(data))
-                volts = ConvertVolts(data,3)
-                print("Volts: {0}".format(volts))
-            # ４つの圧力の合計値(通信する変数1:data_total)
-            print("Data total: {0}\n".format(data_total))
-            #data_total = 2000 # デバック用圧力合計値
-            # 一定以下の圧力になったら抜ける
-            if data_total >= DATA_TOTAL_MIN:
-                if DATA_TOTAL_MIN <= data_total < DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL:
-                    MP3_PATH = 'music1.mp3'
-                elif DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2):
-                    MP3_PATH = 'music2.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2) <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3):
-                    MP3_PATH = 'music3.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3) <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4):
-                    MP3_PATH = 'music4.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4) <= data_total:
-                    MP3_PATH = 'music5.mp3'
+            # 閾値を超えた瞬間に戻る(超えなければ0.1秒ごとにモードの切り替えを確認)
+            press = trigger.wait_press(timeout=0.1)
+            if press is not None:
                 break
-            time.sleep(0.5)
 
-                
         # ToFセンサとサーボで物体の位置特定
-        print("find position of object")
-        target_x, target_y = find_pos(timing)
+        logger.info("find position of object")
+        target_x, target_y = locate_object()
+
+        # 押している間の圧力の最大値(位置特定の間に集め終わっている)
+        # ４つの圧力の合計値(通信する変数1:data_total)
+        data_total = press.wait_peak()
+        # 押したときの閾値(基準値に合わせて動く)を音楽の区切りの基準にする
+        data_total_min = press.threshold
+        #data_total = 2000 # デバック用圧力合計値
+        logger.info("Data total: %d", data_total)
+        # 閾値からの圧力の大きさで鳴らす曲を選ぶ
+        music = audio.select(data_total - data_total_min)
         if target_x < 0 or target_y < 0:
             continue
         #print("\n x:%d mm \t y:%d mm\n" % (target_x, target_y))
@@ -545,28 +498,26 @@ def single_function():
 
         #target_x, target_y = MATRIX_WIDTH / 2, MATRIX_HEIGHT / 2
         target_x, target_y = int(target_x), int(target_y)
-        print(f"Target position: ({target_x}, {target_y})")
+        logger.info("Target position: (%d, %d)", target_x, target_y)
 
         # LEDマトリックス
         # Generate multiple random starting points and their colors
         points = []
         # 圧力の値から生成する点の数を設定
         generated_points = int((10000 - data_total) / 700)
-        print("generated points: %d\n" % (generated_points))
+        logger.info("generated points: %d", generated_points)
         for _ in range(generated_points):  # Number of points
-            x = random.randint(0, MATRIX_WIDTH - 1)
-            y = random.randint(0, MATRIX_HEIGHT - 1)
-            color = Color(random.randint(50, 255), random.randint(50, 255), random.randint(50, 255))
+            x = random.randint(0, panel_map.width - 1)
+            y = random.randint(0, panel_map.height - 1)
+            color = hw.Color(random.randint(50, 255), random.randint(50, 255), random.randint(50, 255))
             points.append((x, y, color))
 
-        print()
-        subprocess.Popen(['mpg321', MP3_PATH])
-        print()
+        audio.play(music)
 
         # Move all points toward the target simultaneously
-        print("update position start")
-        update_positions(points, target_x, target_y, strip, speed=0.1)
-        print("update position end\n")
+        trace.debug("update position start")
+        update_positions(points, target_x, target_y)
+        trace.debug("update position end")
 
         # Clear the matrix
         clear_screen()
@@ -588,39 +539,24 @@ def multi_function(server):
                 clear_screen()
                 return
 
-            # 圧力の合計データの初期化
-            data_total = 0
-            # ４箇所の圧力を測定
-            for i in range(4):
-                # センサのチャンネルの切り替え
-                data = ReadChannel(i)
-                data_total += data
-                print("channel: %d" % (i))
-                print("A/D Converter: {0}".format(data))
-                volts = ConvertVolts(data,3)
-                print("Volts: {0}".format(volts))
-            # ４つの圧力の合計値(通信する変数1:data_total)
-            print("Data total: {0}\n".format(data_total))
-            #data_total = 2500 # デバック用圧力合計値
-            # 一定以下の圧力になったら抜ける
-            if data_total >= DATA_TOTAL_MIN:
-                if DATA_TOTAL_MIN <= data_total < DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL:
-                    MP3_PATH = 'music1.mp3'
-                elif DATA_TOTAL_MIN + DATA_TOTAL_INTERVAL <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2):
-                    MP3_PATH = 'music2.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 2) <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3):
-                    MP3_PATH = 'music3.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 3) <= data_total < DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4):
-                    MP3_PATH = 'music4.mp3'
-                elif DATA_TOTAL_MIN + (DATA_TOTAL_INTERVAL * 4) <= data_total:
-                    MP3_PATH = 'music5.mp3'
+            # 閾値を超えた瞬間に戻る(超えなければ0.1秒ごとにモードの切り替えを確認)
+            press = trigger.wait_press(timeout=0.1)
+            if press is not None:
                 break
-            time.sleep(0.5)
-            
-                
+
         # ToFセンサとサーボで物体の位置特定
-        print("find position of object")
-        target_x, target_y = find_pos(timing)
+        logger.info("find position of object")
+        target_x, target_y = locate_object()
+
+        # 押している間の圧力の最大値(位置特定の間に集め終わっている)
+        # ４つの圧力の合計値(通信する変数1:data_total)
+        data_total = press.wait_peak()
+        # 押したときの閾値(基準値に合わせて動く)を音楽の区切りの基準にする
+        data_total_min = press.threshold
+        #data_total = 2500 # デバック用圧力合計値
+        logger.info("Data total: %d", data_total)
+        # 閾値からの圧力の大きさで鳴らす曲を選ぶ
+        music = audio.select(data_total - data_total_min)
         if target_x < 0 or target_y < 0:
             continue
         #print("\n x:%d mm \t y:%d mm\n" % (target_x, target_y))
@@ -631,13 +567,11 @@ def multi_function(server):
  
         #target_x, target_y = MATRIX_WIDTH / 2, MATRIX_HEIGHT / 2 # デバック用
         target_x, target_y = int(target_x), int(target_y)
-        print(f"Target position: ({target_x}, {target_y})")
+        logger.info("Target position: (%d, %d)", target_x, target_y)
 
-        print()
-        subprocess.Popen(['mpg321', MP3_PATH])
-        print()
+        audio.play(music)
         
-        multi_animation(server, target_x, target_y, data_total-DATA_TOTAL_MIN)
+        multi_animation(server, target_x, target_y, data_total-data_total_min)
         #time.sleep(5) # デバッグ用
 
         
@@ -650,11 +584,11 @@ def button_callback(gpio, level, tick):
     #print(f"Button pressed! GPIO: {gpio}, Level: {level}, Tick: {tick}")
 
     if level == 0:  # ボタンが押されたとき  # ボタンが押されたとき
-        pressed_time = time.time()  # ボタンが押された時間を記録
+        pressed_time = tick  # ボタンが押された時間を記録(us)
 
     elif level == 1:
-        released_time = time.time()
-        press_duration = released_time - pressed_time  # 押していた時間を記録
+        released_time = tick
+        press_duration = hal.tick_diff(pressed_time, released_time) / 1000000  # 押していた時間を記録
         print(f"#####Button press duration: {press_duration:.2f} second#####")
 
         if press_duration >= 5:
@@ -670,64 +604,98 @@ def button_callback(gpio, level, tick):
             # 単体機能に切り替え
             else:
                 command = {"type": "multiend"}
-                server.broadcast(command)
+                send_command(server, command)
+                if multicast is not None:
+                    # 最後のデータグラムが抜けても次がないので気づけない。終わりはTCPでも送る
+                    server.broadcast(command)
                 isSingleMode = True
                 print(f"isSingleMode = {isSingleMode}\n")   
 
 if __name__ == '__main__':
+    # ログはキューに積んで別スレッドで書き出す
+    log.setup(LOG_LEVEL, trace=TRACE_LOG)
     isSingleMode = True
     
      # 初期設定
-    valInit()  # 変数の初期化
-
     # ToF起動
-    tof.start_ranging(VL53L0X.VL53L0X_BETTER_ACCURACY_MODE)
-
-    timing = tof.get_timing()
-    if (timing < 20000):
-        timing = 20000
+    # 荒い走査は高速モード、細かい走査は精度の高いモードで測る
+    # シミュレーションのToFは物体までの距離をこの変換から逆算する
+    hw.set_geometry(to_point)
+    scanner = TofScanner(tof, set_angle, to_point, isRange,
+                         hal.HIGH_SPEED_MODE, hal.BETTER_ACCURACY_MODE,
+                         distance_error=DISTANCE_ERROR, degree_cycle=DEGREE_CYCLE)
+    timing = scanner.set_mode(hal.BETTER_ACCURACY_MODE)
     print("Timing %d ms" % (timing / 1000))
 
+    # 裏で物体の位置を探し続けるスレッド
+    background_scanner = BackgroundScanner(sweep_once, max_age=SCAN_MAX_AGE)
+    if BACKGROUND_SCAN:
+        background_scanner.start()
+
     print()
 
-    # 圧力の合計データの初期化
-    data_total = 0
-    # ４箇所の圧力を測定
+    # ４箇所の圧力をまとめて測定
+    data = pad.read()
     for i in range(4):
-        # センサのチャンネルの切り替え
-        data = ReadChannel(i)
-        data_total += data
-        print("channel: %d" % (i))
-        print("A/D Converter: {0}".format(data))
-        volts = ConvertVolts(data,3)
-        print("Volts: {0}".format(volts))
+        print("channel: %d\tA/D Converter: %d\tVolts: %.3f" % (i, data[i], to_volts(data[i])))
     # ４つの圧力の合計値(通信する変数1:data_total)
+    data_total = sum(data)
     print("Data total: {0}\n".format(data_total))
     
-    # 圧力の最小値を最初の圧力ちをもとに設定
-    DATA_TOTAL_MIN = data_total + 50
+    # 圧力の最小値を前回保存した基準値(なければ最初の圧力値)をもとに設定
+    # シミュレーションのときは実機の基準値を読み書きしない
+    baseline = Baseline(path=None if hw.simulated else BASELINE_PATH)
+    if baseline.start(data_total):
+        print(f"Pressure baseline loaded: {baseline.value:.1f}")
+    DATA_TOTAL_MIN = baseline.threshold
 
     print(f"Presurre total data min: {DATA_TOTAL_MIN}\n")
 
+    # 圧力を高い周期で読み続け、閾値を超えたら知らせるスレッド
+    # 押していない間の値で基準値を更新し、閾値もそれに合わせて動かす
+    trigger = PressureTrigger(pad, DATA_TOTAL_MIN, baseline=baseline)
+    trigger.start()
+
+    # 音楽を起動時にデコードしておき、ミキサーから鳴らす
+    audio = Audio(BandTable.evenly_spaced(interval=DATA_TOTAL_INTERVAL), enabled=not hw.simulated)
+    audio.start()
+
 
     # LED setting
-    strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
+    strip = hw.PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
     strip.begin()
+    # 全エフェクトをまとめて描画するスレッド
+    compositor = render.Compositor(strip, panel_map)
+    compositor.start()
     # 初期設定終了
     
     clear_screen()
+    # 円のオフセット表を先に作っておく
+    render.warm_ring_cache(render.RING_CACHE_SIZE - 1)
 
     pressed_time = 0
     released_time = 0
 
     # ボタンのコールバックを設定
-    cb = pi.callback(BUTTON_PIN, pigpio.EITHER_EDGE, button_callback)
-
-    server = MultiClientServer()
+    cb = pi.callback(BUTTON_PIN, hal.EITHER_EDGE, button_callback)
+
+    # 描画コマンドのマルチキャスト(使わなければNone)
+    multicast = MulticastSender(binary=BINARY_PROTOCOL) if MULTICAST_FANOUT else None
+    if ASYNC_SERVER:
+        server = AsyncMultiClientServer(PORT, multi_animation,
+                                        is_active=lambda: not isSingleMode,
+                                        binary=BINARY_PROTOCOL,
+                                        panel_size=(LED_PER_PANEL, LED_PER_PANEL),
+                                        multicast=multicast)
+    else:
+        server = MultiClientServer(multicast=multicast)
     # サーバーのスレッドを立ち上げてサーバーをつくる
     server_thread = threading.Thread(target=server.start_server)
     server_thread.daemon = True # メインが終われば終わる
     server_thread.start()
+    # スレーブが見つけられるように、つないでよい間(複数機能中)はそう知らせる
+    beacon = discovery.Beacon(PORT, is_active=lambda: not isSingleMode)
+    beacon.start()
     
     try:
         while True:
@@ -746,6 +714,10 @@ if __name__ == '__main__':
     finally:
         # コールバックを解除して終了
         cb.cancel()
+        trigger.stop()
+        audio.stop()
+        # 裏の走査を止めてからサーボ(pigpio)を止める
+        background_scanner.stop()
         pi.stop()
         # 圧力センサに関するものを閉じる
         spi.close()
@@ -753,6 +725,22 @@ if __name__ == '__main__':
         tof.stop_ranging()
         # Clear on exit
         clear_screen()
+        # LEDに送ったフレーム数と省略したフレーム数
+        print(f"> LED frames: {compositor.stats()}")
+        # 鳴らした音の数と鳴り始めるまでの時間
+        print(f"> Audio: {audio.stats()}")
+        # 位置特定にかかった時間(最後の1回の内訳)と、裏の走査のキャッシュを使えた回数
+        print(f"> Scan: {scanner.latency_stats()} last: {scanner.last_report}")
+        print(f"> Scan cache: {background_scanner.stats()}")
+        if ASYNC_SERVER:
+            # 送信キューがあふれて捨てたメッセージ数
+            print(f"> Dropped messages: {server.dropped_messages()}")
         server.shutdown()
+        beacon.stop()
+        if multicast is not None:
+            print(f"> Multicast: {multicast.stats()}")
+            multicast.close()
+        # 残っているログを書き出す
+        log.shutdown()
         # システム終了
         sys.exit(0)
\ No newline at end of file
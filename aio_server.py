@@ -0,0 +1,264 @@
+# asyncioで動くマスター用サーバー
+# MultiClientServerはスレーブ1台ごとにスレッドを立てて、broadcastで順番にsendしていた
+# こちらは1つのイベントループで全スレーブを扱い、
+# 送信はクライアントごとのキューに積むだけなので遅いスレーブに他が待たされない
+import asyncio
+from typing import Callable, Dict, Optional, Tuple
+
+import clock_sync  # スレーブとの時計合わせ
+import heartbeat  # 接続が生きているかの確認
+import log
+import protocol  # 通信のメッセージ層
+from hal import clock  # シミュレーションでは速回しされる時計
+from panel_map import PanelRegistry
+
+logger = log.get_logger("server")
+
+# クライアントごとの送信キューの長さ。あふれたら古いものから捨てる
+WRITE_QUEUE_SIZE = 32
+# 1メッセージの送信(drain)をこれ以上待ったら死んだスレーブとみなして切る(秒)
+SEND_TIMEOUT = 2.0
+# ソケットの送信バッファがこれを超えたらdrainで待つ(byte)
+WRITE_BUFFER_HIGH = 16 * 1024
+
+
+def panel_geometry(init_data: dict):
+    """initメッセージのorigin/sizeを(origin, size)にする。古いスレーブが送ってこなければNone"""
+    origin = init_data.get("origin")
+    size = init_data.get("size")
+    return ((origin["x"], origin["y"]) if origin else None,
+            (size["width"], size["height"]) if size else None)
+
+
+class _Client:
+    """1台のスレーブの接続と送信キュー"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.position: Optional[Tuple[int, int]] = None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.dropped = 0  # キューがあふれて捨てたメッセージ数
+        self.writer_task: Optional[asyncio.Task] = None
+        self.handler_task: Optional[asyncio.Task] = None
+
+    def enqueue(self, message: bytes):
+        """送信キューに積む。いっぱいなら一番古いものを捨てる"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+
+class AsyncMultiClientServer:
+    """MultiClientServerと同じ init/sensor_data/draw/multiend を扱うasyncio版サーバー
+
+    start_serverは呼んだスレッドでイベントループを回す(戻るのはshutdown後)
+    broadcast/send_to_position/shutdownはどのスレッドから呼んでもよい
+    """
+
+    def __init__(self, port: int,
+                 on_sensor_data: Callable[["AsyncMultiClientServer", int, int, int], None],
+                 is_active: Callable[[], bool] = lambda: True,
+                 binary: bool = True,
+                 panel_size: Tuple[int, int] = (16, 16),
+                 multicast=None):
+        self.host = '0.0.0.0'
+        self.port = port
+        self.binary = binary
+        self.on_sensor_data = on_sensor_data  # sensor_data受信時に呼ぶ (multi_animation)
+        self.is_active = is_active  # Falseの間は接続を受け付けない (単体機能中)
+        self.clients: Dict[Tuple[int, int], _Client] = {}  # {(row, column): client}
+        self.panels = PanelRegistry(*panel_size)  # 各スレーブの担当領域
+        self.multicast = multicast  # 描画コマンドをマルチキャストで送るときのMulticastSender
+        self.unicast_positions = frozenset()  # マルチキャストを受けられず、描画コマンドもTCPで送る位置
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._connections = set()
+        self._dropped: Dict[Tuple[int, int], int] = {}  # 切れたスレーブの分の捨てたメッセージ数
+
+    def start_server(self):
+        """イベントループを作ってサーバーを動かす"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except KeyboardInterrupt:
+            logger.info("Shutting down server...")
+        finally:
+            self.loop.close()
+
+    async def _serve(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, self.host, self.port, reuse_address=True)
+        logger.info("Master server (asyncio) listening on port %d", self.port)
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            tasks = [client.handler_task for client in self._connections]
+            for client in list(self._connections):
+                self._close(client)
+            # 受信側のタスクが終わるのを待つ
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.info("Server shutdown complete")
+
+    async def _handle_client(self, reader, writer):
+        client = _Client(reader, writer)
+        # isSingleMode が True の場合、接続を拒否
+        if not self.is_active():
+            logger.info("Connection attempt from %s rejected (isSingleMode is True)", client.address)
+            writer.close()
+            return
+
+        logger.info("New connection from %s", client.address)
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        heartbeat.set_keepalive(writer.get_extra_info("socket"))
+        client.handler_task = asyncio.current_task()
+        self._connections.add(client)
+        client.writer_task = asyncio.ensure_future(self._write_loop(client))
+        decoder = protocol.FrameDecoder()
+        try:
+            while self.is_active():
+                # ハートビートが途絶えた(スレーブが落ちた)ら切る
+                data = await asyncio.wait_for(reader.read(4096), clock.real(heartbeat.HEARTBEAT_TIMEOUT))
+                if not data:
+                    break
+                received = clock.monotonic()  # 時計合わせに使う受信時刻
+                # 1回のreadに複数のメッセージが入っていることもある
+                for received_data in decoder.feed(data):
+                    try:
+                        self._dispatch(client, received_data, received)
+                    except (KeyError, TypeError, ValueError) as e:
+                        # フレームとしては正しくても中身の形が違うものは捨てる(FrameDecoderと同じ)
+                        logger.warning("Dropped malformed message from %s: %s", client.address, e)
+        except asyncio.TimeoutError:
+            logger.warning("No heartbeat from %s, disconnecting", client.position)
+        except (ConnectionError, OSError) as e:
+            logger.warning("Error handling client: %s", e)
+        finally:
+            self._close(client)
+
+    def _dispatch(self, client: _Client, received_data: dict, received: float):
+        if received_data["type"] == "heartbeat":
+            # 同じものを返す(スレーブはこれでマスターが生きていると分かる)
+            client.enqueue(protocol.encode_message(heartbeat.heartbeat(), self.binary))
+
+        elif received_data["type"] == "sync":
+            # 受け取った時刻と返す時刻を入れてすぐ返す
+            reply = clock_sync.sync_reply(received_data, received)
+            client.enqueue(protocol.encode_message(reply, self.binary))
+
+        elif received_data["type"] == "init":
+            # クライアントの位置情報を登録
+            position = tuple(received_data["position"].values())  # (row, column)
+            client.position = position
+            self.clients[position] = client
+            self.panels.register(position, *panel_geometry(received_data))
+            logger.info("Registered client at position: %s", position)
+            if self.multicast is not None:
+                # 描画コマンドの受け取り方を教える(参加できなければmulticast_failedが返ってくる)
+                self.unicast_positions = self.unicast_positions - {position}
+                client.enqueue(protocol.encode_message(self.multicast.announcement(), self.binary))
+
+        elif received_data["type"] == "multicast_failed":
+            # このスレーブには描画コマンドもTCPで送る
+            if client.position is not None:
+                self.unicast_positions = self.unicast_positions | {client.position}
+                logger.warning("Client at %s cannot receive multicast, sending draw over TCP", client.position)
+
+        elif received_data["type"] == "nack":
+            if self.multicast is not None:
+                self.multicast.retransmit(received_data["seqs"])
+
+        elif received_data["type"] == "sensor_data":
+            x = received_data["x"]
+            y = received_data["y"]
+            data_total = received_data["data_total"]
+            logger.info("multi_animation start")
+            self.on_sensor_data(self, x, y, data_total)
+
+    async def _write_loop(self, client: _Client):
+        """キューからメッセージを取り出して送る。詰まったスレーブは切る"""
+        try:
+            while True:
+                message = await client.queue.get()
+                client.writer.write(message)
+                await asyncio.wait_for(client.writer.drain(), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Client %s is not reading, disconnecting", client.position)
+            self._close(client)
+        except (ConnectionError, OSError) as e:
+            logger.warning("Failed to send to %s: %s", client.position, e)
+            self._close(client)
+        except asyncio.CancelledError:
+            pass
+
+    def _close(self, client: _Client):
+        if client not in self._connections:
+            return
+        self._connections.discard(client)
+        self.remove_client(client)
+        if client.writer_task and client.writer_task is not asyncio.current_task():
+            client.writer_task.cancel()
+        client.writer.close()
+
+    def _enqueue(self, position: Optional[Tuple[int, int]], message: bytes):
+        """イベントループ上で送信キューに積む(positionがNoneなら全員、listならその位置の全員)"""
+        if position is None:
+            targets = list(self.clients.values())
+        elif isinstance(position, list):
+            targets = [self.clients[p] for p in position if p in self.clients]
+        elif position in self.clients:
+            targets = [self.clients[position]]
+        else:
+            logger.warning("No client at position %s", position)
+            return
+        for client in targets:
+            client.enqueue(message)
+
+    def _call(self, callback, *args):
+        """ループのスレッドかどうかに関係なくループ上でcallbackを実行する"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def send_to_position(self, row: int, column: int, data: dict):
+        """特定の位置にデータを送信"""
+        self._call(self._enqueue, (row, column), protocol.encode_message(data, self.binary))
+
+    def broadcast(self, data: dict):
+        """すべてのクライアントにデータをブロードキャスト(キューに積むだけで待たない)"""
+        self._call(self._enqueue, None, protocol.encode_message(data, self.binary))
+
+    def broadcast_to(self, positions, data: dict):
+        """positionsのクライアントだけにデータを送信(エンコードは1回だけ)"""
+        if positions:
+            self._call(self._enqueue, list(positions), protocol.encode_message(data, self.binary))
+
+    def remove_client(self, client: _Client):
+        """クライアントを削除"""
+        if client.position is not None and client.dropped:
+            # 別のスレッドからdropped_messagesで読むので差し替える
+            dropped = dict(self._dropped)
+            dropped[client.position] = dropped.get(client.position, 0) + client.dropped
+            self._dropped = dropped
+        if client.position is not None and self.clients.get(client.position) is client:
+            del self.clients[client.position]
+            self.panels.remove(client.position)
+            self.unicast_positions = self.unicast_positions - {client.position}
+            logger.info("Removed client at position: %s", client.position)
+
+    def dropped_messages(self) -> Dict[Tuple[int, int], int]:
+        """送信キューがあふれて捨てたメッセージ数(位置ごと、切れたスレーブの分も含む)"""
+        dropped = dict(self._dropped)
+        for position, client in list(self.clients.items()):
+            dropped[position] = dropped.get(position, 0) + client.dropped
+        return dropped
+
+    def shutdown(self):
+        """すべてのクライアントとサーバーソケットを閉じる"""
+        if self._server is not None:
+            self._call(self._server.close)
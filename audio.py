@@ -0,0 +1,371 @@
+# 圧力に応じた音楽の再生 (マスター・スレーブ共通)
+# 押すたびにmpg321を起動すると、プロセスの起動とMP3のデコードで音が鳴るまで100ms以上かかる
+# ここでは起動時に全曲をPCMにデコードしておき、ずっと動いている1つのミキサーから流す
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import warnings
+import wave
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+import log
+
+logger = log.get_logger("audio")
+
+try:
+    # 波形の足し算をCで行う(Python 3.13で削除されたので、なければPythonで足す)
+    # 3.11からはimportするだけでDeprecationWarningが出るので、ここでは黙らせる
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+# 音楽の切り替えの間の値(DATA_TOTAL_INTERVALと同じ)
+BAND_INTERVAL = 300
+# 圧力の弱い順の音楽
+MUSIC_FILES = ("music1.mp3", "music2.mp3", "music3.mp3", "music4.mp3", "music5.mp3")
+# 同時に鳴らせる音の数。超えたら一番古い音を止める
+MAX_VOICES = 4
+# ミキサーが1回に書き出す長さ(フレーム数)。44.1kHzで約23ms
+CHUNK_FRAMES = 1024
+# aplayのバッファの長さ(us)。短いほど押してから鳴るまでが短い
+APLAY_BUFFER_US = 60000
+# ミキサーがaplayより先に書いておくチャンク数(これ以上は先に書かない)
+LEAD_CHUNKS = 2
+# mpg321を直接起動するときに同時に動かしてよいプロセス数
+MAX_PLAYERS = 2
+# 止めたmpg321がこの秒数で終わらなければkillする
+PLAYER_STOP_GRACE = 0.5
+# 鳴り始めるまでの時間を何回分覚えておくか
+LATENCY_HISTORY = 50
+
+
+class BandTable:
+    """圧力の値 -> 鳴らす音楽 の表
+
+    thresholdsは各音楽が鳴り始める値(昇順)。bisectで1回引くだけで決まる
+    一番小さい閾値より小さい値にはNoneを返す
+    """
+
+    def __init__(self, thresholds, clips):
+        if len(thresholds) != len(clips):
+            raise ValueError("thresholds and clips must have the same length")
+        if list(thresholds) != sorted(thresholds):
+            raise ValueError("thresholds must be sorted")
+        self.thresholds = list(thresholds)
+        self.clips = list(clips)
+
+    @classmethod
+    def evenly_spaced(cls, clips=MUSIC_FILES, interval=BAND_INTERVAL, start=0):
+        """start から interval ごとに区切った表 (元のif/elifの区切りと同じ)"""
+        return cls([start + interval * i for i in range(len(clips))], clips)
+
+    def select(self, value):
+        i = bisect_right(self.thresholds, value) - 1
+        return self.clips[i] if i >= 0 else None
+
+
+def decode_clip(path):
+    """MP3をmpg321でWAVにデコードして(PCMのbytes, rate, channels, sampwidth)を返す"""
+    fd, wav_path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        subprocess.run(["mpg321", "-q", "-w", wav_path, path], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with wave.open(wav_path, "rb") as f:
+            return (f.readframes(f.getnframes()), f.getframerate(),
+                    f.getnchannels(), f.getsampwidth())
+    finally:
+        os.remove(wav_path)
+
+
+def _mix(a, b):
+    """16bitのPCMを2つ足す(はみ出たら頭打ち)"""
+    if audioop is not None:
+        return audioop.add(a, b, 2)
+    x = array("h", a)
+    y = array("h", b)
+    return array("h", [min(max(p + q, -32768), 32767) for p, q in zip(x, y)]).tobytes()
+
+
+class _Voice:
+    """鳴っている1つの音"""
+
+    def __init__(self, name, pcm):
+        self.name = name
+        self.pcm = pcm
+        self.pos = 0  # 次に書き出す位置(byte)
+        self.requested = time.monotonic()  # play()が呼ばれた時刻
+
+
+class Mixer:
+    """デコード済みの音を重ねてaplayに流し続ける
+
+    aplayは起動したままにしておき、音が鳴っていない間は無音を流す
+    書き出しは再生の速さに合わせて行う(先に書きすぎるとパイプにたまった分だけ音が遅れる)
+    """
+
+    def __init__(self, max_voices=MAX_VOICES, chunk_frames=CHUNK_FRAMES):
+        self.max_voices = max_voices
+        self.chunk_frames = chunk_frames
+        self.clips = {}  # {name: PCMのbytes}
+        self.rate = None
+        self.channels = None
+        self.voices = []
+        self.played = 0
+        self.stolen = 0  # 上限を超えて止めた音の数
+        self.latencies = deque(maxlen=LATENCY_HISTORY)  # play()からaplayに書くまでの時間(秒)
+        self._lock = threading.Lock()
+        self._process = None
+        self._thread = None
+        self._running = False
+
+    def load(self, name, path):
+        """pathをデコードしてnameで鳴らせるようにする。他の曲と形式が違えばValueError"""
+        pcm, rate, channels, sampwidth = decode_clip(path)
+        if sampwidth != 2:
+            raise ValueError(f"{path}: only 16-bit audio is supported")
+        if self.rate is None:
+            self.rate, self.channels = rate, channels
+        elif (rate, channels) != (self.rate, self.channels):
+            raise ValueError(f"{path}: {rate} Hz/{channels} ch does not match {self.rate} Hz/{self.channels} ch")
+        self.clips[name] = pcm
+
+    def start(self):
+        """aplayとミキサーのスレッドを立ち上げる"""
+        if self.rate is None:
+            raise RuntimeError("no clips loaded")
+        self._process = subprocess.Popen(
+            ["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-r", str(self.rate),
+             "-c", str(self.channels), "--buffer-time=%d" % APLAY_BUFFER_US, "-"],
+            stdin=subprocess.PIPE)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+    def play(self, name):
+        """nameの音を重ねて鳴らす。鳴らせればTrue"""
+        pcm = self.clips.get(name)
+        if pcm is None or not self._running:
+            return False
+        with self._lock:
+            if len(self.voices) >= self.max_voices:
+                self.voices.pop(0)  # 一番古い音を止める
+                self.stolen += 1
+            self.voices.append(_Voice(name, pcm))
+            self.played += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._running,
+                "voices": len(self.voices),
+                "played": self.played,
+                "stolen": self.stolen,
+                "latency_ms": _latency_stats(self.latencies),
+            }
+
+    def _next_chunk(self, size):
+        """全部の音を足した次のsize byte分"""
+        now = time.monotonic()
+        with self._lock:
+            voices = list(self.voices)
+            # stats()が同じdequeを読むので、記録もロックを持って行う
+            for voice in voices:
+                if voice.pos == 0:
+                    self.latencies.append(now - voice.requested)
+        chunk = None
+        finished = []
+        for voice in voices:
+            part = voice.pcm[voice.pos:voice.pos + size]
+            voice.pos += size
+            if voice.pos >= len(voice.pcm):
+                finished.append(voice)
+            if len(part) < size:
+                part += bytes(size - len(part))
+            chunk = part if chunk is None else _mix(chunk, part)
+        if finished:
+            with self._lock:
+                self.voices = [voice for voice in self.voices if voice not in finished]
+        return chunk if chunk is not None else bytes(size)
+
+    def _run(self):
+        size = self.chunk_frames * self.channels * 2
+        period = self.chunk_frames / self.rate
+        next_write = time.monotonic()
+        try:
+            while self._running:
+                self._process.stdin.write(self._next_chunk(size))
+                self._process.stdin.flush()
+                # 再生の速さに合わせて、LEAD_CHUNKS分より先には書かない
+                next_write += period
+                delay = next_write - time.monotonic() - period * LEAD_CHUNKS
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -period * LEAD_CHUNKS:
+                    next_write = time.monotonic()
+        except (BrokenPipeError, OSError) as e:
+            logger.warning("Audio output stopped: %s", e)
+            self._running = False
+
+
+def _latency_stats(latencies):
+    """時間(秒)の記録の平均と最大(ms)"""
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies) * 1000,
+        "max": max(latencies) * 1000,
+    }
+
+
+class PlayerPool:
+    """mpg321のプロセスをまとめて管理する
+
+    同時に動かすのはmax_players個まで。超えたら一番古いプロセスを止めてから起動する
+    止めるときはterminateするだけで終わるのを待たない(押してから鳴るまでを延ばさない)
+    終わったプロセスは次のplay/statsでpollして回収するので、ゾンビが残り続けない
+    """
+
+    def __init__(self, max_players=MAX_PLAYERS):
+        self.max_players = max_players
+        self.players = deque()  # 起動した順のPopen
+        self.stopping = []  # terminateして終わるのを待っている(Popen, killする時刻)
+        self.started = 0
+        self.stolen = 0  # 上限を超えて止めたプロセスの数
+        self.reaped = 0  # 再生が終わって回収したプロセスの数
+        self.latencies = deque(maxlen=LATENCY_HISTORY)  # プロセスの起動にかかった時間(秒)
+        self._lock = threading.Lock()
+
+    def _reap(self):
+        """終わったプロセスを取り除く(poll()がwaitして回収する)"""
+        alive = deque()
+        for player in self.players:
+            if player.poll() is None:
+                alive.append(player)
+            else:
+                self.reaped += 1
+        self.players = alive
+        if self.stopping:
+            now = time.monotonic()
+            stopping = []
+            for player, deadline in self.stopping:
+                if player.poll() is None:
+                    if now >= deadline:
+                        player.kill()  # 次のpollで回収する
+                    stopping.append((player, deadline))
+            self.stopping = stopping
+
+    def _terminate(self, player):
+        """playerを止めるように頼むだけで待たない"""
+        player.terminate()
+        self.stopping.append((player, time.monotonic() + PLAYER_STOP_GRACE))
+
+    @staticmethod
+    def _kill(player):
+        player.terminate()
+        try:
+            player.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            player.kill()
+            player.wait()
+
+    def play(self, path):
+        with self._lock:
+            self._reap()
+            while len(self.players) >= self.max_players:
+                self._terminate(self.players.popleft())  # 一番古い音を止める
+                self.stolen += 1
+            start = time.monotonic()
+            try:
+                player = subprocess.Popen(["mpg321", "-q", path],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logger.warning("Could not start mpg321: %s", e)
+                return
+            self.latencies.append(time.monotonic() - start)
+            self.players.append(player)
+            self.started += 1
+
+    def stop(self):
+        """動いているプロセスを全部止める(終わるまで待つ)"""
+        with self._lock:
+            while self.players:
+                self._kill(self.players.popleft())
+            for player, _ in self.stopping:
+                self._kill(player)
+            self.stopping = []
+
+    def stats(self):
+        with self._lock:
+            self._reap()
+            return {
+                "players": len(self.players),
+                "started": self.started,
+                "stolen": self.stolen,
+                "reaped": self.reaped,
+                "latency_ms": _latency_stats(self.latencies),
+            }
+
+
+class Audio:
+    """圧力の値で音楽を選んで鳴らす
+
+    起動時に全曲をMixerに読み込む。デコードできない曲やaplayが使えないときは、
+    その曲だけPlayerPoolでmpg321を起動して鳴らす
+    """
+
+    def __init__(self, bands=None, directory=".", enabled=True):
+        self.bands = bands if bands is not None else BandTable.evenly_spaced()
+        self.directory = directory
+        self.enabled = enabled  # Falseなら何も鳴らさない(シミュレーション用)
+        self.mixer = Mixer()
+        self.pool = PlayerPool()
+
+    def start(self):
+        if not self.enabled:
+            return
+        for clip in set(self.bands.clips):
+            try:
+                self.mixer.load(clip, os.path.join(self.directory, clip))
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                logger.warning("Could not preload %s: %s", clip, e)
+        try:
+            self.mixer.start()
+        except (OSError, RuntimeError) as e:
+            logger.warning("Audio mixer disabled: %s", e)
+
+    def stop(self):
+        self.mixer.stop()
+        self.pool.stop()
+
+    def stats(self):
+        """鳴っている音の数と、鳴り始めるまでの時間"""
+        return {"mixer": self.mixer.stats(), "mpg321": self.pool.stats()}
+
+    def select(self, level):
+        """閾値からの圧力の値(data_total - data_total_min)で鳴らす曲を選ぶ"""
+        return self.bands.select(level)
+
+    def play(self, clip):
+        if clip is None or not self.enabled:
+            return
+        if not self.mixer.play(clip):
+            self.pool.play(os.path.join(self.directory, clip))
@@ -0,0 +1,309 @@
+# 押下 -> 全パネルの最初の点灯 までの時間を測るベンチマーク
+# マスター1台とスレーブN台を、このPCの上でシミュレーション(HAL=sim)のプロセスとして動かす
+# スレーブのパッドを台本どおりに押し、各処理を通過した時刻(hal.mark)から区間ごとの時間を求める
+#
+#   python -m benchmarks.latency --slaves 2 --taps 20 --interval 2.0
+#   python -m benchmarks.latency --intervals 2,1,0.5 --output latency.json
+#   python -m benchmarks.latency --slaves 8 --multicast   (drawをUDPマルチキャストで送る)
+#   python -m benchmarks.latency --discover               (スレーブがビーコンでマスターを見つける)
+#
+# 結果はJSONで出す(区間ごとのp50/p95/p99(ms)と、取りこぼしなしで処理できた押下の頻度)
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASTER_SCRIPT = os.path.join(ROOT, "Multifunc8_master.py")
+SLAVE_SCRIPT = os.path.join(ROOT, "Circle10_slave.py")
+
+# マスターとスレーブを複数機能にするボタンの時刻(各プロセスの起動からの秒数)
+MASTER_BUTTON_AT = 0.5
+SLAVE_BUTTON_AT = 2.0
+# 最初の押下の時刻。スレーブがマスターにつながり終わってから
+FIRST_TAP_AT = 6.0
+# 押下の強さと押している時間
+TAP_TOTAL = 900
+TAP_DURATION = 0.2
+# 最後の押下のあと、波紋が全パネルに届くのを待つ時間(秒)
+SETTLE_TIME = 8.0
+
+# 押下から順に通る処理。(プロセス, stage)
+# "tapped"は押したスレーブ、"master"はマスター、"panels"は全パネル(マスターと全スレーブ)
+STAGES = [
+    ("tapped", "pressed"),          # 圧力が閾値を超えた (PressureTrigger)
+    ("tapped", "located"),          # 物体の位置が分かった (locate_object)
+    ("tapped", "sent"),             # sensor_dataを送った (send_to_master)
+    ("master", "sensor_received"),  # マスターが受け取った (multi_animation)
+    ("master", "broadcast"),        # drawを送った (broadcast)
+    ("panels", "draw_received"),    # スレーブが受け取った (handle_command)
+    ("panels", "led_on"),           # そのパネルで波紋が最初に点灯した
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def slave_positions(count):
+    """マスター(0, 0)以外の(row, column)を近い順に"""
+    positions = []
+    size = 1
+    while len(positions) < count:
+        for row in range(size + 1):
+            for column in range(size + 1):
+                if (row, column) != (0, 0) and (row, column) not in positions:
+                    positions.append((row, column))
+        size += 1
+    return sorted(positions, key=lambda p: (max(p), p))[:count]
+
+
+def scenario(buttons, presses):
+    return {
+        "object_radius": 15,
+        "objects": [[0, 80, 80]],
+        "presses": presses,
+        "buttons": buttons,
+        "idle_total": 400,
+        "noise": 4,
+    }
+
+
+class Session:
+    """マスターとスレーブのプロセスを立ち上げて、taps回押して、イベントを集める"""
+
+    def __init__(self, slaves, taps, interval, speed, workdir, multicast=False, discover=False):
+        self.slaves = slave_positions(slaves)
+        self.multicast = multicast
+        self.discover = discover
+        self.taps = taps
+        self.interval = interval
+        self.speed = speed
+        self.workdir = workdir
+        self.port = free_port()
+        self.processes = []
+
+    def _spawn(self, name, script, scenario_data, extra_env):
+        scenario_path = os.path.join(self.workdir, name + ".scenario.json")
+        with open(scenario_path, "w") as f:
+            json.dump(scenario_data, f)
+        env = dict(os.environ)
+        env.update({
+            "HAL": "sim",
+            "HAL_SPEED": str(self.speed),
+            "HAL_SCENARIO": scenario_path,
+            "HAL_EVENTS": os.path.join(self.workdir, name + ".events.jsonl"),
+            "HAL_NAME": name,
+            "MASTER_PORT": str(self.port),
+            "MULTICAST_INTERFACE": "127.0.0.1",
+        })
+        if self.multicast:
+            env["MULTICAST_FANOUT"] = "1"
+        env.update(extra_env)
+        log = open(os.path.join(self.workdir, name + ".log"), "w")
+        process = subprocess.Popen([sys.executable, script], cwd=ROOT, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((name, process, log))
+
+    def run(self):
+        # スレーブの押下は順番に回す(同じパッドを続けて押さない)
+        presses = {position: [] for position in self.slaves}
+        for k in range(self.taps):
+            position = self.slaves[k % len(self.slaves)]
+            presses[position].append([FIRST_TAP_AT + k * self.interval, TAP_TOTAL, TAP_DURATION])
+
+        self._spawn("master", MASTER_SCRIPT, scenario([[MASTER_BUTTON_AT, 0.3]], []), {})
+        time.sleep(0.5)
+        for row, column in self.slaves:
+            self._spawn("slave-%d-%d" % (row, column), SLAVE_SCRIPT,
+                        scenario([[SLAVE_BUTTON_AT, 0.3]], presses[(row, column)]),
+                        {"MASTER_IP": "" if self.discover else "127.0.0.1",
+                         "SLAVE_ROWS": str(row), "SLAVE_COLS": str(column)})
+
+        duration = FIRST_TAP_AT + self.taps * self.interval + SETTLE_TIME
+        time.sleep(duration / self.speed + 1.0)
+        self.stop()
+        return self.events()
+
+    def stop(self):
+        for name, process, log in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for name, process, log in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+
+    def events(self):
+        events = []
+        for name, process, log in self.processes:
+            path = os.path.join(self.workdir, name + ".events.jsonl")
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        return sorted(events, key=lambda e: e["t"])
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarize(values):
+    ms = [v * 1000 for v in values]
+    return {
+        "count": len(ms),
+        "p50": percentile(ms, 50),
+        "p95": percentile(ms, 95),
+        "p99": percentile(ms, 99),
+        "max": max(ms) if ms else None,
+    }
+
+
+def match_taps(events, panels):
+    """押下ごとに各処理を通過した時刻を対応させる
+
+    メッセージには押下の番号が入っていないので、各プロセスの各stageのイベントを時刻順に、
+    まだ対応していない押下のうち前の処理を通過した後で一番早いものに割り当てる
+    """
+    streams = {}
+    for event in events:
+        streams.setdefault((event["name"], event["stage"]), []).append(event["t"])
+    taps = [(e["name"], e["t"]) for e in events if e["stage"] == "tap"]
+    used = {}
+
+    def take(name, stage, after):
+        times = streams.get((name, stage), [])
+        start = used.get((name, stage), 0)
+        for i in range(start, len(times)):
+            if times[i] >= after:
+                used[(name, stage)] = i + 1
+                return times[i]
+        return None
+
+    results = []
+    for tapped, t0 in taps:
+        result = {"slave": tapped, "tap": t0, "stages": {}, "panels": {}}
+        previous = t0
+        for where, stage in STAGES:
+            if where == "panels":
+                for panel in panels:
+                    if stage == "draw_received" and panel == "master":
+                        continue
+                    after = result["panels"].get(panel, {}).get("draw_received", previous)
+                    t = take(panel, stage, after)
+                    if t is not None:
+                        result["panels"].setdefault(panel, {})[stage] = t
+                continue
+            name = tapped if where == "tapped" else "master"
+            t = take(name, stage, previous)
+            if t is None:
+                break
+            result["stages"][stage] = t
+            previous = t
+        results.append(result)
+    return results
+
+
+def report(results, panels, interval):
+    stage_names = [stage for where, stage in STAGES if where != "panels"]
+    deltas = {}
+    end_to_end = []
+    panel_latency = {panel: [] for panel in panels}
+    dropped = 0
+    for result in results:
+        stages = result["stages"]
+        previous, previous_name = result["tap"], "tap"
+        for stage in stage_names:
+            if stage not in stages:
+                break
+            deltas.setdefault("%s->%s" % (previous_name, stage), []).append(stages[stage] - previous)
+            previous, previous_name = stages[stage], stage
+        lit = {panel: times["led_on"] for panel, times in result["panels"].items() if "led_on" in times}
+        for panel, t in lit.items():
+            panel_latency[panel].append(t - result["tap"])
+        received = [times["draw_received"] for times in result["panels"].values() if "draw_received" in times]
+        if received and "broadcast" in stages:
+            deltas.setdefault("broadcast->draw_received", []).extend(t - stages["broadcast"] for t in received)
+        # drawは波紋が届くパネルにしか送られないので、受け取ったパネル(とマスター)だけ点灯を待つ
+        expected = ["master"] + [panel for panel, times in result["panels"].items() if "draw_received" in times]
+        if len(stages) < len(stage_names) or any(panel not in lit for panel in expected):
+            dropped += 1
+        else:
+            end_to_end.append(max(lit.values()) - result["tap"])
+    return {
+        "interval": interval,
+        "taps": len(results),
+        "dropped": dropped,
+        "taps_per_second": 1.0 / interval,
+        "stages": {name: summarize(values) for name, values in deltas.items()},
+        "first_led_per_panel": {panel: summarize(values) for panel, values in panel_latency.items()},
+        "end_to_end": summarize(end_to_end),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tap -> first LED latency over loopback with simulated hardware")
+    parser.add_argument("--slaves", type=int, default=2)
+    parser.add_argument("--taps", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between taps")
+    parser.add_argument("--intervals", help="comma separated intervals to find the throughput limit")
+    parser.add_argument("--speed", type=float, default=1.0, help="HAL_SPEED (1 for realistic latency)")
+    parser.add_argument("--multicast", action="store_true", help="send draw over UDP multicast")
+    parser.add_argument("--discover", action="store_true", help="let slaves find the master by its beacon")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the logs and event files")
+    args = parser.parse_args()
+
+    intervals = [float(v) for v in args.intervals.split(",")] if args.intervals else [args.interval]
+    runs = []
+    for interval in intervals:
+        workdir = tempfile.mkdtemp(prefix="latency-")
+        session = Session(args.slaves, args.taps, interval, args.speed, workdir, args.multicast, args.discover)
+        panels = ["master"] + ["slave-%d-%d" % position for position in session.slaves]
+        events = session.run()
+        run = report(match_taps(events, panels), panels, interval)
+        if args.keep:
+            run["workdir"] = workdir
+        else:
+            for name in os.listdir(workdir):
+                os.remove(os.path.join(workdir, name))
+            os.rmdir(workdir)
+        runs.append(run)
+        print("> interval %.2fs: %d/%d taps dropped" % (interval, run["dropped"], run["taps"]), file=sys.stderr)
+
+    clean = [run["taps_per_second"] for run in runs if run["taps"] and not run["dropped"]]
+    result = {
+        "slaves": args.slaves,
+        "speed": args.speed,
+        "multicast": args.multicast,
+        "discover": args.discover,
+        "runs": runs,
+        "max_taps_per_second_without_drops": max(clean) if clean else None,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# 描画処理(render.py)のマイクロベンチマーク
+# 実機のLEDの代わりに何もしないstripに描いて、Python側の処理時間を測る
+# show()ではLEDの数だけ転送時間(WS2812Bは1個24bit x 1.25us = 30us)を待つので、
+# frame_budgetは実機と同じくshow()の転送も入れた1フレームになる(--us-per-led 0で処理時間だけ)
+# 各フレームの結果は描画(render_ms)と転送(transfer_ms)を分けて出し、ns_per_pixelは描画の時間だけで求める
+#
+#   python -m benchmarks.render_bench
+#   python -m benchmarks.render_bench --quick --output render.json
+#
+# 測るもの
+#   ring         : ring_pixels (circle_pixels) の半径・中心(中央/端/領域外)ごとの時間
+#   ripples      : Compositor + Ripple (draw_frame/draw_slave の代わり) を同時にN個描いたときの1フレーム
+#   gathering    : Gathering (update_positions) の点の数ごとの1フレーム
+#   frame_budget : パネルの枚数を増やしていき、一番遅いフレームがFRAME_INTERVAL(100ms)に収まらなくなる枚数
+import argparse
+import json
+import random
+import sys
+import time
+
+import render
+from panel_map import PanelMap
+
+# 1つのケースを測る最短の時間(秒)
+MIN_TIME = 0.2
+# 円の幅 (CIRCLE_WIDTHと同じ)
+CIRCLE_WIDTH = 7
+PANEL_SIZE = 16
+# show()1回でLED1個あたりにかかる転送時間(us)。WS2812Bは800kHzで24bit
+LED_US_PER_PIXEL = 30.0
+
+
+class NullStrip:
+    """PixelStripの代わり。書き込まれた画素数を数え、show()では全LED分の転送時間だけ待つ"""
+
+    def __init__(self, count, us_per_led=LED_US_PER_PIXEL):
+        self.count = count
+        self.transfer = count * us_per_led / 1e6  # show()1回の転送時間(秒)
+        self.transferred = 0.0  # これまでに転送で待った時間の合計(秒)
+        self.writes = 0
+        self.shows = 0
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        self.writes += 1
+
+    def show(self):
+        self.shows += 1
+        if self.transfer:
+            # sleepでは短い時間が正確に待てないので回して待つ
+            start = time.perf_counter()
+            end = start + self.transfer
+            while time.perf_counter() < end:
+                pass
+            self.transferred += time.perf_counter() - start
+
+
+def measure(func, min_time=MIN_TIME):
+    """funcをmin_time秒以上くり返して1回あたりの秒数を返す"""
+    func()  # キャッシュを温める
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / count
+
+
+def measure_each(func, min_time=MIN_TIME):
+    """funcをmin_time秒以上くり返して1回ごとの秒数のリストを返す"""
+    func()  # キャッシュを温める
+    times = []
+    start = time.perf_counter()
+    while True:
+        before = time.perf_counter()
+        func()
+        after = time.perf_counter()
+        times.append(after - before)
+        if after - start >= min_time:
+            return times
+
+
+def bench_ring(radii, min_time):
+    """ring_pixelsを中心の位置と半径ごとに測る"""
+    w = h = PANEL_SIZE
+    centres = {
+        "centre": (w // 2, h // 2),
+        "edge": (0, h // 2),
+        "corner": (0, 0),
+        "outside": (w + 20, h + 20),  # 隣のパネルの波紋(このパネルにはほとんどかからない)
+    }
+    results = []
+    for name, (xc, yc) in centres.items():
+        for radius in radii:
+            pixels = len(render.ring_pixels(xc, yc, radius, 0, 0, w, h))
+            seconds = measure(lambda: render.ring_pixels(xc, yc, radius, 0, 0, w, h), min_time)
+            results.append({
+                "centre": name,
+                "radius": radius,
+                "pixels": pixels,
+                "us_per_call": seconds * 1e6,
+                "ns_per_pixel": seconds * 1e9 / pixels if pixels else None,
+            })
+    return results
+
+
+def random_colors(rng):
+    return [[rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)] for _ in range(CIRCLE_WIDTH)]
+
+
+def run_frames(panel_map, make_layers, min_time, us_per_led=LED_US_PER_PIXEL):
+    """レイヤーを載せたCompositorのrender_onceを1フレームずつ測る。終わったレイヤーは作り直す
+
+    1フレームの時間を描画(Python)と転送(show)に分けて、それぞれの平均と一番遅いフレーム(秒)を返す
+    """
+    strip = NullStrip(panel_map.led_count, us_per_led)
+    compositor = render.Compositor(strip, panel_map)
+    transfers = []
+
+    def frame():
+        if not compositor.layers:
+            for layer in make_layers():
+                compositor.add_layer(layer)
+        transferred = strip.transferred
+        compositor.render_once()
+        transfers.append(strip.transferred - transferred)
+
+    times = measure_each(frame, min_time)
+    transfers = transfers[1:]  # measure_eachがキャッシュを温めた1回分
+    count = len(times)
+    transfer = sum(transfers) / count
+    return {
+        "frame": sum(times) / count,
+        "worst": max(times),
+        "render": sum(times) / count - transfer,
+        "transfer": transfer,
+    }
+
+
+def frame_result(timing):
+    """run_framesの結果をmsにする"""
+    return {
+        "ms_per_frame": timing["frame"] * 1000,
+        "worst_frame_ms": timing["worst"] * 1000,
+        "render_ms": timing["render"] * 1000,
+        "transfer_ms": timing["transfer"] * 1000,
+        "frames_per_second": 1 / timing["frame"],
+    }
+
+
+def bench_ripples(counts, min_time, us_per_led=LED_US_PER_PIXEL, seed=0):
+    """16x16のパネルに同時にN個の波紋を描く"""
+    panel_map = PanelMap(PANEL_SIZE, PANEL_SIZE)
+    results = []
+    for count in counts:
+        rng = random.Random(seed)
+
+        def make_layers():
+            return [render.Ripple(rng.randint(-8, 24), rng.randint(-8, 24), random_colors(rng), 30, CIRCLE_WIDTH)
+                    for _ in range(count)]
+
+        timing = run_frames(panel_map, make_layers, min_time, us_per_led)
+        results.append({
+            "ripples": count,
+            **frame_result(timing),
+            # 転送はLEDの数で決まるので、描画の時間だけで割る
+            "ns_per_pixel": timing["render"] * 1e9 / panel_map.led_count,
+        })
+    return results
+
+
+def bench_gathering(counts, min_time, us_per_led=LED_US_PER_PIXEL, seed=0):
+    """16x16のパネルでN個の点を集める"""
+    panel_map = PanelMap(PANEL_SIZE, PANEL_SIZE)
+    results = []
+    for count in counts:
+        rng = random.Random(seed)
+
+        def make_layers():
+            points = [(rng.randrange(PANEL_SIZE), rng.randrange(PANEL_SIZE), render.pack_color(200, 100, 50))
+                      for _ in range(count)]
+            return [render.Gathering(points, PANEL_SIZE // 2, PANEL_SIZE // 2)]
+
+        timing = run_frames(panel_map, make_layers, min_time, us_per_led)
+        results.append({
+            "particles": count,
+            **frame_result(timing),
+            "ns_per_particle": timing["render"] * 1e9 / count,
+        })
+    return results
+
+
+def bench_frame_budget(max_panels, ripples, min_time, us_per_led=LED_US_PER_PIXEL, seed=0):
+    """パネルをn x n枚に増やしながら、ripples個の波紋の1フレームを測る
+
+    平均ではなく一番遅いフレームが予算に収まるかを見る(1フレームでも遅れれば波紋がかくつく)
+    """
+    results = []
+    limit = None
+    for n in range(1, max_panels + 1):
+        panel_map = PanelMap(PANEL_SIZE, PANEL_SIZE, n, n)
+        rng = random.Random(seed)
+        size = PANEL_SIZE * n
+
+        def make_layers():
+            return [render.Ripple(rng.randrange(size), rng.randrange(size), random_colors(rng),
+                                  size, CIRCLE_WIDTH)
+                    for _ in range(ripples)]
+
+        timing = run_frames(panel_map, make_layers, min_time, us_per_led)
+        within = timing["worst"] <= render.FRAME_INTERVAL
+        results.append({
+            "panels": n * n,
+            "leds": panel_map.led_count,
+            **frame_result(timing),
+            "ns_per_pixel": timing["render"] * 1e9 / panel_map.led_count,
+            "within_budget": within,
+        })
+        if not within:
+            limit = n * n
+            break
+    return {"ripples": ripples, "budget_ms": render.FRAME_INTERVAL * 1000, "us_per_led": us_per_led,
+            "first_panel_count_over_budget": limit, "sizes": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render path microbenchmarks against a null strip")
+    parser.add_argument("--quick", action="store_true", help="shorter runs and fewer cases")
+    parser.add_argument("--max-panels", type=int, default=16, help="largest n for the n x n panel sweep")
+    parser.add_argument("--budget-ripples", type=int, default=3, help="simultaneous ripples in the panel sweep")
+    parser.add_argument("--us-per-led", type=float, default=LED_US_PER_PIXEL,
+                        help="LED transfer time added to each show() (0 to time Python only)")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    min_time = MIN_TIME / 4 if args.quick else MIN_TIME
+    render.warm_ring_cache(render.RING_CACHE_SIZE - 1)
+    result = {
+        "python": sys.version.split()[0],
+        "ring": bench_ring([1, 4, 8, 16, 32] if args.quick else [1, 2, 4, 8, 12, 16, 24, 32, 48, 63], min_time),
+        "us_per_led": args.us_per_led,
+        "ripples": bench_ripples([1, 4, 16] if args.quick else [1, 2, 4, 8, 16, 32], min_time, args.us_per_led),
+        "gathering": bench_gathering([10, 100, 1000, 10000], min_time, args.us_per_led),
+        "frame_budget": bench_frame_budget(args.max_panels, args.budget_ripples, min_time, args.us_per_led),
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
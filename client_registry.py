@@ -0,0 +1,94 @@
+# マスターが持つ、スレーブの位置 -> ソケット の表 (スレッド版サーバー用)
+# 登録・削除は各スレーブの受信スレッドから、broadcastは別のスレッドから同時に行われる
+# 書き換えはロックを持って新しい辞書を作って差し替え(コピーオンライト)、
+# 読む側はロックを取らずに今の辞書をそのまま使う
+# 同じソケットへのsendallは受信スレッド(ハートビート・時計合わせの返事)とbroadcastから同時に来るので、
+# send()でソケットごとのロックを持って送る(途中で混ざるとフレームが壊れる)
+import threading
+import weakref
+
+
+class ClientRegistry:
+    """位置(row, column)ごとのソケット
+
+    つなぎ直しの途中は同じ位置に古いソケットと新しいソケットが両方あることがある
+    送り先にはその位置で一番新しいソケットを使い、それが外れたら前のものに戻る
+    ソケット -> 位置 の逆引きを持っているので、削除は全位置をなめずに済む
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets = {}  # {position: (古い順のソケット, ...)}
+        self._positions = {}  # {socket: position}
+        self._targets = {}  # {position: 一番新しいソケット}。差し替えるだけで中身は変えない
+        self._send_locks = weakref.WeakKeyDictionary()  # {socket: 送信用のロック}。閉じたソケットの分は消える
+
+    def _publish(self):
+        # _lockを持って呼ぶ
+        self._targets = {position: sockets[-1] for position, sockets in self._sockets.items()}
+
+    def register(self, position, sock):
+        """sockをpositionに登録する。同じ位置にあったソケットは外れるまで残す
+
+        登録後にその位置にあるソケットの数を返す(2以上ならつなぎ直しの途中)
+        """
+        with self._lock:
+            old = self._positions.get(sock)
+            if old is not None and old != position:
+                self._discard(old, sock)
+            sockets = tuple(s for s in self._sockets.get(position, ()) if s is not sock) + (sock,)
+            self._sockets[position] = sockets
+            self._positions[sock] = position
+            self._publish()
+            return len(sockets)
+
+    def remove(self, sock):
+        """sockを外して(位置, その位置に残ったソケットの数)を返す。登録されていなければ(None, 0)"""
+        with self._lock:
+            position = self._positions.pop(sock, None)
+            if position is None:
+                return None, 0
+            remaining = self._discard(position, sock)
+            self._publish()
+            return position, remaining
+
+    def _discard(self, position, sock):
+        # _lockを持って呼ぶ。positionに残ったソケットの数を返す
+        sockets = tuple(s for s in self._sockets.get(position, ()) if s is not sock)
+        if sockets:
+            self._sockets[position] = sockets
+        else:
+            self._sockets.pop(position, None)
+        return len(sockets)
+
+    def send(self, sock, message):
+        """sockにmessage(エンコード済み)を送る。同じソケットへの送信は1つずつ"""
+        with self._lock:
+            lock = self._send_locks.get(sock)
+            if lock is None:
+                lock = self._send_locks[sock] = threading.Lock()
+        with lock:
+            sock.sendall(message)
+
+    def position_of(self, sock):
+        """sockが登録されている位置(なければNone)"""
+        return self._positions.get(sock)
+
+    def get(self, position):
+        """positionに送るソケット(なければNone)"""
+        return self._targets.get(position)
+
+    def snapshot(self):
+        """{位置: 送るソケット}。ロックを取らずに読め、あとで登録・削除があっても変わらない"""
+        return self._targets
+
+    def sockets(self):
+        """登録されている全ソケット(つなぎ直しの途中の古いものも含む)"""
+        with self._lock:
+            return list(self._positions)
+
+    def __len__(self):
+        return len(self._targets)
+
+    def __contains__(self, position):
+        return position in self._targets
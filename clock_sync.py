@@ -0,0 +1,72 @@
+# マスターとスレーブの時計合わせ (NTPと同じ考え方)
+# drawが届いた瞬間に描き始めると、届くのが遅れたパネルだけ波紋がずれる
+# マスターは「この時刻にフレーム0を描く」(start_at)を送り、スレーブは自分の時計に直して描く
+#
+# スレーブ -> マスター: {"type": "sync", "t0": 送った時刻}
+# マスター -> スレーブ: {"type": "sync_reply", "t0": t0, "t1": 受け取った時刻, "t2": 返した時刻}
+# スレーブは返事を受け取った時刻t3と合わせて、時計のずれ(offset)と往復時間(rtt)を求める
+import math
+import threading
+from collections import deque
+
+from hal import clock  # シミュレーションでは速回しされる時計
+
+# 時計合わせの間隔(秒)
+SYNC_INTERVAL = 5.0
+# 接続直後に続けて送る回数と間隔(秒)。最初のdrawまでにずれを分かっておくため
+SYNC_BURST = 4
+SYNC_BURST_INTERVAL = 0.05
+# 何回分の測定から一番往復時間の短いものを選ぶか
+SYNC_SAMPLES = 8
+# マスターがdrawを送ってから描き始めるまでの余裕(秒)。全スレーブに届くまでの時間より長く
+DRAW_LEAD = 0.1
+
+
+def sync_request():
+    return {"type": "sync", "t0": clock.monotonic()}
+
+
+def sync_reply(request, received):
+    """syncに対する返事。receivedはsyncを受け取った時刻"""
+    return {"type": "sync_reply", "t0": request["t0"], "t1": received, "t2": clock.monotonic()}
+
+
+def next_frame_time(interval, lead=DRAW_LEAD):
+    """lead秒後以降で、フレームの区切り(intervalの倍数の時刻)になる最初の時刻"""
+    return math.ceil((clock.monotonic() + lead) / interval) * interval
+
+
+class ClockSync:
+    """スレーブ側で、マスターの時計とのずれを推定する
+
+    往復時間が短い測定ほど行きと帰りの遅れの差が小さく、ずれの誤差も小さい
+    そこで直近SYNC_SAMPLES回のうち往復時間が一番短いものを使う
+    """
+
+    def __init__(self, samples=SYNC_SAMPLES):
+        self.samples = deque(maxlen=samples)  # (rtt, offset)
+        self.offset = None  # マスターの時刻 - 自分の時刻 (まだ分からなければNone)
+        self.rtt = None
+        self._lock = threading.Lock()
+
+    @property
+    def synced(self):
+        return self.offset is not None
+
+    def add(self, reply, received):
+        """sync_replyと、それを受け取った時刻receivedから1回分の測定を加える"""
+        t0, t1, t2, t3 = reply["t0"], reply["t1"], reply["t2"], received
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        with self._lock:
+            self.samples.append((rtt, offset))
+            self.rtt, self.offset = min(self.samples)
+
+    def to_local(self, master_time):
+        """マスターの時刻を自分の時計の時刻にする。まだずれが分からなければNone"""
+        offset = self.offset
+        return None if offset is None else master_time - offset
+
+    def phase(self, interval):
+        """マスターのフレームの区切りが自分の時計で何秒ずれているか(0 <= phase < interval)"""
+        return 0.0 if self.offset is None else (-self.offset) % interval
@@ -0,0 +1,133 @@
+# マスターの自動発見と、つなぎ直しの間隔
+# マスターはBEACON_INTERVALごとに自分のTCPポートをUDPマルチキャストで知らせる
+# スレーブはそれを待ち受けて、送ってきたアドレスにつなぐ(マスターのIPを設定しなくてよい)
+# 1台のPCで試すときは環境変数MULTICAST_INTERFACE=127.0.0.1にする(multicast.pyと同じ)
+import json
+import random
+import socket
+import threading
+import time
+
+import log
+from hal import clock  # シミュレーションでは速回しされる時計
+from multicast import MULTICAST_INTERFACE, MULTICAST_TTL
+
+logger = log.get_logger("discovery")
+
+# ビーコンのグループとポート(描画コマンドのマルチキャストとは別)
+BEACON_GROUP = "239.255.42.2"
+BEACON_PORT = 5008
+# ビーコンを送る間隔(秒)
+BEACON_INTERVAL = 1.0
+# 受信待ちのタイムアウト(秒)。止めるときの反応の速さ
+RECEIVE_TIMEOUT = 0.5
+
+# つなぎ直しの間隔(秒)。失敗するたびにBACKOFF_FACTOR倍、BACKOFF_MAXまで
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 10.0
+BACKOFF_FACTOR = 2.0
+# 間隔をどこまでランダムに縮めるか(全スレーブが同時につなぎ直さないように)
+BACKOFF_JITTER = 0.5
+
+
+class Backoff:
+    """失敗するたびに待ち時間を伸ばす(ゆらぎ付きの指数バックオフ)"""
+
+    def __init__(self, initial=BACKOFF_INITIAL, maximum=BACKOFF_MAX, factor=BACKOFF_FACTOR,
+                 jitter=BACKOFF_JITTER):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        """次に待つ時間(秒)"""
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    def reset(self):
+        """つながったら最初の間隔に戻す"""
+        self.attempts = 0
+
+
+class Beacon:
+    """マスター側。TCPポートと、今つないでよいか(複数機能中か)を知らせ続ける"""
+
+    def __init__(self, port, is_active=lambda: True, group=BEACON_GROUP, beacon_port=BEACON_PORT,
+                 interface=MULTICAST_INTERFACE, interval=BEACON_INTERVAL):
+        self.port = port
+        self.is_active = is_active
+        self.group = group
+        self.beacon_port = beacon_port
+        self.interval = interval
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._socket.close()
+
+    def send(self):
+        """ビーコンを1回送る"""
+        message = {"type": "beacon", "port": self.port, "active": bool(self.is_active())}
+        try:
+            self._socket.sendto(json.dumps(message).encode(), (self.group, self.beacon_port))
+        except OSError as e:
+            logger.warning("Beacon send failed: %s", e)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.send()
+            self._stopped.wait(clock.real(self.interval))
+
+
+def discover_master(timeout, cancel=None, group=BEACON_GROUP, beacon_port=BEACON_PORT,
+                    interface=MULTICAST_INTERFACE):
+    """つないでよいマスターのビーコンを待って(ip, port)を返す
+
+    timeout秒(clockの時間)待っても来なければ、またはcancel(threading.Event)がセットされたらNone
+    グループに参加できない(マルチキャストの経路がないなど)ときもNone。呼んだ側がしばらくして試し直す
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                # 1台のPCで複数のスレーブが同時に待ち受けてもよいように
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((group, beacon_port))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + socket.inet_aton(interface))
+        except OSError as e:
+            logger.warning("Could not listen for master beacons on %s: %s", interface, e)
+            return None
+        sock.settimeout(RECEIVE_TIMEOUT)
+        deadline = time.monotonic() + clock.real(timeout)
+        while time.monotonic() < deadline:
+            if cancel is not None and cancel.is_set():
+                return None
+            try:
+                data, (ip, _) = sock.recvfrom(1024)
+                message = json.loads(data.decode())
+            except socket.timeout:
+                continue
+            except (UnicodeDecodeError, ValueError):
+                continue
+            if isinstance(message, dict) and message.get("type") == "beacon" and message.get("active"):
+                return ip, message["port"]
+        return None
+    finally:
+        sock.close()
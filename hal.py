@@ -0,0 +1,375 @@
+# ハードウェアの抽象化 (マスター・スレーブ共通)
+# サーボ・ボタン(pigpio)、圧力センサ(spidev)、ToF(VL53L0X)、LED(rpi_ws281x)を差し替えられるようにする
+# 環境変数 HAL=sim で起動すると全部シミュレーションになり、Raspberry Piがなくても動く
+#   HAL_SPEED    : シミュレーションの時間の速さ(2なら2倍速。サーボやToFの待ち時間も縮む)
+#   HAL_SCENARIO : 物体の位置・圧力・ボタンの台本(JSONファイル)。なければdefault_scenario()
+#   HAL_EVENTS   : 押下から点灯までの各処理を通過した時刻を書き出すファイル(ベンチマーク用)
+#   HAL_NAME     : HAL_EVENTSに書く、このプロセスの名前
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+BACKEND = os.environ.get("HAL", "pi")
+SPEED = float(os.environ.get("HAL_SPEED", "1"))
+SCENARIO = os.environ.get("HAL_SCENARIO")
+EVENTS = os.environ.get("HAL_EVENTS")
+NAME = os.environ.get("HAL_NAME", "")
+
+# pigpioと同じ値
+INPUT = 0
+OUTPUT = 1
+EITHER_EDGE = 2
+# VL53L0X.pyと同じ値の測距モード
+BETTER_ACCURACY_MODE = 1
+HIGH_SPEED_MODE = 4
+
+# 測距モードごとの測定時間(us)。VL53L0Xのデータシートの値
+SIM_TIMING = {0: 33000, BETTER_ACCURACY_MODE: 66000, 2: 200000, 3: 33000, HIGH_SPEED_MODE: 20000}
+# 何もないときにToFが返す距離(mm)
+SIM_OUT_OF_RANGE = 8190
+# LEDに送ったフレームを何枚覚えておくか
+SIM_FRAME_HISTORY = 1000
+
+
+class Clock:
+    """時間の進み方をspeed倍にした時計
+
+    サーボやToFの待ち時間、描画や圧力の周期はこの時計で測るので、
+    シミュレーションでは全体を速回しできる。実機ではspeed=1でtimeと同じ
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._origin = time.monotonic()
+
+    def monotonic(self):
+        return self._origin + (time.monotonic() - self._origin) * self.speed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def real(self, seconds):
+        """この時計でのseconds秒が実時間で何秒か(Noneはそのまま)"""
+        return None if seconds is None else seconds / self.speed
+
+
+clock = Clock(SPEED)
+
+
+class EventLog:
+    """処理を通過した時刻を1行1つのJSONで書き出す
+
+    時刻はtime.monotonic()の実時間(LinuxではCLOCK_MONOTONICなので別プロセスの時刻と比べられる)
+    """
+
+    def __init__(self, path, name=NAME):
+        self.name = name
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def mark(self, stage, **fields):
+        record = {"t": time.monotonic(), "name": self.name, "stage": stage}
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+
+events = EventLog(EVENTS) if EVENTS else None
+
+
+def mark(stage, **fields):
+    """stageを通過した時刻を記録する。HAL_EVENTSがなければ何もしない"""
+    if events is not None:
+        events.mark(stage, **fields)
+
+
+def tick_diff(start, end):
+    """pigpioのtick(us, 32bitで一周する)の差 (pigpio.tickDiffと同じ)"""
+    return (end - start) & 0xFFFFFFFF
+
+
+class Hardware:
+    """ハードウェアを作る関数をまとめたもの
+
+    pi()       : pigpio.pi 相当(サーボとボタン)
+    SpiDev()   : spidev.SpiDev 相当(圧力センサのMCP3008)
+    ToF()      : VL53L0X.VL53L0X 相当
+    PixelStrip : rpi_ws281x.PixelStrip 相当
+    Color      : rpi_ws281x.Color 相当
+    """
+
+    simulated = False
+
+    def set_geometry(self, to_point):
+        """(角度, 距離) -> 筐体の座標 の変換を教える(シミュレーションのToFが使う)"""
+
+
+class PiHardware(Hardware):
+    """実機。ライブラリは使うときに初めてimportする
+
+    VL53L0X.pyはimportしただけで./vl53l0x_python.soを読み込みsmbusを開くので、
+    シミュレーションのときにimportされないようにしておく
+    """
+
+    def pi(self):
+        import pigpio
+        return pigpio.pi()
+
+    def SpiDev(self):
+        import spidev
+        return spidev.SpiDev()
+
+    def ToF(self):
+        import VL53L0X
+        return VL53L0X.VL53L0X()
+
+    def PixelStrip(self, *args, **kwargs):
+        from rpi_ws281x import PixelStrip
+        return PixelStrip(*args, **kwargs)
+
+    @staticmethod
+    def Color(red, green, blue, white=0):
+        return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+def default_scenario():
+    """台本がないときの動き: 中央付近に物体を置き、3秒ごとに強さの違う押下"""
+    return {
+        "object_radius": 15,
+        "objects": [[0, 80, 80]],
+        "presses": [[2.0 + 3.0 * i, 700 + 200 * (i % 5), 0.3] for i in range(100)],
+        "buttons": [],
+        "idle_total": 400,
+        "noise": 4,
+    }
+
+
+def load_scenario(path=SCENARIO):
+    if not path:
+        return default_scenario()
+    with open(path) as f:
+        scenario = default_scenario()
+        scenario.update(json.load(f))
+        return scenario
+
+
+class World:
+    """シミュレーションの状態(サーボの角度、物体の位置、圧力)を台本どおりに進める
+
+    台本の時刻は起動してからの秒数(clockの時間)
+    objects : [[時刻, x, y], ...] その時刻から物体が(x, y)(mm)にある。x, yがnullなら物体なし
+    presses : [[時刻, 圧力の合計値, 押している秒数], ...]
+    buttons : [[時刻, 押している秒数], ...]
+    """
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.start = clock.monotonic()
+        self.angle = 0.0
+        self.to_point = None
+        self.objects = sorted(scenario["objects"], key=lambda item: item[0])
+        self.presses = sorted(scenario["presses"])
+        self.random = random.Random(scenario.get("seed", 0))
+        # 台本の押下の時刻を実時間にして記録しておく(ベンチマークの起点)
+        now = time.monotonic()
+        for start, value, duration in self.presses:
+            mark("tap", t=now + clock.real(start), total=value)
+
+    def now(self):
+        return clock.monotonic() - self.start
+
+    def object_at(self, t):
+        position = None
+        for start, x, y in self.objects:
+            if start > t:
+                break
+            position = None if x is None or y is None else (x, y)
+        return position
+
+    def pressure_total(self, t):
+        total = self.scenario["idle_total"]
+        for start, value, duration in self.presses:
+            if start > t:
+                break
+            if t < start + duration:
+                total = max(total, value)
+        return total + self.random.uniform(-1, 1) * self.scenario["noise"]
+
+    def distance(self):
+        """今の角度でToFが測る距離(mm)。物体を円として、光線との交点までの距離"""
+        position = self.object_at(self.now())
+        if position is None or self.to_point is None:
+            return SIM_OUT_OF_RANGE
+        # to_pointは距離について1次なので、距離0と1の点から光線の向きが分かる
+        ox, oy = self.to_point(self.angle, 0)
+        ux, uy = self.to_point(self.angle, 1)
+        ux, uy = ux - ox, uy - oy
+        cx, cy = position[0] - ox, position[1] - oy
+        along = cx * ux + cy * uy
+        gap = cx * cx + cy * cy - along * along
+        radius = self.scenario["object_radius"]
+        if along <= 0 or gap > radius * radius:
+            return SIM_OUT_OF_RANGE
+        return int(along - math.sqrt(radius * radius - gap))
+
+
+class _SimCallback:
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class SimPi:
+    """pigpio.piのうち使っている分。サーボの角度をWorldに伝え、台本どおりにボタンを押す"""
+
+    def __init__(self, world):
+        self.world = world
+        self.pulse_width = {}
+
+    def set_mode(self, pin, mode):
+        pass
+
+    def set_glitch_filter(self, pin, steady):
+        pass
+
+    def set_servo_pulsewidth(self, pin, pulse_width):
+        self.pulse_width[pin] = pulse_width
+        if pulse_width:
+            # set_angleの 500~2500us -> 0~180度 の逆
+            self.world.angle = (pulse_width - 500) / (2500 - 500) * 180
+
+    def get_servo_pulsewidth(self, pin):
+        return self.pulse_width.get(pin, 0)
+
+    def get_current_tick(self):
+        return int(self.world.now() * 1000000) & 0xFFFFFFFF
+
+    def callback(self, pin, edge, func):
+        """台本のbuttonsの時刻にfunc(pin, level, tick)を呼ぶ(押す: level 0、離す: level 1)"""
+        handle = _SimCallback()
+
+        def press_buttons():
+            for start, duration in sorted(self.world.scenario["buttons"]):
+                for t, level in ((start, 0), (start + duration, 1)):
+                    delay = t - self.world.now()
+                    if handle.cancelled.wait(clock.real(max(0.0, delay))):
+                        return
+                    func(pin, level, int(t * 1000000) & 0xFFFFFFFF)
+
+        thread = threading.Thread(target=press_buttons)
+        thread.daemon = True
+        thread.start()
+        return handle
+
+    def stop(self):
+        pass
+
+
+class SimSpiDev:
+    """spidev.SpiDevのうち使っている分。MCP3008として台本の圧力を4チャンネルに分けて返す"""
+
+    def __init__(self, world, channels=4):
+        self.world = world
+        self.channels = channels
+        self.max_speed_hz = 0
+
+    def open(self, bus, device):
+        pass
+
+    def xfer2(self, data):
+        value = self.world.pressure_total(self.world.now()) / self.channels
+        value = min(max(int(round(value)), 0), 1023)
+        return [0, (value >> 8) & 3, value & 0xFF]
+
+    def close(self):
+        pass
+
+
+class SimToF:
+    """VL53L0X.VL53L0Xのうち使っている分"""
+
+    def __init__(self, world):
+        self.world = world
+        self.mode = None
+
+    def start_ranging(self, mode=BETTER_ACCURACY_MODE):
+        self.mode = mode
+
+    def stop_ranging(self):
+        self.mode = None
+
+    def get_timing(self):
+        return SIM_TIMING.get(self.mode, SIM_TIMING[BETTER_ACCURACY_MODE])
+
+    def get_distance(self):
+        return self.world.distance()
+
+
+class SimPixelStrip:
+    """rpi_ws281x.PixelStripのうち使っている分。show()したフレームを覚えておく"""
+
+    def __init__(self, num, pin, freq_hz=800000, dma=10, invert=False, brightness=255, channel=0):
+        self.pixels = [0] * num
+        self.frames = deque(maxlen=SIM_FRAME_HISTORY)  # (時刻, 画素のリスト)
+        self.shows = 0
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return len(self.pixels)
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return self.pixels[n]
+
+    def show(self):
+        self.shows += 1
+        self.frames.append((clock.monotonic(), list(self.pixels)))
+
+
+class SimHardware(Hardware):
+    """全部シミュレーション。台本(scenario)どおりに物体・圧力・ボタンが動く"""
+
+    simulated = True
+    Color = staticmethod(PiHardware.Color)
+
+    def __init__(self, scenario):
+        self.world = World(scenario)
+        self.strips = []
+
+    def set_geometry(self, to_point):
+        self.world.to_point = to_point
+
+    def pi(self):
+        return SimPi(self.world)
+
+    def SpiDev(self):
+        return SimSpiDev(self.world)
+
+    def ToF(self):
+        return SimToF(self.world)
+
+    def PixelStrip(self, *args, **kwargs):
+        strip = SimPixelStrip(*args, **kwargs)
+        self.strips.append(strip)
+        return strip
+
+
+def open_hardware(backend=BACKEND, scenario=None):
+    """backend("pi" か "sim")のハードウェアを返す"""
+    if backend == "pi":
+        return PiHardware()
+    if backend == "sim":
+        return SimHardware(scenario if scenario is not None else load_scenario())
+    raise ValueError("unknown HAL backend: %s" % backend)
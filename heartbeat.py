@@ -0,0 +1,104 @@
+# 接続が生きているかの確認 (マスター・スレーブ共通)
+# 空のsend(b"")ではsyscallが1回増えるだけで、相手が落ちていても分からない
+# スレーブはHEARTBEAT_INTERVALごとに {"type": "heartbeat"} を送り、マスターは同じものを返す
+# 何か受け取るたびに生きているとみなし、しばらく何も来なければ接続を切ってつなぎ直す
+import socket
+import threading
+
+import log
+from hal import clock  # シミュレーションでは速回しされる時計
+
+logger = log.get_logger("heartbeat")
+
+# ハートビートを送る間隔(秒)
+HEARTBEAT_INTERVAL = 1.0
+# これだけ何も受け取らなければ調子が悪い(degraded)とみなす(秒)
+HEARTBEAT_DEGRADED = 2.0
+# これだけ何も受け取らなければ死んだ(down)とみなして切る(秒)
+HEARTBEAT_TIMEOUT = 4.0
+
+# TCPキープアライブ(アプリが止まっていてもOSが相手の死を見つける)
+# 何もない状態がIDLE秒続いたらINTERVAL秒ごとに確認し、COUNT回返事がなければ切る
+KEEPALIVE_IDLE = 5
+KEEPALIVE_INTERVAL = 1
+KEEPALIVE_COUNT = 3
+
+# 接続の状態
+CONNECTING = "connecting"
+UP = "up"
+DEGRADED = "degraded"
+DOWN = "down"
+
+
+def heartbeat():
+    return {"type": "heartbeat"}
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """sockのTCPキープアライブを有効にする(細かい設定はLinuxだけ)"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError as e:
+        logger.warning("Could not enable TCP keepalive: %s", e)
+
+
+class LinkState:
+    """接続の状態 connecting -> up <-> degraded -> down
+
+    received()は何か受け取るたびに呼ぶ。check()は最後に受け取ってからの時間で状態を進める
+    状態が変わるとログに出す
+    """
+
+    def __init__(self, name, degraded=HEARTBEAT_DEGRADED, timeout=HEARTBEAT_TIMEOUT):
+        self.name = name
+        self.degraded = degraded
+        self.timeout = timeout
+        self.state = DOWN
+        self.last_received = None  # 最後に受け取った時刻 (clock.monotonic)
+        self._lock = threading.Lock()
+
+    def _set(self, state):
+        # _lockを持って呼ぶ
+        if state != self.state:
+            logger.info("%s: %s -> %s", self.name, self.state, state)
+            self.state = state
+
+    def connecting(self):
+        with self._lock:
+            self._set(CONNECTING)
+
+    def up(self):
+        """つながった。ここから時間を数える"""
+        with self._lock:
+            self.last_received = clock.monotonic()
+            self._set(UP)
+
+    def down(self):
+        with self._lock:
+            self._set(DOWN)
+
+    def received(self):
+        with self._lock:
+            self.last_received = clock.monotonic()
+            if self.state == DEGRADED:
+                self._set(UP)
+
+    def check(self):
+        """最後に受け取ってからの時間で状態を更新して返す"""
+        with self._lock:
+            if self.state in (UP, DEGRADED):
+                silent = clock.monotonic() - self.last_received
+                if silent >= self.timeout:
+                    self._set(DOWN)
+                elif silent >= self.degraded:
+                    self._set(DEGRADED)
+            return self.state
+
+    @property
+    def usable(self):
+        """送ってよい状態か(調子が悪くてもまだ送る)"""
+        return self.state in (UP, DEGRADED)
@@ -0,0 +1,96 @@
+# ログの出力 (マスター・スレーブ共通)
+# printはstdout(autostartではjournald)に書き終わるまで呼んだスレッドを止めてしまう
+# ここではログをキューに積むだけにして、書き出しは別スレッドで行う
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+# 同じメッセージはこの間隔(秒)に1回だけ出す
+RATE_LIMIT_INTERVAL = 0.2
+# 間引きのために覚えておくメッセージの数。超えたら間隔を過ぎたものを忘れる
+RATE_LIMIT_KEYS = 1024
+# 1角度ごと・1メッセージごとなどの細かいログのロガー名の頭。普段は出さない
+TRACE = "trace"
+FORMAT = "%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s"
+DATE_FORMAT = "%H:%M:%S"
+
+
+class RateLimitFilter(logging.Filter):
+    """同じロガー・同じメッセージをinterval秒に1回に間引く
+
+    間引いた数は次に出すメッセージの後ろに付ける
+    細かいログ(trace)は書式(msg)ごとに数えるので、引数(角度など)が違っても同じメッセージとして扱う
+    普段のログは引数を入れたあとの文が同じものだけを間引く(別のスレーブ・別のできごとは全部出す)
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, max_keys=RATE_LIMIT_KEYS):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self._last = {}  # {(name, msg): (最後に出した時刻, 間引いた数)}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.name == TRACE or record.name.startswith(TRACE + "."):
+            key = (record.name, record.msg)
+        else:
+            key = (record.name, record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._last.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._last[key] = (last, suppressed + 1)
+                return False
+            if len(self._last) >= self.max_keys:
+                # 間隔を過ぎたものは覚えておかなくてよい
+                self._last = {k: v for k, v in self._last.items() if now - v[0] < self.interval}
+            self._last[key] = (now, 0)
+        if suppressed:
+            record.msg = "%s (%d similar suppressed)" % (record.msg, suppressed)
+        return True
+
+
+def get_logger(name):
+    """普段から出すログ(接続・押下ごとのできごと)のロガー"""
+    return logging.getLogger(name)
+
+
+def get_trace_logger(name):
+    """ループの中の細かいログのロガー。setup(trace=True)のときだけ出る"""
+    return logging.getLogger(TRACE + "." + name)
+
+
+_listener = None
+
+
+def setup(level=logging.INFO, trace=False, interval=RATE_LIMIT_INTERVAL, stream=None):
+    """ログをキュー経由で出すようにする
+
+    呼んだスレッドはキューに積むだけなので、出力が詰まっても描画やサーボの周期に影響しない
+    traceがFalseなら細かいログ(get_trace_logger)はレベルの比較だけで捨てられる
+    """
+    global _listener
+    shutdown()
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if interval:
+        handler.addFilter(RateLimitFilter(interval))
+    output = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    logging.getLogger(TRACE).setLevel(logging.DEBUG if trace else logging.WARNING)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def shutdown():
+    """キューに残っているログを書き出して、書き出しスレッドを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,202 @@
+# マスター -> スレーブの描画コマンドをUDPマルチキャストで送る
+# TCPのbroadcastはスレーブの数だけsendするので、台数に比例して最後のスレーブに届くのが遅れる
+# マルチキャストなら1回送るだけで全スレーブに届く
+# init・nackなどの制御はこれまでどおりTCPで送る
+#
+# データグラム形式: [通し番号 4byte (big endian)][protocolの1フレーム]
+# UDPは届かないことがあるので、スレーブは通し番号の抜けに気づいたらTCPで {"type": "nack", "seqs": [...]} を送り、
+# マスターは最近送ったRETRANSMIT_WINDOW個の中にあればもう一度マルチキャストする(重複はスレーブが捨てる)
+# グループに参加できなかったスレーブはTCPで {"type": "multicast_failed"} を送り、
+# マスターはそのスレーブにだけ描画コマンドもTCPで送る
+import os
+import socket
+import struct
+import threading
+from collections import OrderedDict
+
+import log
+import protocol  # 通信のメッセージ層
+
+logger = log.get_logger("multicast")
+trace = log.get_trace_logger("multicast")
+
+# マルチキャストのグループとポート(239.0.0.0/8は組織内で自由に使える範囲)
+MULTICAST_GROUP = "239.255.42.1"
+MULTICAST_PORT = 5007
+# ルーターを越えない(同じネットワークのスレーブだけ)
+MULTICAST_TTL = 1
+# 送受信に使うインターフェースのアドレス。0.0.0.0ならOSに任せる
+# 環境変数MULTICAST_INTERFACEで変えられる(1台のPCで試すときは127.0.0.1)
+MULTICAST_INTERFACE = os.environ.get("MULTICAST_INTERFACE", "0.0.0.0")
+# 再送のために覚えておくデータグラムの数。これより古い抜けはあきらめる
+RETRANSMIT_WINDOW = 64
+# 受信待ちのタイムアウト(秒)。stop()してからスレッドが終わるまでの最大時間
+RECEIVE_TIMEOUT = 0.5
+
+_SEQ = struct.Struct(">I")
+_SEQ_MAX = 0xFFFFFFFF
+
+
+def _seq_after(a, b):
+    """通し番号aがbより後か(一周しても比べられるように差で見る)"""
+    return a != b and ((a - b) & _SEQ_MAX) < 0x80000000
+
+
+class MulticastSender:
+    """マスター側。コマンドに通し番号を付けてマルチキャストし、最近の分を再送用に覚えておく"""
+
+    def __init__(self, group=MULTICAST_GROUP, port=MULTICAST_PORT, interface=MULTICAST_INTERFACE,
+                 ttl=MULTICAST_TTL, window=RETRANSMIT_WINDOW, binary=True):
+        self.group = group
+        self.port = port
+        self.window = window
+        self.binary = binary
+        self.seq = 0  # 最後に送った通し番号
+        self.sent = 0
+        self.retransmitted = 0
+        self._history = OrderedDict()  # {seq: データグラム}
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+
+    def announcement(self):
+        """スレーブに受信の仕方を教えるメッセージ(initへの返事としてTCPで送る)"""
+        return {"type": "multicast", "group": self.group, "port": self.port, "seq": self.seq}
+
+    def send(self, data):
+        """dataを1回だけマルチキャストする(エンコードも1回だけ)"""
+        frame = protocol.encode_message(data, self.binary)
+        with self._lock:
+            self.seq = (self.seq + 1) & _SEQ_MAX
+            datagram = _SEQ.pack(self.seq) + frame
+            self._history[self.seq] = datagram
+            while len(self._history) > self.window:
+                self._history.popitem(last=False)
+            self._sendto(datagram)
+            self.sent += 1
+
+    def retransmit(self, seqs):
+        """nackで頼まれた番号をもう一度マルチキャストする。もう覚えていないものは飛ばす"""
+        with self._lock:
+            for seq in seqs:
+                datagram = self._history.get(seq)
+                if datagram is None:
+                    trace.debug("Cannot retransmit %d (out of window)", seq)
+                    continue
+                self._sendto(datagram)
+                self.retransmitted += 1
+
+    def _sendto(self, datagram):
+        try:
+            self._socket.sendto(datagram, (self.group, self.port))
+        except OSError as e:
+            logger.warning("Multicast send failed: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "retransmitted": self.retransmitted}
+
+    def close(self):
+        self._socket.close()
+
+
+class MulticastReceiver:
+    """スレーブ側。受け取ったコマンドを通し番号の順に調べ、抜けていればnackを頼む
+
+    on_messageは受け取ったコマンド(辞書)ごとに、on_nackは抜けた通し番号のリストで呼ぶ
+    再送で届いたものは順番が前後してもそのまま渡す(drawはstart_atで描く時刻が決まるので困らない)
+    """
+
+    def __init__(self, on_message, on_nack, group=MULTICAST_GROUP, port=MULTICAST_PORT,
+                 interface=MULTICAST_INTERFACE, window=RETRANSMIT_WINDOW):
+        self.on_message = on_message
+        self.on_nack = on_nack
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.window = window
+        self.expected = None  # 次に届くはずの通し番号
+        self.missing = set()  # 抜けていて、再送を待っている通し番号
+        self.received = 0
+        self.duplicates = 0
+        self.lost = 0  # 再送でも間に合わなかった数
+        self._socket = None
+        self._thread = None
+        self._running = False
+
+    def start(self, seq=None):
+        """グループに参加して受信スレッドを立ち上げる。seqはマスターが最後に送った通し番号"""
+        if seq is not None:
+            self.expected = (seq + 1) & _SEQ_MAX
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # 1台のPCで複数のスレーブを動かすときも同じポートで受けられるように
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._socket.bind((self.group, self.port))
+        self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                socket.inet_aton(self.group) + socket.inet_aton(self.interface))
+        self._socket.settimeout(RECEIVE_TIMEOUT)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+        logger.info("Joined multicast group %s:%d", self.group, self.port)
+
+    def stop(self):
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _run(self):
+        while self._running:
+            try:
+                datagram = self._socket.recv(protocol.MAX_PAYLOAD + 8)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                logger.warning("Multicast receive failed: %s", e)
+                break
+            if len(datagram) < _SEQ.size:
+                continue
+            (seq,) = _SEQ.unpack_from(datagram)
+            if not self._accept(seq):
+                continue
+            for message in protocol.FrameDecoder().feed(datagram[_SEQ.size:]):
+                self.on_message(message)
+
+    def _accept(self, seq):
+        """seqのデータグラムを渡すかどうか。抜けを見つけたらon_nackを呼ぶ"""
+        if self.expected is None or seq == self.expected:
+            self.expected = (seq + 1) & _SEQ_MAX
+        elif _seq_after(seq, self.expected):
+            # 間が抜けた。古すぎるものは頼まない
+            gap = (seq - self.expected) & _SEQ_MAX
+            first = (seq - min(gap, self.window)) & _SEQ_MAX
+            self.lost += gap - min(gap, self.window)
+            lost = [(first + i) & _SEQ_MAX for i in range(min(gap, self.window))]
+            self.missing.update(lost)
+            self.expected = (seq + 1) & _SEQ_MAX
+            trace.debug("Missing %s, requesting retransmit", lost)
+            self.on_nack(lost)
+        elif seq in self.missing:
+            self.missing.discard(seq)  # 再送で届いた
+        else:
+            self.duplicates += 1
+            return False
+        # 再送の窓から外れたものはあきらめる
+        if len(self.missing) > self.window:
+            oldest = sorted(self.missing, key=lambda s: (self.expected - s) & _SEQ_MAX, reverse=True)
+            for s in oldest[:len(self.missing) - self.window]:
+                self.missing.discard(s)
+                self.lost += 1
+        self.received += 1
+        return True
+
+    def stats(self):
+        return {"received": self.received, "duplicates": self.duplicates,
+                "missing": len(self.missing), "lost": self.lost}
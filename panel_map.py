@@ -0,0 +1,120 @@
+# LEDマトリックスの座標(x, y)からテープLEDの何番目かへの対応表
+# 奇数行の反転(ジグザグ)を毎ピクセル計算する代わりに、起動時に表を作って引くだけにする
+import threading
+from array import array
+
+# パネル内の配線
+SERPENTINE = "serpentine"    # 奇数行で向きが反転するジグザグ配線
+PROGRESSIVE = "progressive"  # 全行が同じ向き
+
+# 複数パネルをつなぐ順番
+# ROW_MAJOR : 左上から右へ、段が変わったら左端から
+# SNAKE     : 段ごとに向きが反転する
+ROW_MAJOR = "row_major"
+SNAKE = "snake"
+
+
+class PanelMap:
+    """(x, y) -> テープLEDのインデックスの表
+
+    panels_x x panels_y 枚のパネルを1本のテープにつないだものを1つの座標系として扱う
+    rotationはパネルの取り付け向き(0, 90, 180, 270度)
+    """
+
+    def __init__(self, panel_width=16, panel_height=16, panels_x=1, panels_y=1,
+                 wiring=SERPENTINE, rotation=0, chain=ROW_MAJOR):
+        if wiring not in (SERPENTINE, PROGRESSIVE):
+            raise ValueError("unknown wiring: %s" % wiring)
+        if rotation not in (0, 90, 180, 270):
+            raise ValueError("rotation must be 0, 90, 180 or 270")
+        if chain not in (ROW_MAJOR, SNAKE):
+            raise ValueError("unknown chain: %s" % chain)
+        self.panel_width = panel_width
+        self.panel_height = panel_height
+        self.panels_x = panels_x
+        self.panels_y = panels_y
+        self.wiring = wiring
+        self.rotation = rotation
+        self.chain = chain
+        self.width = panel_width * panels_x
+        self.height = panel_height * panels_y
+        self.led_count = self.width * self.height
+        self.table = self._build()
+
+    def _panel_index(self, x, y):
+        """パネル内の座標からパネル内のインデックスを求める"""
+        w, h = self.panel_width, self.panel_height
+        # 取り付け向きの分だけ回して、配線上の行・列にする
+        if self.rotation == 0:
+            col, row, row_len = x, y, w
+        elif self.rotation == 90:
+            col, row, row_len = h - 1 - y, x, h
+        elif self.rotation == 180:
+            col, row, row_len = w - 1 - x, h - 1 - y, w
+        else:
+            col, row, row_len = y, w - 1 - x, h
+        if self.wiring == SERPENTINE and row % 2 == 1:  # Zigzag for odd rows
+            col = row_len - 1 - col
+        return row * row_len + col
+
+    def _chain_position(self, panel_x, panel_y):
+        """テープ上で何枚目のパネルか"""
+        if self.chain == SNAKE and panel_y % 2 == 1:
+            panel_x = self.panels_x - 1 - panel_x
+        return panel_y * self.panels_x + panel_x
+
+    def _build(self):
+        per_panel = self.panel_width * self.panel_height
+        table = array("I", bytes(4 * self.led_count))
+        for y in range(self.height):
+            panel_y, local_y = divmod(y, self.panel_height)
+            for x in range(self.width):
+                panel_x, local_x = divmod(x, self.panel_width)
+                base = self._chain_position(panel_x, panel_y) * per_panel
+                table[y * self.width + x] = base + self._panel_index(local_x, local_y)
+        return table
+
+
+def disc_reaches(xc, yc, radius, x0, y0, x1, y1):
+    """中心(xc, yc)、半径radiusの円板が x0 <= x < x1, y0 <= y < y1 の領域にかかるか"""
+    nx = min(max(xc, x0), x1 - 1) - xc
+    ny = min(max(yc, y0), y1 - 1) - yc
+    return nx * nx + ny * ny <= radius * radius
+
+
+class PanelRegistry:
+    """マスターが覚えておく、各スレーブの担当領域(全体の座標で)
+
+    initメッセージの位置(row, column)と、あればorigin/sizeから登録する
+    波紋がどのスレーブの領域にかかるかをreaching()で調べ、drawを送る先を絞る
+    """
+
+    def __init__(self, panel_width=16, panel_height=16):
+        self.panel_width = panel_width
+        self.panel_height = panel_height
+        self.regions = {}  # {(row, column): (x0, y0, x1, y1)}
+        self._lock = threading.Lock()
+
+    def register(self, position, origin=None, size=None):
+        """positionのスレーブの領域を登録する。originとsizeがなければ位置とパネルの大きさから求める"""
+        row, column = position
+        if origin is None:
+            # スレーブのSLAVE_ORIGIN_X/Yと同じ: rowが横方向、columnが縦方向
+            origin = (row * self.panel_width, column * self.panel_height)
+        if size is None:
+            size = (self.panel_width, self.panel_height)
+        x0, y0 = origin
+        region = (x0, y0, x0 + size[0], y0 + size[1])
+        with self._lock:
+            self.regions[tuple(position)] = region
+        return region
+
+    def remove(self, position):
+        with self._lock:
+            self.regions.pop(tuple(position), None)
+
+    def reaching(self, xc, yc, radius):
+        """中心(xc, yc)、最大半径radiusの波紋がかかるスレーブの位置のリスト"""
+        with self._lock:
+            regions = list(self.regions.items())
+        return [position for position, region in regions if disc_reaches(xc, yc, radius, *region)]
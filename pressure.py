@@ -0,0 +1,347 @@
+# 圧力センサ(MCP3008)の読み取り (マスター・スレーブ共通)
+# ReadChannelは1チャンネルごとにspi.xfer2を呼んでいたが、
+# ここでは全チャンネル分の変換を1回のioctl(SPI_IOC_MESSAGE)でまとめて行う
+import ctypes
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+from array import array
+
+import hal
+import log
+from hal import clock  # シミュレーションでは速回しされる時計
+
+logger = log.get_logger("pressure")
+
+# MCP3008の分解能(10bit)と基準電圧
+ADC_MAX = 1023
+ADC_VREF = 5.0
+
+# linux/spi/spidev.h の struct spi_ioc_transfer
+class _SpiIocTransfer(ctypes.Structure):
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+
+def _spi_ioc_message(count):
+    """SPI_IOC_MESSAGE(count) のioctl番号"""
+    size = ctypes.sizeof(_SpiIocTransfer) * count
+    return (1 << 30) | (size << 16) | (ord("k") << 8)
+
+
+def to_volts(data, places=3):
+    """A/Dの値を電圧に変換する(指定した桁数で丸める)"""
+    return round((data * ADC_VREF) / float(ADC_MAX), places)
+
+
+class PressurePad:
+    """4つの圧力センサをまとめて読む
+
+    MCP3008は1回の変換ごとにCSを上げる必要があるので、1本のxfer2バッファにはつなげられない
+    代わりにチャンネルごとの転送(CSを毎回上げる)を並べて1回のioctlで送る
+    ioctlが使えないとき(spidev以外のオブジェクトなど)はチャンネルごとのxfer2で読む
+
+    sample_rateは読み取りの周期(Hz)、oversampleは1回の読み取りで何回変換して平均するか
+    """
+
+    def __init__(self, spi, channels=(0, 1, 2, 3), sample_rate=200, oversample=4):
+        self.spi = spi
+        self.channels = tuple(channels)
+        self.sample_rate = sample_rate
+        self.oversample = max(1, oversample)
+        self.period = 1.0 / sample_rate  # 読み取りの間隔(秒)
+        self._setup_batch()
+
+    def _setup_batch(self):
+        # oversample回 x チャンネル数 の変換を1つのメッセージにする
+        count = len(self.channels) * self.oversample
+        self._tx = (ctypes.c_uint8 * (3 * count))()
+        self._rx = (ctypes.c_uint8 * (3 * count))()
+        self._transfers = (_SpiIocTransfer * count)()
+        for n in range(count):
+            channel = self.channels[n % len(self.channels)]
+            self._tx[3 * n] = 1
+            self._tx[3 * n + 1] = (8 + channel) << 4
+            transfer = self._transfers[n]
+            transfer.tx_buf = ctypes.addressof(self._tx) + 3 * n
+            transfer.rx_buf = ctypes.addressof(self._rx) + 3 * n
+            transfer.len = 3
+            transfer.cs_change = 1 if n < count - 1 else 0  # 変換ごとにCSを上げる
+        self._request = _spi_ioc_message(count)
+        try:
+            self._fd = self.spi.fileno()
+        except (AttributeError, OSError):
+            self._fd = None
+
+    def _read_batch(self):
+        """全チャンネル x oversample回分の生の値を返す"""
+        if self._fd is not None:
+            for transfer in self._transfers:
+                transfer.speed_hz = getattr(self.spi, "max_speed_hz", 0)
+            try:
+                fcntl.ioctl(self._fd, self._request, self._transfers)
+                rx = self._rx
+                return [((rx[3 * n + 1] & 3) << 8) + rx[3 * n + 2] for n in range(len(self._transfers))]
+            except OSError:
+                self._fd = None  # 以降はxfer2で読む
+        values = []
+        for _ in range(self.oversample):
+            for channel in self.channels:
+                adc = self.spi.xfer2([1, (8 + channel) << 4, 0])
+                values.append(((adc[1] & 3) << 8) + adc[2])
+        return values
+
+    def read(self):
+        """各チャンネルの値(oversample回の平均)をarrayで返す"""
+        values = self._read_batch()
+        n = len(self.channels)
+        sums = [0] * n
+        for i, value in enumerate(values):
+            sums[i % n] += value
+        return array("H", [round(s / self.oversample) for s in sums])
+
+    def read_total(self):
+        """全チャンネルの合計値"""
+        return sum(self.read())
+
+
+# 閾値を下回ってから次の押下を受け付けるまでの余裕(A/Dの値)
+HYSTERESIS = 20
+# 押した瞬間から最大値を探す時間(秒)
+PRESS_WINDOW = 0.15
+# これより前に押されたものは古いので捨てる(秒)
+PRESS_MAX_AGE = 0.3
+
+
+# 何も載っていないときの合計値にこれを足したものを閾値にする
+TRIGGER_MARGIN = 50
+# 基準値の追従の速さ(EWMAの係数)。200Hzなら100秒ほどで変化の6割に追いつく
+BASELINE_ALPHA = 0.00005
+# 基準値をファイルに書き出す間隔(秒)
+BASELINE_SAVE_INTERVAL = 60.0
+# 基準値を保存するファイル(起動し直したときに空の状態を測り直さなくてよいように)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pressure_baseline.json")
+# 押下のあと閾値の上から下りず、値がこの幅に収まったままこの秒数続いたら、空の状態がずれたとみなして測り直す
+BASELINE_STUCK_BAND = HYSTERESIS
+BASELINE_STUCK_TIME = 10.0
+
+
+class Baseline:
+    """何も載っていないときの圧力の合計値をEWMAで追いかける
+
+    センサのドリフトや温度で空の状態の値がずれても閾値(baseline + margin)がついていく
+    押している間や閾値付近の値は混ぜない(PressureTriggerが静かなときの値だけを渡す)
+    値はpathにときどき保存し、次の起動時はstart()でそこから始める
+    """
+
+    def __init__(self, path=BASELINE_PATH, margin=TRIGGER_MARGIN, alpha=BASELINE_ALPHA,
+                 save_interval=BASELINE_SAVE_INTERVAL):
+        self.path = path
+        self.margin = margin
+        self.alpha = alpha
+        self.save_interval = save_interval
+        self.value = None  # 空の状態の合計値(まだ分からなければNone)
+        self._saved_at = time.monotonic()
+
+    @property
+    def threshold(self):
+        """押したとみなす合計値"""
+        return int(round(self.value)) + self.margin
+
+    def load(self):
+        """保存した基準値を読む。読めたらTrue"""
+        try:
+            with open(self.path) as f:
+                self.value = float(json.load(f)["baseline"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self):
+        """基準値を書き出す(書きかけのファイルを残さないように置き換える)"""
+        if self.value is None or not self.path:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"baseline": round(self.value, 2), "margin": self.margin}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning("Failed to save pressure baseline: %s", e)
+        self._saved_at = time.monotonic()
+
+    def seed(self, total):
+        """保存した値がなければ、今の値(空の状態のはず)から始める"""
+        if self.value is None:
+            self.value = float(total)
+            self.save()
+
+    def start(self, total):
+        """起動時の空の状態の値totalで始める。保存した値を使えたらTrue
+
+        保存した値がtotalとmargin以上違えば古いので捨てる
+        (そのままだと空の状態で閾値を超えたままになり、押下を検出できなくなる)
+        """
+        if self.load() and abs(self.value - total) <= self.margin:
+            return True
+        if self.value is not None:
+            logger.warning("Saved pressure baseline %.1f is stale (empty pad reads %d), re-measuring",
+                           self.value, total)
+        self.value = None
+        self.seed(total)
+        return False
+
+    def rebase(self, total):
+        """空の状態の値をtotalに置き直す(ずれが大きくてEWMAでは追いつけないとき)"""
+        self.value = float(total)
+        self.save()
+
+    def update(self, total):
+        """空の状態の値を1つ混ぜる"""
+        if self.value is None:
+            self.value = float(total)
+        elif total < self.value - self.margin:
+            # 空の状態より下がることはないので、基準値の方が古い。すぐに置き直す
+            self.rebase(total)
+            return
+        else:
+            self.value += self.alpha * (total - self.value)
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+
+class Press:
+    """1回の押下。閾値を超えた時刻と、PRESS_WINDOWの間の最大値を持つ"""
+
+    def __init__(self, timestamp, total, threshold):
+        self.timestamp = timestamp  # 閾値を超えた時刻 (clock.monotonic)
+        self.threshold = threshold  # そのときの閾値(音楽の区切りの基準)
+        self.first = total  # 閾値を超えたときの値
+        self.peak = total  # 押下中の最大値
+        self._complete = threading.Event()
+
+    def wait_peak(self, timeout=None):
+        """PRESS_WINDOWが終わるまで待って最大値を返す"""
+        self._complete.wait(clock.real(timeout))
+        return self.peak
+
+
+class PressureTrigger:
+    """専用スレッドで圧力を高い周期で読み、閾値を超えた瞬間に押下を知らせる
+
+    閾値を超えたらすぐにwait_press()が戻る。最大値はPRESS_WINDOWの間集めてPress.peakに入る
+    閾値 - hysteresis を下回るまでは次の押下にしない(閾値付近でのばたつき防止)
+    baselineを渡すと、押していない間の値で基準値を更新し、閾値をそれに合わせる
+    閾値の上で値が動かないままstuck_time秒続いたら、空の状態が上にずれたとみなして基準値を置き直す
+    (押している人の値は揺れるので、平らなまま続くのはずれた空の状態か載せたままの物)
+    """
+
+    def __init__(self, pad, threshold, hysteresis=HYSTERESIS, window=PRESS_WINDOW, baseline=None,
+                 stuck_band=BASELINE_STUCK_BAND, stuck_time=BASELINE_STUCK_TIME):
+        self.pad = pad
+        self.threshold = threshold
+        self.baseline = baseline
+        self.hysteresis = hysteresis
+        self.window = window
+        self.stuck_band = stuck_band
+        self.stuck_time = stuck_time
+        self.rebased = 0  # 平らなまま続いて基準値を置き直した回数
+        self.last_total = 0
+        self._presses = queue.Queue()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """読み取りスレッドを立ち上げる"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self.baseline is not None:
+            self.baseline.save()
+
+    def _run(self):
+        baseline = self.baseline
+        press = None
+        armed = True
+        stuck_value = None  # 閾値の上で平らに続いている値と、その始まりの時刻
+        stuck_since = None
+        next_sample = clock.monotonic()
+        while self._running:
+            total = self.pad.read_total()
+            now = clock.monotonic()
+            self.last_total = total
+            if press is not None:
+                # 押した直後は最大値を探す
+                if total > press.peak:
+                    press.peak = total
+                if now - press.timestamp >= self.window:
+                    press._complete.set()
+                    press = None
+            if armed and total >= self.threshold:
+                armed = False
+                if press is not None:
+                    press._complete.set()  # 前の押下の最大値探しはここまで
+                press = Press(now, total, self.threshold)
+                self._presses.put(press)
+                hal.mark("pressed", total=total)
+            elif total < self.threshold - self.hysteresis:
+                armed = True
+                stuck_value = None
+                if baseline is not None and press is None:
+                    # 押していないときの値だけで基準値を動かす
+                    baseline.update(total)
+                    self.threshold = baseline.threshold
+            elif not armed and press is None and baseline is not None:
+                # 押下が終わっても閾値の上から下りてこない
+                if stuck_value is None or abs(total - stuck_value) > self.stuck_band:
+                    stuck_value, stuck_since = total, now
+                elif now - stuck_since >= self.stuck_time:
+                    baseline.rebase(total)
+                    self.threshold = baseline.threshold
+                    self.rebased += 1
+                    logger.warning("Pressure stuck at %d above the threshold, re-based the baseline", total)
+                    armed = True
+                    stuck_value = None
+            next_sample += self.pad.period
+            delay = next_sample - clock.monotonic()
+            if delay > 0:
+                clock.sleep(delay)
+            else:
+                next_sample = clock.monotonic()
+        if press is not None:
+            press._complete.set()
+
+    def wait_press(self, timeout=None, max_age=PRESS_MAX_AGE):
+        """次の押下を待つ。timeout秒以内に押されなければNone
+
+        max_ageより前の押下(別の処理をしていた間のもの)は捨てる
+        """
+        deadline = None if timeout is None else clock.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - clock.monotonic())
+            try:
+                press = self._presses.get(timeout=clock.real(remaining))
+            except queue.Empty:
+                return None
+            if clock.monotonic() - press.timestamp <= max_age:
+                return press
@@ -0,0 +1,146 @@
+# マスター・スレーブ間通信のメッセージ層
+# TCPはストリームなので recv() の区切りとメッセージの区切りは一致しない
+# (2つのdrawが1回のrecvにまとまる、1つのメッセージが2回に分かれる など)
+# そこで長さ付きフレームで送り、FrameDecoderで1メッセージずつ取り出す
+#
+# フレーム形式: [ペイロード長 2byte (big endian)][種別 1byte][本体]
+#   種別 KIND_JSON   : 本体はJSON(UTF-8)
+#   種別 KIND_DRAW   : x, y, max_radius と7色のRGBを固定長で詰めたもの (フレーム全体で30byte)
+#   種別 KIND_SENSOR : x, y, data_total を固定長で詰めたもの
+#   種別 KIND_DRAW_AT: KIND_DRAWに描き始める時刻start_at(マスターの時計、double)を足したもの
+import json
+import struct
+
+import log
+
+logger = log.get_logger("protocol")
+
+KIND_JSON = 0
+KIND_DRAW = 1
+KIND_SENSOR = 2
+KIND_DRAW_AT = 3
+
+# drawで送る色の数 (CIRCLE_WIDTHと同じ)
+DRAW_COLORS = 7
+
+_HEADER = struct.Struct(">H")
+# 種別, x, y, max_radius, RGB x 7
+_DRAW = struct.Struct(">BhhH%dB" % (DRAW_COLORS * 3))
+# 種別, x, y, max_radius, start_at, RGB x 7
+_DRAW_AT = struct.Struct(">BhhHd%dB" % (DRAW_COLORS * 3))
+# 種別, x, y, data_total
+_SENSOR = struct.Struct(">Bhhi")
+
+# 1フレームのペイロードの最大長
+MAX_PAYLOAD = 0xFFFF
+
+_DRAW_KEYS = {"type", "x", "y", "colors", "max_radius"}
+_DRAW_AT_KEYS = _DRAW_KEYS | {"start_at"}
+_SENSOR_KEYS = {"type", "x", "y", "data_total"}
+
+
+class ProtocolError(ValueError):
+    """受信したフレームが不正"""
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _pack_binary(data):
+    """draw/sensor_dataを固定長バイナリにする。できなければNoneを返す"""
+    keys = set(data)
+    try:
+        if data.get("type") == "draw" and keys in (_DRAW_KEYS, _DRAW_AT_KEYS):
+            colors = data["colors"]
+            if len(colors) != DRAW_COLORS:
+                return None
+            rgb = [c for color in colors for c in color]
+            values = [data["x"], data["y"], data["max_radius"]] + rgb
+            if len(rgb) != DRAW_COLORS * 3 or not all(_is_int(v) for v in values):
+                return None
+            if keys == _DRAW_KEYS:
+                return _DRAW.pack(KIND_DRAW, *values)
+            start_at = data["start_at"]
+            if not isinstance(start_at, (int, float)) or isinstance(start_at, bool):
+                return None
+            return _DRAW_AT.pack(KIND_DRAW_AT, *values[:3], start_at, *rgb)
+        if data.get("type") == "sensor_data" and keys == _SENSOR_KEYS:
+            values = [data["x"], data["y"], data["data_total"]]
+            if not all(_is_int(v) for v in values):
+                return None
+            return _SENSOR.pack(KIND_SENSOR, *values)
+    except (struct.error, TypeError):
+        return None
+    return None
+
+
+def encode_message(data, binary=True):
+    """辞書を1フレームのbytesに変換
+
+    binaryがTrueのときdraw/sensor_dataは固定長バイナリで送る
+    (値が範囲外などで詰められないときはJSONで送る)
+    """
+    payload = _pack_binary(data) if binary else None
+    if payload is None:
+        body = json.dumps(data, separators=(",", ":")).encode()
+        payload = bytes([KIND_JSON]) + body
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("message too large: %d bytes" % len(payload))
+    return _HEADER.pack(len(payload)) + payload
+
+
+def decode_payload(payload):
+    """1フレーム分のペイロードを辞書に戻す"""
+    if not payload:
+        raise ProtocolError("empty frame")
+    kind = payload[0]
+    try:
+        if kind == KIND_JSON:
+            return json.loads(payload[1:].decode())
+        if kind == KIND_DRAW:
+            values = _DRAW.unpack(payload)
+            rgb = values[4:]
+            colors = [list(rgb[i:i + 3]) for i in range(0, len(rgb), 3)]
+            return {"type": "draw", "x": values[1], "y": values[2],
+                    "colors": colors, "max_radius": values[3]}
+        if kind == KIND_DRAW_AT:
+            values = _DRAW_AT.unpack(payload)
+            rgb = values[5:]
+            colors = [list(rgb[i:i + 3]) for i in range(0, len(rgb), 3)]
+            return {"type": "draw", "x": values[1], "y": values[2],
+                    "colors": colors, "max_radius": values[3], "start_at": values[4]}
+        if kind == KIND_SENSOR:
+            _, x, y, data_total = _SENSOR.unpack(payload)
+            return {"type": "sensor_data", "x": x, "y": y, "data_total": data_total}
+    except (struct.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(str(e)) from e
+    raise ProtocolError("unknown frame kind: %d" % kind)
+
+
+class FrameDecoder:
+    """受信したバイト列を溜めて、完成したメッセージから順に取り出す"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """受信データを追加し、完成したメッセージ(辞書)のリストを返す
+
+        途中までのフレームは次のfeedまで持ち越す
+        壊れたフレームはそのフレームだけ捨てて続きを読む
+        """
+        self._buffer += data
+        messages = []
+        while len(self._buffer) >= _HEADER.size:
+            (length,) = _HEADER.unpack_from(self._buffer)
+            end = _HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[_HEADER.size:end])
+            del self._buffer[:end]
+            try:
+                messages.append(decode_payload(payload))
+            except ProtocolError as e:
+                logger.warning("Dropped malformed frame: %s", e)
+        return messages
@@ -0,0 +1,369 @@
+# LEDマトリックスの描画に使う共通の処理 (マスター・スレーブ共通)
+import math
+import threading
+from array import array
+from functools import lru_cache
+from itertools import compress
+
+import hal
+from hal import clock  # シミュレーションでは速回しされる時計
+
+# 円のオフセット表をいくつの半径まで覚えておくか
+RING_CACHE_SIZE = 64
+
+
+# 円の配列の作成
+@lru_cache(maxsize=RING_CACHE_SIZE)
+def ring_offsets(radius):
+    """半径radiusの円周の中心からのオフセット(dx, dy)のタプル
+
+    中点円アルゴリズムの結果を重複なしで返す。形は半径だけで決まるので一度計算したら使い回す
+    """
+    x, y = 0, radius
+    d = 1 - radius
+    offsets = []
+    seen = set()
+
+    while x <= y:
+        for dx, dy in [(x, y), (y, x), (-x, y), (-y, x), (x, -y), (y, -x), (-x, -y), (-y, -x)]:
+            if (dx, dy) not in seen:
+                seen.add((dx, dy))
+                offsets.append((dx, dy))
+        if d < 0:
+            d += 2 * x + 3
+        else:
+            d += 2 * (x - y) + 5
+            y -= 1
+        x += 1
+    return tuple(offsets)
+
+
+def warm_ring_cache(max_radius):
+    """起動時に0からmax_radiusまでのオフセット表を作っておく"""
+    for radius in range(min(max_radius, RING_CACHE_SIZE - 1) + 1):
+        ring_offsets(radius)
+
+
+def ring_pixels(xc, yc, radius, x0, y0, x1, y1):
+    """中心(xc, yc)、半径radiusの円周のうち x0 <= x < x1, y0 <= y < y1 に入る座標のリスト"""
+    # 円周と領域が重ならないならオフセット表を見るまでもない
+    nx = min(max(xc, x0), x1 - 1) - xc
+    ny = min(max(yc, y0), y1 - 1) - yc
+    if nx * nx + ny * ny > (radius + 1) * (radius + 1):
+        return []  # 領域が円の外側
+    fx = max(xc - x0, x1 - 1 - xc)
+    fy = max(yc - y0, y1 - 1 - yc)
+    if radius > 1 and (radius - 1) * (radius - 1) > fx * fx + fy * fy:
+        return []  # 領域が円の内側
+
+    offsets = ring_offsets(radius)
+    # 円全体が領域に収まるなら平行移動だけ
+    if x0 <= xc - radius and xc + radius < x1 and y0 <= yc - radius and yc + radius < y1:
+        return [(xc + dx, yc + dy) for dx, dy in offsets]
+    # 領域の範囲をオフセット側に移しておけば範囲外の点は足し算せずに捨てられる
+    lo_x, hi_x = x0 - xc, x1 - xc
+    lo_y, hi_y = y0 - yc, y1 - yc
+    return [(xc + dx, yc + dy) for dx, dy in offsets
+            if lo_x <= dx < hi_x and lo_y <= dy < hi_y]
+
+
+# 1フレームの時間(秒)。animate_circlesのtime.sleep(0.1)と同じ
+FRAME_INTERVAL = 0.1
+
+
+def pack_color(r, g, b):
+    """rpi_ws281xのColor(r, g, b)と同じ形式の整数にする"""
+    return (r << 16) | (g << 8) | b
+
+
+def add_colors(a, b):
+    """2色を加算合成する(各色255で頭打ち)"""
+    if not a:
+        return b
+    if not b:
+        return a
+    r = min(((a >> 16) & 0xFF) + ((b >> 16) & 0xFF), 0xFF)
+    g = min(((a >> 8) & 0xFF) + ((b >> 8) & 0xFF), 0xFF)
+    bl = min((a & 0xFF) + (b & 0xFF), 0xFF)
+    return (r << 16) | (g << 8) | bl
+
+
+class Canvas:
+    """1フレーム分の画素(この筐体のローカル座標)。レイヤーはここに加算で描く"""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pixels = [0] * (width * height)
+
+    def add(self, x, y, color):
+        i = y * self.width + x
+        self.pixels[i] = add_colors(self.pixels[i], color)
+
+
+class Layer:
+    """Compositorに載せるエフェクトの基本形
+
+    draw()で今の状態をCanvasに描き、advance()で1フレーム進める
+    終わったらdoneをTrueにするとCompositorから外される
+    draw()で1画素でも描いたらlitをTrueにする(最初に点灯した時刻の記録に使う)
+    """
+
+    def __init__(self):
+        self.done = False
+        self.lit = False
+        self._finished = threading.Event()
+
+    def draw(self, canvas):
+        raise NotImplementedError
+
+    def advance(self):
+        raise NotImplementedError
+
+    def finish(self):
+        """Compositorから外されたときに呼ばれる"""
+        self.done = True
+        self._finished.set()
+
+    def wait(self, timeout=None):
+        """エフェクトが終わるまで待つ"""
+        return self._finished.wait(clock.real(timeout))
+
+
+class Ripple(Layer):
+    """広がる円(animate_circlesと同じ動き)
+
+    フレームkでは半径 max(0, k - (width - 1)) 以上 min(k + 1, max_radius) 未満の円を描く
+    つまり1フレームに1本ずつ外側へ描き足し、width本を超えたら内側から消していく
+    start_at(clockの時刻)を渡すと、フレームは描いた回数ではなく start_at からの経過時間で決まる
+    (フレーム0はstart_at。それまでは何も描かない。描画が遅れたフレームは飛ばす)
+    """
+
+    def __init__(self, xc, yc, colors, max_radius, width, start_at=None, interval=FRAME_INTERVAL):
+        super().__init__()
+        self.start_at = start_at
+        self.interval = interval
+        self.xc = xc
+        self.yc = yc
+        self.colors = [pack_color(*color) for color in colors]
+        self.max_radius = max_radius
+        self.width = width
+        self.frame = 0
+        self.frame_count = max_radius + width
+
+    def visible_radii(self):
+        return range(max(0, self.frame - (self.width - 1)), min(self.frame + 1, self.max_radius))
+
+    def draw(self, canvas):
+        if self.start_at is not None:
+            # 一番近いフレームの区切りで数える(区切りちょうどに描いたときの誤差で前のフレームにならないように)
+            self.frame = int(math.floor((clock.monotonic() - self.start_at) / self.interval + 0.5))
+        for radius in self.visible_radii():
+            color = self.colors[radius % self.width]
+            pixels = ring_pixels(self.xc, self.yc, radius, 0, 0, canvas.width, canvas.height)
+            if pixels:
+                self.lit = True
+            for x, y in pixels:
+                canvas.add(x, y, color)
+
+    def advance(self):
+        self.frame += 1
+        if self.frame >= self.frame_count:
+            self.done = True
+
+
+class Gathering(Layer):
+    """ランダムな位置の光がターゲットポジションに集まる(update_positionsと同じ動き)
+
+    点の座標と色はそれぞれarrayにまとめて持ち、全点を1回でまとめて動かす
+    たどり着いた点はマスクでまとめて取り除くので、1フレームの処理は点の数に比例するだけ
+    """
+
+    def __init__(self, points, target_x, target_y):
+        super().__init__()
+        self.xs = array("i", [point[0] for point in points])
+        self.ys = array("i", [point[1] for point in points])
+        self.colors = array("L", [point[2] for point in points])
+        self.target_x = int(target_x)
+        self.target_y = int(target_y)
+        self.done = not self.xs
+
+    def __len__(self):
+        return len(self.xs)
+
+    def draw(self, canvas):
+        width, height, pixels = canvas.width, canvas.height, canvas.pixels
+        for x, y, color in zip(self.xs, self.ys, self.colors):
+            if 0 <= x < width and 0 <= y < height:
+                i = y * width + x
+                pixels[i] = add_colors(pixels[i], color)
+                self.lit = True
+
+    def advance(self):
+        tx, ty = self.target_x, self.target_y
+        xs, ys, colors = self.xs, self.ys, self.colors
+        # ターゲットポジションにたどり着いた点を消す
+        alive = [x != tx or y != ty for x, y in zip(xs, ys)]
+        if not all(alive):
+            xs = array("i", compress(xs, alive))
+            ys = array("i", compress(ys, alive))
+            colors = array("L", compress(colors, alive))
+        # 残りの点を、ターゲットまでの距離が長い方向に1つ進める
+        dxs = [tx - x for x in xs]
+        dys = [ty - y for y in ys]
+        horizontal = [abs(dx) > abs(dy) for dx, dy in zip(dxs, dys)]
+        self.xs = array("i", [x + (dx > 0) - (dx < 0) if h else x
+                              for x, dx, h in zip(xs, dxs, horizontal)])
+        self.ys = array("i", [y if h else y + (dy > 0) - (dy < 0)
+                              for y, dy, h in zip(ys, dys, horizontal)])
+        self.colors = colors
+        self.done = not self.xs
+
+
+class PixelBuffer:
+    """stripに送った画素を覚えておき、変わった画素だけを書き込む
+
+    何も変わっていないフレームではshow()(WS281xへのDMA転送)をしない
+    起動直後はLEDに前の状態が残っているかもしれないので、最初の1回は全画素を書き込む
+    """
+
+    def __init__(self, strip, table):
+        self.strip = strip
+        self.table = table  # 座標の並び -> テープのインデックス (PanelMap.table)
+        self.pixels = [0] * len(table)
+        self.lit = 0  # 点灯している画素の数
+        self.synced = False  # stripの中身とpixelsが一致しているか
+        self.frames_pushed = 0
+        self.frames_skipped = 0
+        self.pixels_written = 0
+
+    def update(self, frame):
+        """frameと違う画素だけを書き込み、1つでも変わっていればshow()する"""
+        pixels, table, strip = self.pixels, self.table, self.strip
+        changed = 0
+        lit = self.lit
+        for i, color in enumerate(frame):
+            old = pixels[i]
+            if color == old and self.synced:
+                continue
+            strip.setPixelColor(table[i], color)
+            pixels[i] = color
+            changed += 1
+            if self.synced:
+                lit += (color != 0) - (old != 0)
+        if not self.synced:
+            lit = sum(1 for color in pixels if color)
+            self.synced = True
+        self.lit = lit
+        if changed:
+            strip.show()
+            self.frames_pushed += 1
+            self.pixels_written += changed
+        else:
+            self.frames_skipped += 1
+        return changed
+
+    def clear(self):
+        """全消灯。すでに全部消えていれば何もしない"""
+        if self.synced and self.lit == 0:
+            self.frames_skipped += 1
+            return 0
+        return self.update([0] * len(self.pixels))
+
+    def stats(self):
+        """送ったフレーム数と送らずに済んだフレーム数"""
+        total = self.frames_pushed + self.frames_skipped
+        return {
+            "frames_pushed": self.frames_pushed,
+            "frames_skipped": self.frames_skipped,
+            "pixels_written": self.pixels_written,
+            "skip_ratio": self.frames_skipped / total if total else 0.0,
+        }
+
+
+class Compositor:
+    """全エフェクトを1枚のフレームに合成して、1フレームに1回だけstrip.show()する
+
+    エフェクトはstripを直接触らずにレイヤーとしてadd_layer()で登録する
+    描画スレッドはFRAME_INTERVALごとに全レイヤーを合成し、変わった画素があるときだけ送る
+    描く時刻は phase + interval の倍数 にそろえる(スレーブはマスターのフレームの区切りに合わせる)
+    """
+
+    def __init__(self, strip, panel_map, interval=FRAME_INTERVAL):
+        self.strip = strip
+        self.panel_map = panel_map
+        self.interval = interval
+        self.phase = 0.0
+        self.layers = []
+        self.buffer = PixelBuffer(strip, panel_map.table)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def add_layer(self, layer):
+        with self._lock:
+            if not layer.done:
+                self.layers.append(layer)
+                return
+        layer.finish()
+
+    def clear(self):
+        """全レイヤーを外してすぐに消灯する"""
+        with self._lock:
+            layers, self.layers = self.layers, []
+            self.buffer.clear()
+        for layer in layers:
+            layer.finish()
+
+    def render_once(self):
+        """1フレーム分を合成して送る"""
+        canvas = Canvas(self.panel_map.width, self.panel_map.height)
+        finished = []
+        first_lit = []
+        with self._lock:
+            for layer in self.layers:
+                lit = layer.lit
+                layer.draw(canvas)
+                if layer.lit and not lit:
+                    first_lit.append(layer)
+                layer.advance()
+                if layer.done:
+                    finished.append(layer)
+            if finished:
+                self.layers = [layer for layer in self.layers if not layer.done]
+            if self.layers or finished:
+                self.buffer.update(canvas.pixels)
+            else:
+                # レイヤーがなければ合成するまでもなく真っ暗
+                self.buffer.clear()
+        for layer in first_lit:
+            hal.mark("led_on", layer=type(layer).__name__)
+        for layer in finished:
+            layer.finish()
+
+    def stats(self):
+        with self._lock:
+            return self.buffer.stats()
+
+    def start(self):
+        """描画スレッドを立ち上げる"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def next_tick(self, now):
+        """nowより後の、次に描く時刻"""
+        return self.phase + (math.floor((now - self.phase) / self.interval) + 1) * self.interval
+
+    def _run(self):
+        while self._running:
+            self.render_once()
+            # 間に合わなかったフレームは飛ばして、次の区切りまで待つ
+            now = clock.monotonic()
+            clock.sleep(self.next_tick(now) - now)
@@ -0,0 +1,328 @@
+# ToFセンサとサーボで物体の位置を特定する処理 (マスター・スレーブ共通)
+import threading
+from collections import deque
+
+import log
+from hal import clock  # シミュレーションでは速回しされる時計
+
+trace = log.get_trace_logger("tof_scan")
+
+# 荒い走査の角度の刻み(度)
+COARSE_STEP = 5
+# 細かい走査の角度の刻み(度)
+FINE_STEP = 1
+# 細かい走査で範囲内の点がこれより少なければ見つからなかったことにする
+FINE_MIN_POINTS = 3
+# ToFの測定時間の下限(us)
+MIN_TIMING = 20000
+# SG90が1度回るのにかかる時間(秒) 0.1秒/60度
+SERVO_SEC_PER_DEGREE = 0.1 / 60
+# 回す角度によらずサーボが落ち着くまでにかかる時間(秒)
+SERVO_SETTLE_MIN = 0.005
+# 範囲内(外)がこの回数続いたら物体の始まり(終わり)とみなす
+RUN_LENGTH = 5
+# 位置特定にかかった時間を何回分覚えておくか
+LATENCY_HISTORY = 50
+# キャッシュを使ってよい古さを、裏の走査1回にかかる時間(最近で一番長いもの)の何倍にするか
+# キャッシュは次の走査が終わるまで更新されないので、1回分より短いと押したときにほとんど古くなっている
+SCAN_AGE_MARGIN = 1.5
+
+
+class TofScanner:
+    """サーボを回しながらToFセンサで測距して、物体の位置(mm)を求める
+
+    to_point(angle, distance) で極座標を筐体の座標(x, y)に変換し、
+    in_range(x, y) でその点がディスプレイ上(物体)かどうかを判定する
+    サーボの今の角度を覚えておき、走査は今の角度に近い端から始める
+    (0→90度の次は90→0度になるので、毎回0度まで戻さなくてよい)
+    """
+
+    def __init__(self, tof, set_angle, to_point, in_range,
+                 coarse_mode, fine_mode, distance_error=0, max_angle=90, degree_cycle=FINE_STEP):
+        self.tof = tof
+        self.set_angle = set_angle
+        self.to_point = to_point
+        self.in_range = in_range
+        self.coarse_mode = coarse_mode  # 荒い走査の測距モード (VL53L0X_HIGH_SPEED_MODE)
+        self.fine_mode = fine_mode  # 細かい走査の測距モード (VL53L0X_BETTER_ACCURACY_MODE)
+        self.distance_error = distance_error
+        self.max_angle = max_angle
+        self.degree_cycle = degree_cycle  # 細かい走査の刻み(度)
+        self.angle = None  # サーボの今の角度(起動直後は不明)
+        self.mode = None
+        self.timing = MIN_TIMING
+        self.latencies = deque(maxlen=LATENCY_HISTORY)  # 位置特定にかかった時間(秒)
+        self.last_report = {}
+
+    def set_mode(self, mode):
+        """測距モードを切り替える(同じモードなら何もしない)。測定時間(us)を返す"""
+        if mode == self.mode:
+            return self.timing
+        if self.mode is not None:
+            self.tof.stop_ranging()
+        self.tof.start_ranging(mode)
+        self.mode = mode
+        self.timing = max(self.tof.get_timing(), MIN_TIMING)
+        return self.timing
+
+    def move_to(self, angle):
+        """サーボをangle度にして、回した角度の分だけ落ち着くのを待つ"""
+        if self.angle is None:
+            travel = self.max_angle  # どこにいるか分からないので一番遠い場合で待つ
+        else:
+            travel = abs(angle - self.angle)
+        self.set_angle(angle)  # サーボを回転
+        self.angle = angle
+        if travel:
+            clock.sleep(SERVO_SETTLE_MIN + travel * SERVO_SEC_PER_DEGREE)
+
+    def sweep_angles(self, low, high, step):
+        """low~highをstep刻みで、今の角度に近い端から並べる"""
+        angles = list(range(low, high + 1, step))
+        if self.angle is not None and abs(self.angle - high) < abs(self.angle - low):
+            angles.reverse()
+        return angles
+
+    def measure(self, angle):
+        """サーボをangle度にして測距する。物体の座標(x, y)と範囲内かを返す(測れなければNone)"""
+        self.set_angle(angle)  # サーボを回転
+        self.angle = angle
+        # ToFセンサで測距し、誤差を引いて正確な値にする
+        distance = self.tof.get_distance() - self.distance_error
+        clock.sleep(self.timing / 1000000.00)
+        if distance <= 0:
+            return None
+        x, y = self.to_point(angle, distance)
+        return x, y, self.in_range(x, y)
+
+    def find_pos_fast(self):
+        """荒い走査で物体のある角度の範囲を見つけ、その範囲だけを細かく走査する
+
+        物体の中心座標(x, y)を返す。見つからなければ(-1, -1)
+        """
+        start = clock.monotonic()
+
+        # 荒い走査: 高速モードでCOARSE_STEPごとに測り、最初に範囲内が続いた角度の範囲を探す
+        self.set_mode(self.coarse_mode)
+        angles = self.sweep_angles(0, self.max_angle, COARSE_STEP)
+        self.move_to(angles[0])
+        span = []
+        coarse_samples = 0
+        for angle in angles:
+            result = self.measure(angle)
+            coarse_samples += 1
+            if result is not None and result[2]:
+                span.append(angle)
+            elif span:
+                break  # 範囲内が途切れたら物体の範囲はそこまで
+        span.sort()
+        coarse_time = clock.monotonic() - start
+
+        # 細かい走査: 精度の高いモードで物体の範囲(前後に1刻み分の余裕)だけを測る
+        self.set_mode(self.fine_mode)
+        pointlist = []
+        fine_samples = 0
+        if span:
+            low = max(0, span[0] - COARSE_STEP + self.degree_cycle)
+            high = min(self.max_angle, span[-1] + COARSE_STEP - self.degree_cycle)
+            # 荒い走査が止まった側から折り返して測る
+            angles = self.sweep_angles(low, high, self.degree_cycle)
+            self.move_to(angles[0])
+            for angle in angles:
+                result = self.measure(angle)
+                fine_samples += 1
+                if result is not None and result[2]:
+                    pointlist.append(result[:2])
+
+        latency = clock.monotonic() - start
+        self.latencies.append(latency)
+        self.last_report = {
+            "latency_ms": latency * 1000,
+            "coarse_ms": coarse_time * 1000,
+            "fine_ms": (latency - coarse_time) * 1000,
+            "coarse_samples": coarse_samples,
+            "fine_samples": fine_samples,
+            "span": (span[0], span[-1]) if span else None,
+        }
+        trace.debug("find_pos_fast: %.0f ms (coarse %d samples %.0f ms, fine %d samples)",
+                    latency * 1000, coarse_samples, coarse_time * 1000, fine_samples)
+
+        if len(pointlist) < FINE_MIN_POINTS:
+            return -1, -1
+        # リストの中央値(物体の中心座標)を求める
+        return pointlist[len(pointlist) // 2]
+
+    def find_pos(self):
+        """0~90度をdegree_cycle刻みで走査して物体の中心座標(x, y)を返す。見つからなければ(-1, -1)
+
+        範囲内がRUN_LENGTH回続いたら物体の始まりとみなして記録を始め、
+        範囲外がRUN_LENGTH回続いたら終わりとみなす。記録した点の中央を物体の中心とする
+        """
+        start = clock.monotonic()
+        angles = self.sweep_angles(0, self.max_angle, self.degree_cycle)
+        self.move_to(angles[0])
+
+        # 配列の初期化
+        pointlist = []
+        flag = False
+        count = 0
+        samples = 0
+
+        for angle in angles:
+            result = self.measure(angle)
+            samples += 1
+            if result is None:
+                continue
+            x, y, in_range = result
+            # 角度と座標の表示
+            trace.debug("angle: %d \t pos:x %d, y %d", angle, x, y)
+            if not flag:  # flagがFalseのとき
+                count = count + 1 if in_range else 0
+                if count == RUN_LENGTH:  # 連続で範囲内ならflagをtrueに
+                    flag = True
+            else:  # flagがTrueのとき
+                pointlist.append([x, y])
+                count = 0 if in_range else count + 1
+                if count == RUN_LENGTH:  # 連続で範囲外ならforをぬける
+                    break
+
+        # 余分に記録した末尾の範囲外の点を削除
+        del pointlist[-RUN_LENGTH:]
+
+        latency = clock.monotonic() - start
+        self.latencies.append(latency)
+        self.last_report = {"latency_ms": latency * 1000, "samples": samples}
+        trace.debug("find_pos: %.0f ms (%d samples)", latency * 1000, samples)
+
+        # もしリストが入ってなかったら
+        if len(pointlist) == 0:
+            return -1, -1
+        # リストの中央値(物体の中心座標)を求める
+        mid = len(pointlist) // 2
+        return pointlist[mid][0], pointlist[mid][1]
+
+    def latency_stats(self):
+        """位置特定にかかった時間の統計(ms)"""
+        if not self.latencies:
+            return {"count": 0}
+        ordered = sorted(self.latencies)
+        return {
+            "count": len(ordered),
+            "last_ms": self.latencies[-1] * 1000,
+            "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+
+
+class PositionCache:
+    """最後に見つけた物体の位置と、その時刻を持つ(スレッドセーフ)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._position = None
+        self._timestamp = 0.0
+
+    def update(self, position):
+        with self._lock:
+            self._position = position
+            self._timestamp = clock.monotonic()
+
+    def latest(self, max_age):
+        """max_age秒以内に見つけた位置を返す。古いか、物体がなかったならNone"""
+        with self._lock:
+            position, timestamp = self._position, self._timestamp
+        if position is None or clock.monotonic() - timestamp > max_age:
+            return None
+        if position[0] < 0 or position[1] < 0:
+            return None
+        return position
+
+
+class BackgroundScanner:
+    """裏でサーボを回し続けて、物体の位置をキャッシュしておく
+
+    圧力が閾値を超えたらget_position()でキャッシュの位置をすぐに使える
+    キャッシュがmax_ageより古い(か物体がなかった)ときはその場で走査し直す
+    max_ageがNoneなら、測った走査1回の時間 * SCAN_AGE_MARGIN + intervalを使う
+    locateは1回分の走査をして(x, y)(見つからなければ(-1, -1))を返す関数
+    """
+
+    def __init__(self, locate, max_age=None, interval=0.0, margin=SCAN_AGE_MARGIN):
+        self.locate = locate
+        self.max_age = max_age  # キャッシュを使ってよい古さ(秒)。Noneなら走査の時間から決める
+        self.interval = interval  # 走査と走査の間の休み(秒)
+        self.margin = margin
+        self.sweep_times = deque(maxlen=LATENCY_HISTORY)  # 裏の走査1回にかかった時間(秒)
+        self.cache = PositionCache()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._servo_lock = threading.Lock()  # サーボとToFは同時に1つの走査しか使えない
+        self._idle = threading.Event()  # クリアされている間は裏の走査を始めない
+        self._idle.set()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """走査スレッドを立ち上げる"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True  # メインが終われば終わる
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._idle.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _sweep(self):
+        with self._servo_lock:
+            start = clock.monotonic()
+            position = self.locate()
+            self.cache.update(position)
+            self.sweep_times.append(clock.monotonic() - start)
+        return position
+
+    def effective_max_age(self):
+        """キャッシュを使ってよい古さ(秒)"""
+        if self.max_age is not None:
+            return self.max_age
+        if not self.sweep_times:
+            return 0.0  # まだ1回も走査していない(キャッシュも空)
+        return max(self.sweep_times) * self.margin + self.interval
+
+    def _run(self):
+        while self._running:
+            # get_positionが走査を待っている間は譲る
+            self._idle.wait()
+            if not self._running:
+                break
+            self._sweep()
+            if self.interval:
+                clock.sleep(self.interval)
+
+    def stats(self):
+        """キャッシュを使えた回数・走査し直した回数と、使ってよい古さ(秒)"""
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "max_age": self.effective_max_age()}
+
+    def get_position(self, max_age=None):
+        """物体の位置(x, y)を返す。キャッシュが古ければ走査する"""
+        if max_age is None:
+            max_age = self.effective_max_age()
+        position = self.cache.latest(max_age)
+        if position is None:
+            # 走査中ならそれが終わるのを待ってからもう一度キャッシュを見る
+            self._idle.clear()
+            try:
+                with self._servo_lock:
+                    position = self.cache.latest(max_age)
+                    if position is None:
+                        self.cache_misses += 1
+                        position = self.locate()
+                        self.cache.update(position)
+                        return position
+            finally:
+                self._idle.set()
+        self.cache_hits += 1
+        return position